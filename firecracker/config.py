@@ -47,12 +47,19 @@ class NetworkInterface(BaseModel):
     host_dev_name: str
 
 
+class Balloon(BaseModel):
+    amount_mib: int = 0
+    deflate_on_oom: bool = True
+    stats_polling_interval_s: int = 0
+
+
 class FirecrackerConfig(BaseModel):
     boot_source: BootSource
     drives: List[Drive]
     machine_config: MachineConfig
     vsock: Optional[Vsock]
     network_interfaces: Optional[List[NetworkInterface]]
+    balloon: Optional[Balloon]
 
     class Config:
         allow_population_by_field_name = True
@@ -2,6 +2,7 @@ import asyncio
 import json
 import logging
 import os.path
+import shutil
 import string
 from asyncio import Task
 from asyncio.base_events import Server
@@ -9,7 +10,9 @@ from os import getuid
 from pathlib import Path
 from pwd import getpwnam
 from tempfile import NamedTemporaryFile
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict
+
+import aiohttp
 
 from .config import FirecrackerConfig
 from .config import Drive
@@ -24,6 +27,10 @@ class MicroVMFailedInit(Exception):
     pass
 
 
+class FirecrackerApiError(Exception):
+    pass
+
+
 # extend the json.JSONEncoder class to support bytes
 class JSONBytesEncoder(json.JSONEncoder):
 
@@ -69,8 +76,9 @@ class MicroVM:
     config_file_path: Optional[Path] = None
     drives: List[Drive]
     init_timeout: float
+    restored_from_snapshot: bool = False
 
-    _unix_socket: Server
+    _unix_socket: Optional[Server] = None
 
     @property
     def namespace_path(self):
@@ -136,14 +144,17 @@ class MicroVM:
         # system(f"cp disks/rootfs.ext4 {self.jailer_path}/opt")
         # system(f"cp hello-vmlinux.bin {self.jailer_path}/opt")
 
-    async def start(self, config: FirecrackerConfig) -> asyncio.subprocess.Process:
+    async def start(
+        self, config: Optional[FirecrackerConfig]
+    ) -> asyncio.subprocess.Process:
+        """Start Firecracker. Without a config, the VM is only configured via the API."""
         if self.use_jailer:
             return await self.start_jailed_firecracker(config)
         else:
             return await self.start_firecracker(config)
 
     async def start_firecracker(
-        self, config: FirecrackerConfig
+        self, config: Optional[FirecrackerConfig]
     ) -> asyncio.subprocess.Process:
 
         if os.path.exists(VSOCK_PATH):
@@ -151,32 +162,22 @@ class MicroVM:
         if os.path.exists(self.socket_path):
             os.remove(self.socket_path)
 
-        with NamedTemporaryFile(delete=False) as config_file:
-            config_file.write(
-                config.json(by_alias=True, exclude_none=True, indent=4).encode()
-            )
-            config_file.flush()
-            os.chmod(config_file.name, 0o644)
-            self.config_file_path = Path(config_file.name)
-
-        logger.debug(
-            " ".join(
-                (
-                    self.firecracker_bin_path,
-                    "--api-sock",
-                    self.socket_path,
-                    "--config-file",
-                    config_file.name,
+        args = [self.firecracker_bin_path, "--api-sock", self.socket_path]
+
+        if config:
+            with NamedTemporaryFile(delete=False) as config_file:
+                config_file.write(
+                    config.json(by_alias=True, exclude_none=True, indent=4).encode()
                 )
-            )
-        )
+                config_file.flush()
+                os.chmod(config_file.name, 0o644)
+                self.config_file_path = Path(config_file.name)
+            args += ["--config-file", config_file.name]
+
+        logger.debug(" ".join(args))
 
         self.proc = await asyncio.create_subprocess_exec(
-            self.firecracker_bin_path,
-            "--api-sock",
-            self.socket_path,
-            "--config-file",
-            config_file.name,
+            *args,
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
@@ -184,43 +185,14 @@ class MicroVM:
         return self.proc
 
     async def start_jailed_firecracker(
-        self, config: FirecrackerConfig
+        self, config: Optional[FirecrackerConfig]
     ) -> asyncio.subprocess.Process:
         if not self.jailer_bin_path:
             raise ValueError("Jailer binary path is missing")
         uid = str(getpwnam("jailman").pw_uid)
         gid = str(getpwnam("jailman").pw_gid)
 
-        with open(f"{self.jailer_path}/tmp/config.json", "wb") as config_file:
-            config_file.write(
-                config.json(by_alias=True, exclude_none=True, indent=4).encode()
-            )
-            config_file.flush()
-            os.chmod(config_file.name, 0o644)
-            self.config_file_path = Path(config_file.name)
-
-        logger.debug(
-            " ".join(
-                (
-                    self.jailer_bin_path,
-                    "--id",
-                    str(self.vm_id),
-                    "--exec-file",
-                    self.firecracker_bin_path,
-                    "--uid",
-                    uid,
-                    "--gid",
-                    gid,
-                    "--chroot-base-dir",
-                    JAILER_BASE_DIRECTORY,
-                    "--",
-                    "--config-file",
-                    "/tmp/" + os.path.basename(config_file.name),
-                )
-            )
-        )
-
-        self.proc = await asyncio.create_subprocess_exec(
+        args = [
             self.jailer_bin_path,
             "--id",
             str(self.vm_id),
@@ -233,14 +205,135 @@ class MicroVM:
             "--chroot-base-dir",
             JAILER_BASE_DIRECTORY,
             "--",
-            "--config-file",
-            "/tmp/" + os.path.basename(config_file.name),
+        ]
+
+        if config:
+            with open(f"{self.jailer_path}/tmp/config.json", "wb") as config_file:
+                config_file.write(
+                    config.json(by_alias=True, exclude_none=True, indent=4).encode()
+                )
+                config_file.flush()
+                os.chmod(config_file.name, 0o644)
+                self.config_file_path = Path(config_file.name)
+            args += ["--config-file", "/tmp/" + os.path.basename(config_file.name)]
+
+        logger.debug(" ".join(args))
+
+        self.proc = await asyncio.create_subprocess_exec(
+            *args,
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
         return self.proc
 
+    async def wait_for_api_socket(self):
+        """Wait for Firecracker to listen on its API socket"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.init_timeout
+        while not os.path.exists(self.socket_path):
+            if loop.time() > deadline:
+                raise MicroVMFailedInit("Firecracker API socket not available")
+            await asyncio.sleep(0.01)
+
+    async def api_request(
+        self, method: str, path: str, body: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        """Send a request to the Firecracker API of the VM and return its JSON response,
+        if any."""
+        connector = aiohttp.UnixConnector(path=self.socket_path)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async with session.request(
+                method, f"http://localhost{path}", json=body
+            ) as response:
+                if response.status >= 300:
+                    error = await response.text()
+                    raise FirecrackerApiError(f"{method} {path}: {error}")
+                if response.content_type == "application/json":
+                    return await response.json()
+                return None
+
+    async def update_balloon(self, amount_mib: int) -> None:
+        """Set the target size of the balloon device, the guest then inflates or
+        deflates it progressively."""
+        await self.api_request("PATCH", "/balloon", {"amount_mib": amount_mib})
+
+    async def get_balloon_statistics(self) -> Optional[Dict]:
+        """Statistics of the balloon device, if their polling is enabled."""
+        return await self.api_request("GET", "/balloon/statistics")
+
+    def path_in_vm(self, path_on_host: Path) -> Path:
+        """Path of a file in the jail, as seen by Firecracker, from its path on the host."""
+        if self.use_jailer:
+            return Path("/") / Path(path_on_host).relative_to(self.jailer_path)
+        else:
+            return Path(path_on_host)
+
+    async def create_snapshot(self, snapshot_path: Path, mem_file_path: Path) -> None:
+        """Pause the VM, write a full snapshot of its state and memory, and resume it.
+
+        With the jailer, the snapshot files are written in the jail first and moved to
+        the given paths afterwards.
+        """
+        if self.use_jailer:
+            snapshot_in_jail = Path(f"{self.jailer_path}/tmp/snapshot")
+            mem_file_in_jail = Path(f"{self.jailer_path}/tmp/memory")
+        else:
+            snapshot_in_jail = snapshot_path
+            mem_file_in_jail = mem_file_path
+
+        await self.api_request("PATCH", "/vm", {"state": "Paused"})
+        try:
+            await self.api_request(
+                "PUT",
+                "/snapshot/create",
+                {
+                    "snapshot_type": "Full",
+                    "snapshot_path": str(self.path_in_vm(snapshot_in_jail)),
+                    "mem_file_path": str(self.path_in_vm(mem_file_in_jail)),
+                },
+            )
+        finally:
+            await self.api_request("PATCH", "/vm", {"state": "Resumed"})
+
+        if self.use_jailer:
+            shutil.move(snapshot_in_jail, snapshot_path)
+            shutil.move(mem_file_in_jail, mem_file_path)
+
+    async def start_from_snapshot(
+        self, snapshot_path: Path, mem_file_path: Path
+    ) -> asyncio.subprocess.Process:
+        """Start Firecracker and restore the VM from a snapshot instead of booting it.
+
+        The drives of the snapshot must have been made available to the VM beforehand.
+        """
+        if self.use_jailer:
+            snapshot_in_jail = Path(f"{self.jailer_path}/opt/snapshot")
+            mem_file_in_jail = Path(f"{self.jailer_path}/opt/memory")
+            os.link(snapshot_path, snapshot_in_jail)
+            os.link(mem_file_path, mem_file_in_jail)
+        else:
+            snapshot_in_jail = snapshot_path
+            mem_file_in_jail = mem_file_path
+
+        proc = await self.start(config=None)
+        await self.wait_for_api_socket()
+        await self.api_request(
+            "PUT",
+            "/snapshot/load",
+            {
+                "snapshot_path": str(self.path_in_vm(snapshot_in_jail)),
+                "mem_backend": {
+                    "backend_type": "File",
+                    "backend_path": str(self.path_in_vm(mem_file_in_jail)),
+                },
+                "enable_diff_snapshots": False,
+                "resume_vm": True,
+            },
+        )
+        self.restored_from_snapshot = True
+        return proc
+
     def enable_kernel(self, kernel_image_path: str) -> str:
         """Make a kernel available to the VM.
 
@@ -373,14 +466,32 @@ class MicroVM:
                 f"ConnectionResetError in shutdown of {self.vm_id}: {error.args}"
             )
 
-    async def stop(self):
+    async def wait_for_exit(self, timeout: float) -> bool:
+        """Wait for the firecracker process to exit, return whether it did."""
+        if not self.proc:
+            return True
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self, timeout: float = 1.0):
+        """Terminate the firecracker process, killing it if it does not exit in time."""
         if self.proc:
-            logger.debug("Stopping firecracker process")
-            try:
-                self.proc.terminate()
-                self.proc.kill()
-            except ProcessLookupError:
-                logger.debug(f"Firecracker process pid={self.proc.pid} not found")
+            if self.proc.returncode is None:
+                logger.debug("Stopping firecracker process")
+                try:
+                    self.proc.terminate()
+                    if not await self.wait_for_exit(timeout=timeout):
+                        logger.warning(
+                            f"Firecracker process pid={self.proc.pid} did not "
+                            f"terminate, killing it"
+                        )
+                        self.proc.kill()
+                        await self.proc.wait()
+                except ProcessLookupError:
+                    logger.debug(f"Firecracker process pid={self.proc.pid} not found")
             self.proc = None
         else:
             logger.debug("No firecracker process to stop")
@@ -391,8 +502,9 @@ class MicroVM:
             await asyncio.wait_for(self.shutdown(), timeout=5)
         except asyncio.TimeoutError:
             logger.exception(f"Timeout during VM shutdown vm={self.vm_id}")
-        logger.debug("Waiting for one second for the process to shudown")
-        await asyncio.sleep(1)
+        # Firecracker exits when the VM halts
+        if not await self.wait_for_exit(timeout=1):
+            logger.debug("Firecracker process still running after the shutdown")
         await self.stop()
 
         if self.stdout_task:
@@ -14,7 +14,8 @@ import ctypes
 import asyncio
 import os
 import socket
-from enum import Enum
+import struct
+from enum import Enum, IntEnum
 import subprocess
 import sys
 import traceback
@@ -23,7 +24,18 @@ from dataclasses import dataclass, field
 from io import StringIO
 from os import system
 from shutil import make_archive
-from typing import Optional, Dict, Any, Tuple, List, NewType, Union, AsyncIterable
+from typing import (
+    Optional,
+    Dict,
+    Any,
+    Tuple,
+    List,
+    NewType,
+    Union,
+    AsyncIterable,
+    Callable,
+    Awaitable,
+)
 
 import aiohttp
 import msgpack
@@ -32,6 +44,29 @@ logger.debug("Imports finished")
 
 ASGIApplication = NewType("AsgiApplication", Any)
 
+# Multiplexed channel with the supervisor, see `serve_multiplexed`
+MUX_HANDSHAKE = b"MUX\n"
+MUX_ACK = b"MUX OK\n"
+FRAME_HEADER = struct.Struct("!IBI")  # Request id, frame type, payload length
+CREDIT = struct.Struct("!I")  # Number of frames consumed by the receiver
+
+
+class FrameType(IntEnum):
+    request = 1
+    response = 2
+    stream_request = 3
+    event = 4
+    receive = 5
+    cancel = 6  # The request is aborted by the side sending this frame
+    credit = 7  # The receiver of a stream consumed frames, more can be sent
+
+
+# Frames of a stream sent and not consumed yet, at most. Must match the supervisor.
+STREAM_WINDOW = 64
+
+# The duration of requests is bounded by the supervisor, following `resource.seconds`
+EXECUTABLE_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5)
+
 
 class Encoding(str, Enum):
     plain = "plain"
@@ -280,6 +315,10 @@ async def run_python_code_http(
 
         logger.debug("Waiting for body")
         body: Dict = await send_queue.get()
+        # Join the body of chunked responses
+        while body.get("more_body"):
+            next_body: Dict = await send_queue.get()
+            body = {**next_body, "body": body["body"] + next_body.get("body", b"")}
 
         logger.debug("Waiting for buffer")
         output = buf.getvalue()
@@ -288,17 +327,39 @@ async def run_python_code_http(
         logger.debug(f"Body {body}")
         logger.debug(f"Output {output}")
 
+    output_data = get_output_data()
+
+    logger.debug("Returning result")
+    return headers, body, output, output_data
+
+
+def get_output_data() -> bytes:
     logger.debug("Getting output data")
-    output_data: bytes
     if os.path.isdir("/data") and os.listdir("/data"):
         make_archive("/opt/output", "zip", "/data")
         with open("/opt/output.zip", "rb") as output_zipfile:
-            output_data = output_zipfile.read()
+            return output_zipfile.read()
     else:
-        output_data = b""
+        return b""
 
-    logger.debug("Returning result")
-    return headers, body, output, output_data
+
+async def run_python_code_http_streaming(
+    application: ASGIApplication,
+    scope: dict,
+    receive: Callable[[], Awaitable[Dict]],
+    send: Callable[[Dict], Awaitable],
+) -> Tuple[str, Optional[bytes]]:
+    """Run the application, forwarding each ASGI event to `send` as it is produced.
+
+    The body of the request is obtained in chunks from `receive`.
+    """
+    logger.debug("Running code, streaming the response")
+    with StringIO() as buf, redirect_stdout(buf):
+        await application(scope, receive, send)
+        output = buf.getvalue()
+
+    output_data = get_output_data()
+    return output, output_data
 
 
 async def make_request(session, scope):
@@ -326,8 +387,7 @@ async def run_executable_http(scope: dict) -> Tuple[Dict, Dict, str, Optional[by
     headers = None
     body = None
 
-    timeout = aiohttp.ClientTimeout(total=5)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    async with aiohttp.ClientSession(timeout=EXECUTABLE_TIMEOUT) as session:
         while not body:
             try:
                 tries += 1
@@ -343,6 +403,113 @@ async def run_executable_http(scope: dict) -> Tuple[Dict, Dict, str, Optional[by
     return headers, body, output, output_data
 
 
+async def iter_request_body(receive: Callable[[], Awaitable[Dict]]):
+    """Yield the chunks of the body of a request from ASGI `receive` messages."""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            raise ConnectionAbortedError("Request body interrupted")
+        yield message.get("body", b"")
+        if not message.get("more_body"):
+            return
+
+
+async def run_executable_http_streaming(
+    scope: dict,
+    receive: Callable[[], Awaitable[Dict]],
+    send: Callable[[Dict], Awaitable],
+) -> Tuple[str, Optional[bytes]]:
+    """Proxy the request to the executable, forwarding the response as ASGI events."""
+    logger.debug("Calling localhost, streaming the response")
+
+    tries = 0
+    async with aiohttp.ClientSession(timeout=EXECUTABLE_TIMEOUT) as session:
+        while True:
+            try:
+                tries += 1
+                async with session.request(
+                    scope["method"],
+                    url="http://localhost:8080{}".format(scope["path"]),
+                    params=scope["query_string"],
+                    headers=[
+                        (a.decode("utf-8"), b.decode("utf-8"))
+                        for a, b in scope["headers"]
+                    ],
+                    data=iter_request_body(receive),
+                ) as resp:
+                    await send(
+                        {
+                            "type": "http.response.start",
+                            "status": resp.status,
+                            "headers": [
+                                (a.encode("utf-8"), b.encode("utf-8"))
+                                for a, b in resp.headers.items()
+                            ],
+                        }
+                    )
+                    async for chunk in resp.content.iter_chunked(65536):
+                        await send(
+                            {
+                                "type": "http.response.body",
+                                "body": chunk,
+                                "more_body": True,
+                            }
+                        )
+                    await send(
+                        {"type": "http.response.body", "body": b"", "more_body": False}
+                    )
+                    break
+            except aiohttp.ClientConnectorError:
+                if tries > 20:
+                    raise
+                await asyncio.sleep(0.05)
+
+    output = ""  # Process stdout is not captured per request
+    return output, None
+
+
+async def process_instruction_streaming(
+    instruction: bytes,
+    interface: Interface,
+    application: Union[ASGIApplication, subprocess.Popen],
+    receive: Callable[[], Awaitable[Dict]],
+    send: Callable[[Dict], Awaitable],
+) -> bytes:
+    """Run an HTTP request, sending the events of the response with `send`.
+
+    The body of the request is read with `receive`.
+
+    Returns the final result, containing the output or the error.
+    """
+    output: Optional[str] = None
+    try:
+        payload = RunCodePayload(**msgpack.loads(instruction, raw=False))
+        if interface == Interface.asgi:
+            output, output_data = await run_python_code_http_streaming(
+                application=application,
+                scope=payload.scope,
+                receive=receive,
+                send=send,
+            )
+        elif interface == Interface.executable:
+            output, output_data = await run_executable_http_streaming(
+                scope=payload.scope, receive=receive, send=send
+            )
+        else:
+            raise ValueError("Unknown interface. This should never happen")
+        return msgpack.dumps(
+            {"output": output, "output_data": output_data}, use_bin_type=True
+        )
+    except Exception as error:
+        return msgpack.dumps(
+            {
+                "error": str(error),
+                "traceback": str(traceback.format_exc()),
+                "output": output,
+            }
+        )
+
+
 async def process_instruction(
     instruction: bytes,
     interface: Interface,
@@ -418,6 +585,160 @@ async def process_instruction(
             )
 
 
+async def serve_multiplexed(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    interface: Interface,
+    application: Union[ASGIApplication, subprocess.Popen],
+):
+    """Serve concurrent requests from the supervisor on a single connection.
+
+    Each request and response is sent as a frame prefixed by a header containing
+    the request id and the length of the payload. The events of streamed responses
+    are sent as frames as they are produced, followed by a final response frame.
+    The body of streamed requests is received as frames of ASGI `receive` messages.
+
+    Frames are dispatched without waiting for the requests. Both the events of a
+    response and the messages of a request body are flow controlled with credits:
+    at most `STREAM_WINDOW` frames of a stream are sent and not consumed yet, the
+    receiver grants credit back as it consumes them. Streamed requests cancelled by
+    the supervisor are interrupted.
+    """
+    write_lock = asyncio.Lock()
+    receive_queues: Dict[int, asyncio.Queue] = {}
+    send_windows: Dict[int, asyncio.Semaphore] = {}
+    stream_tasks: Dict[int, asyncio.Task] = {}
+
+    async def write_frame(request_id: int, frame_type: FrameType, payload: bytes):
+        async with write_lock:
+            writer.write(FRAME_HEADER.pack(request_id, frame_type, len(payload)))
+            writer.write(payload)
+            await writer.drain()
+
+    async def handle_request(request_id: int, payload: bytes):
+        result = b""
+        try:
+            async for chunk in process_instruction(
+                instruction=payload, interface=interface, application=application
+            ):
+                result += chunk
+        except Exception as error:
+            logger.exception("Request could not be processed")
+            result = msgpack.dumps(
+                {
+                    "error": str(error),
+                    "traceback": str(traceback.format_exc()),
+                    "output": None,
+                }
+            )
+        await write_frame(request_id, FrameType.response, result)
+        logger.debug(f"Request {request_id} processed")
+
+    async def handle_stream_request(
+        request_id: int, payload: bytes, queue: asyncio.Queue
+    ):
+        window = send_windows[request_id]
+        consumed = 0
+
+        async def receive() -> Dict:
+            nonlocal consumed
+            message = await queue.get()
+            consumed += 1
+            if consumed >= STREAM_WINDOW // 2:
+                await write_frame(request_id, FrameType.credit, CREDIT.pack(consumed))
+                consumed = 0
+            return message
+
+        async def send_event(event: Dict):
+            # Paused while the supervisor is not consuming the response
+            await window.acquire()
+            await write_frame(
+                request_id, FrameType.event, msgpack.dumps(event, use_bin_type=True)
+            )
+
+        try:
+            result = await process_instruction_streaming(
+                instruction=payload,
+                interface=interface,
+                application=application,
+                receive=receive,
+                send=send_event,
+            )
+        finally:
+            receive_queues.pop(request_id, None)
+            send_windows.pop(request_id, None)
+            stream_tasks.pop(request_id, None)
+        await write_frame(request_id, FrameType.response, result)
+        logger.debug(f"Streamed request {request_id} processed")
+
+    writer.write(MUX_ACK)
+    await writer.drain()
+    logger.debug("Multiplexed channel opened")
+
+    tasks = set()
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                request_id, frame_type, length = FRAME_HEADER.unpack(header)
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                logger.debug("Multiplexed channel closed by the supervisor")
+                break
+
+            if frame_type == FrameType.request:
+                task = asyncio.create_task(handle_request(request_id, payload))
+            elif frame_type == FrameType.stream_request:
+                # Registered before the task starts, the body follows immediately.
+                # Bounded by the flow control, checked below.
+                queue = asyncio.Queue()
+                receive_queues[request_id] = queue
+                send_windows[request_id] = asyncio.Semaphore(STREAM_WINDOW)
+                task = asyncio.create_task(
+                    handle_stream_request(request_id, payload, queue)
+                )
+                stream_tasks[request_id] = task
+            elif frame_type == FrameType.receive:
+                queue = receive_queues.get(request_id)
+                if not queue:
+                    continue
+                if queue.qsize() < STREAM_WINDOW:
+                    queue.put_nowait(msgpack.loads(payload, raw=False))
+                    continue
+                logger.error(f"Request {request_id} exceeded its window")
+                del receive_queues[request_id]
+                send_windows.pop(request_id, None)
+                stream_task = stream_tasks.pop(request_id, None)
+                if stream_task:
+                    stream_task.cancel()
+                task = asyncio.create_task(
+                    write_frame(request_id, FrameType.cancel, b"")
+                )
+            elif frame_type == FrameType.credit:
+                window = send_windows.get(request_id)
+                if window:
+                    for _ in range(CREDIT.unpack(payload)[0]):
+                        window.release()
+                continue
+            elif frame_type == FrameType.cancel:
+                # The request failed or its client went away
+                logger.warning(f"Request {request_id} cancelled by the supervisor")
+                receive_queues.pop(request_id, None)
+                send_windows.pop(request_id, None)
+                stream_task = stream_tasks.pop(request_id, None)
+                if stream_task:
+                    stream_task.cancel()
+                continue
+            else:
+                logger.warning(f"Unexpected frame type {frame_type}")
+                continue
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 def receive_data_length(client) -> int:
     """Receive the length of the data to follow."""
     buffer = b""
@@ -495,6 +816,15 @@ async def main():
     async def handle_instruction(reader, writer):
         data = await reader.read(1000_1000)  # Max 1 Mo
 
+        if data == MUX_HANDSHAKE:
+            try:
+                await serve_multiplexed(
+                    reader, writer, interface=config.interface, application=app
+                )
+            finally:
+                writer.close()
+            return
+
         logger.debug("Init received msg")
         if logger.level <= logging.DEBUG:
             data_to_print = f"{data[:500]}..." if len(data) > 500 else data
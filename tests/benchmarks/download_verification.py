@@ -0,0 +1,101 @@
+"""Bytes read back from the disk to verify a download, and time taken.
+
+    python -m tests.benchmarks.download_verification [size in MiB]
+
+The file is served from memory by a local server in the same process, so the bytes
+read through the file system (`rchar` of `/proc/self/io`) are the ones read to hash
+the file. Hashing while the file is written is compared with hashing it once
+downloaded, and with a cache hit verified through the index of the cache.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from tests.file_server import FileServer  # noqa: E402
+from vm_supervisor import storage  # noqa: E402
+from vm_supervisor.cache import ContentCache  # noqa: E402
+from vm_supervisor.conf import settings  # noqa: E402
+from vm_supervisor.sessions import close_sessions  # noqa: E402
+
+
+def bytes_read() -> int:
+    with open("/proc/self/io") as io:
+        for line in io:
+            if line.startswith("rchar:"):
+                return int(line.split()[1])
+    raise ValueError("rchar not found")
+
+
+async def measure(name: str, function, size: int):
+    before, t0 = bytes_read(), time.perf_counter()
+    await function()
+    duration, read = time.perf_counter() - t0, bytes_read() - before
+    print(
+        f"BENCHMARK: {name} size={size / 2**20:.0f}MiB "
+        f"read_back={read / 2**20:.2f}MiB time={duration * 1000:.0f}ms"
+    )
+
+
+async def benchmark(size: int):
+    content = os.urandom(size)
+    expected_hash = hashlib.sha256(content).hexdigest()
+
+    async def get_stored_file_hash(ref: str):
+        return expected_hash
+
+    storage.get_stored_file_hash = get_stored_file_hash
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ContentCache("data", Path(directory), max_size=10 * size)
+        manager = SimpleNamespace(get_cache=lambda path: cache)
+        storage.get_cache_manager = lambda: manager
+
+        async def post_hoc():
+            path = cache.path("post-hoc")
+            await storage.download_file(server.url, path)
+            hasher = hashlib.sha256()
+            storage.update_hash_from_file(hasher, path, size)
+            assert hasher.hexdigest() == expected_hash
+
+        async def fused():
+            await storage.download_file(
+                server.url, cache.path("fused"), store_ref="ref"
+            )
+
+        async def parallel_ranges():
+            settings.DOWNLOAD_PARALLEL_RANGES = 4
+            settings.DOWNLOAD_PARALLEL_MIN_SIZE = 0
+            try:
+                await storage.download_file(
+                    server.url, cache.path("ranges"), store_ref="ref"
+                )
+            finally:
+                settings.DOWNLOAD_PARALLEL_RANGES = 1
+
+        async def cache_hit():
+            await storage.download_file(
+                server.url, cache.path("fused"), store_ref="ref"
+            )
+
+        settings.DOWNLOAD_PARALLEL_RANGES = 1
+        async with FileServer(content) as server:
+            try:
+                await measure("post_hoc_hash", post_hoc, size)
+                await measure("hash_while_writing", fused, size)
+                await measure("hash_parallel_ranges", parallel_ranges, size)
+                await measure("verified_cache_hit", cache_hit, size)
+            finally:
+                await close_sessions()
+        assert server.hits == 1 + 1 + 4
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark(int(sys.argv[1] if len(sys.argv) > 1 else 256) * 2**20))
@@ -0,0 +1,77 @@
+"""Cost of the firewall setup and teardown of a VM, by number of VMs on the host.
+
+    python -m tests.benchmarks.nftables_scaling [max VMs]
+
+libnftables is replaced by the in-memory ruleset of `tests/fake_nftables.py`, so
+this measures the work of the supervisor and the size of what it asks nftables to
+process. The teardown by the handles of the jump rules is compared with the
+fallback used when they are unknown, which lists the ruleset.
+"""
+
+import os
+import sys
+import time
+from ipaddress import IPv4Network
+
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from tests.fake_nftables import FakeNftables  # noqa: E402
+from vm_supervisor.conf import NftablesLayout, settings  # noqa: E402
+from vm_supervisor.network import firewall  # noqa: E402
+from vm_supervisor.network.interfaces import TapInterface  # noqa: E402
+
+SAMPLE = 50  # VMs set up and torn down at each size
+
+
+def interface(vm_id: int) -> TapInterface:
+    network = IPv4Network(f"172.{16 + vm_id // 256}.{vm_id % 256}.0/24")
+    return TapInterface(f"vmtap{vm_id}", network)
+
+
+def measure(vm_ids, function) -> float:
+    """Average microseconds of `function` for each VM."""
+    t0 = time.perf_counter()
+    for vm_id in vm_ids:
+        function(vm_id, interface(vm_id))
+    return (time.perf_counter() - t0) / len(vm_ids) * 1e6
+
+
+def benchmark(max_vms: int):
+    settings.NETWORK_INTERFACE = "eth0"
+    for layout in NftablesLayout:
+        settings.NFTABLES_LAYOUT = layout
+        nft = FakeNftables()
+        nft.add_base_chains()
+        firewall.get_customized_nftables = lambda: nft
+        firewall.base_chain_tables.clear()
+        firewall.vm_jump_rules.clear()
+        firewall.initialize_nftables()
+
+        running = 0
+        for size in (10, 100, 1000, 10000):
+            if size > max_vms:
+                break
+            for vm_id in range(running, size):
+                firewall.setup_nftables_for_vm(vm_id, interface(vm_id))
+            running = size
+
+            sample = range(size, size + SAMPLE)
+            listings = nft.listings
+            setup = measure(sample, firewall.setup_nftables_for_vm)
+            teardown = measure(sample, firewall.teardown_nftables_for_vm)
+            results = [
+                f"setup={setup:.0f}us",
+                f"teardown={teardown:.0f}us",
+                f"listings={nft.listings - listings}",
+            ]
+            if layout == NftablesLayout.chains:
+                for vm_id in sample:
+                    firewall.setup_nftables_for_vm(vm_id, interface(vm_id))
+                    del firewall.vm_jump_rules[vm_id]
+                fallback = measure(sample, firewall.teardown_nftables_for_vm)
+                results.append(f"teardown_listing_ruleset={fallback:.0f}us")
+            print(f"BENCHMARK: layout={layout.value} vms={size} {' '.join(results)}")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,190 @@
+"""Simulation of the idle executions of a host running 10k programs.
+
+    python -m tests.benchmarks.reaper_simulation [programs] [requests]
+
+Requests for programs of Zipf-distributed popularity arrive during two hours of
+simulated time, on a fake clock. Each one reuses the execution of its program if it
+is still running, else starts one, which is then left idle until its next request.
+
+The reaper is compared with the previous task per execution, which stopped it after
+`REUSE_TIMEOUT` seconds and was replaced on each request: the cost of scheduling is
+measured on real tasks, and the number of idle executions is simulated.
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from aleph_message.models.program import MachineResources  # noqa: E402
+
+from vm_supervisor.conf import settings  # noqa: E402
+from vm_supervisor.reaper import WHEEL_TICK, ExecutionReaper  # noqa: E402
+
+DURATION = 2 * 3600.0  # Simulated seconds
+
+
+class FakeExecution:
+    def __init__(self, vm_hash: str):
+        self.vm_hash = vm_hash
+        self.program = SimpleNamespace(resources=MachineResources(memory=128))
+        self.vm = None
+        self.is_running = False
+        self.persistent = False
+        self.concurrent_runs = 0
+
+    async def stop(self):
+        self.is_running = False
+
+
+def requests(programs: int, count: int):
+    """Time and program of each request."""
+    rng = random.Random(0)
+    weights = [1 / rank for rank in range(1, programs + 1)]
+    times = sorted(rng.uniform(0, DURATION) for _ in range(count))
+    return zip(times, rng.choices(range(programs), weights=weights, k=count))
+
+
+async def simulate(programs: int, count: int, max_idle):
+    """Serve the requests with the reaper, return its statistics."""
+    settings.MAX_IDLE_EXECUTIONS = max_idle
+    reaper = ExecutionReaper()
+    clock = SimpleNamespace(time=0.0)
+    reaper.now = lambda: clock.time
+    reaper.current_tick = 0
+    executions = [FakeExecution(f"vm-{index}") for index in range(programs)]
+    starts = peak_idle = 0
+    cpu = 0.0
+    next_tick = WHEEL_TICK
+
+    for request_time, program in requests(programs, count):
+        while next_tick <= request_time:
+            clock.time = next_tick
+            next_tick += WHEEL_TICK
+            t0 = time.perf_counter()
+            reaper.expire(clock.time)
+            reaper.evict()
+            cpu += time.perf_counter() - t0
+            # Run the stops started
+            await asyncio.sleep(0)
+        clock.time = request_time
+        execution = executions[program]
+        t0 = time.perf_counter()
+        reaper.cancel(execution)
+        if not execution.is_running:
+            starts += 1
+            execution.is_running = True
+        reaper.schedule(execution, timeout=settings.REUSE_TIMEOUT)
+        cpu += time.perf_counter() - t0
+        peak_idle = max(peak_idle, len(reaper.idle))
+
+    return {
+        "starts": starts,
+        "peak_idle": peak_idle,
+        "expired": reaper.expired,
+        "evicted": reaper.evicted,
+        "cpu_per_request_us": cpu / count * 1e6,
+    }
+
+
+def simulate_timeout_tasks(programs: int, count: int):
+    """Starts and idle executions with a timeout per execution and no eviction."""
+    last_use = {}
+    starts = peak_idle = 0
+    for request_time, program in requests(programs, count):
+        previous = last_use.get(program)
+        if previous is None or previous + settings.REUSE_TIMEOUT <= request_time:
+            starts += 1
+        last_use[program] = request_time
+        if len(last_use) > peak_idle:
+            # Forget the executions stopped by their timeout
+            last_use = {
+                key: used
+                for key, used in last_use.items()
+                if used + settings.REUSE_TIMEOUT > request_time
+            }
+            peak_idle = max(peak_idle, len(last_use))
+    return {"starts": starts, "peak_idle": peak_idle}
+
+
+async def scheduling_cost(programs: int):
+    """Microseconds and bytes to keep `programs` idle executions, per execution."""
+    executions = [FakeExecution(f"vm-{index}") for index in range(programs)]
+    for execution in executions:
+        execution.is_running = True
+
+    async def stop_after_timeout(execution):
+        await asyncio.sleep(settings.REUSE_TIMEOUT)
+        await execution.stop()
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(stop_after_timeout(e)) for e in executions]
+    await asyncio.sleep(0)
+    # Replaced on each request
+    for task in tasks:
+        task.cancel()
+    tasks = [asyncio.create_task(stop_after_timeout(e)) for e in executions]
+    await asyncio.sleep(0)
+    task_time = time.perf_counter() - t0
+    task_memory = tracemalloc.get_traced_memory()[0]
+    for task in tasks:
+        task.cancel()
+    await asyncio.sleep(0)
+    del tasks
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    reaper = ExecutionReaper()
+    reaper.current_tick = 0
+    reaper.now = lambda: 0.0
+    t0 = time.perf_counter()
+    for _ in range(2):
+        for execution in executions:
+            reaper.cancel(execution)
+            reaper.schedule(execution, timeout=settings.REUSE_TIMEOUT)
+    reaper_time = time.perf_counter() - t0
+    reaper_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for name, duration, memory in (
+        ("tasks", task_time, task_memory),
+        ("reaper", reaper_time, reaper_memory),
+    ):
+        print(
+            f"BENCHMARK: idle_executions={programs} scheduling={name} "
+            f"schedule={duration / (2 * programs) * 1e6:.1f}us "
+            f"memory={memory / programs:.0f}B/execution"
+        )
+
+
+async def benchmark(programs: int, count: int):
+    settings.BALLOON_IDLE_DELAY = None
+    settings.MIN_AVAILABLE_MEMORY = 0
+    await scheduling_cost(programs)
+
+    results = {"timeout_tasks": simulate_timeout_tasks(programs, count)}
+    for max_idle in (None, 1000):
+        results[f"reaper_max_idle={max_idle}"] = await simulate(
+            programs, count, max_idle
+        )
+    for name, stats in results.items():
+        values = " ".join(
+            f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in stats.items()
+        )
+        print(f"BENCHMARK: programs={programs} requests={count} {name} {values}")
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        benchmark(
+            programs=int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+            count=int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+        )
+    )
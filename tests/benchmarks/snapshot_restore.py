@@ -0,0 +1,103 @@
+"""Time to get a VM ready when booting it, and when restoring it from a snapshot.
+
+    python -m tests.benchmarks.snapshot_restore [runs] [boot seconds]
+
+Firecracker is replaced by `stub_firecracker.py`, so this measures the work of the
+supervisor on each path, plus the boot time given to the stub. Booting waits for the
+init to connect to the vsock, restoring only waits for the snapshot to be loaded.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from statistics import mean, median
+
+from firecracker.config import (
+    BootSource,
+    Drive,
+    FirecrackerConfig,
+    MachineConfig,
+    Vsock,
+)
+from firecracker.microvm import MicroVM
+
+STUB_PATH = Path(__file__).parent / "stub_firecracker.py"
+
+
+class StubMicroVM(MicroVM):
+    """A MicroVM with its sockets in a directory of the benchmark."""
+
+    socket_path = None
+    vsock_path = None
+
+    def __init__(self, vm_id: int, directory: Path):
+        super().__init__(vm_id, firecracker_bin_path=str(STUB_PATH), use_jailer=False)
+        self.socket_path = str(directory / f"firecracker-{vm_id}.socket")
+        self.vsock_path = str(directory / f"v-{vm_id}.sock")
+
+    def config(self, memory: int) -> FirecrackerConfig:
+        return FirecrackerConfig(
+            boot_source=BootSource(),
+            drives=[Drive()],
+            machine_config=MachineConfig(mem_size_mib=memory),
+            vsock=Vsock(uds_path=self.vsock_path),
+        )
+
+    async def close(self):
+        await self.stop()
+        if self._unix_socket:
+            self._unix_socket.close()
+            await self._unix_socket.wait_closed()
+        if self.config_file_path:
+            self.config_file_path.unlink(missing_ok=True)
+
+
+async def boot(vm: StubMicroVM, memory: int) -> float:
+    t0 = time.perf_counter()
+    await vm.start(vm.config(memory))
+    await vm.wait_for_init()
+    return time.perf_counter() - t0
+
+
+async def restore(vm: StubMicroVM, snapshot: Path) -> float:
+    t0 = time.perf_counter()
+    await vm.start_from_snapshot(snapshot / "snapshot", snapshot / "memory")
+    return time.perf_counter() - t0
+
+
+async def benchmark(runs: int, memory: int = 512):
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        snapshot = directory / "snapshot"
+        snapshot.mkdir()
+        vm = StubMicroVM(0, directory)
+        await boot(vm, memory)
+        await vm.create_snapshot(snapshot / "snapshot", snapshot / "memory")
+        await vm.close()
+
+        timings = {"boot": [], "restore": []}
+        for index in range(1, runs + 1):
+            vm = StubMicroVM(index, directory)
+            timings["boot"].append(await boot(vm, memory))
+            await vm.close()
+            vm = StubMicroVM(index, directory)
+            timings["restore"].append(await restore(vm, snapshot))
+            await vm.close()
+
+    boot_seconds = float(os.environ.get("STUB_BOOT_SECONDS", 0))
+    for path, durations in timings.items():
+        print(
+            f"BENCHMARK: {path} n={runs} memory={memory}MiB "
+            f"stub_boot={boot_seconds:.2f}s avg={mean(durations) * 1000:.1f}ms "
+            f"median={median(durations) * 1000:.1f}ms "
+            f"max={max(durations) * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        os.environ["STUB_BOOT_SECONDS"] = sys.argv[2]
+    asyncio.run(benchmark(runs=int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""A Firecracker without VMs, serving the parts of its API used by the supervisor.
+
+A VM configured with `--config-file` boots in `STUB_BOOT_SECONDS`, after which its
+init connects to the vsock, and exits when it is halted through the vsock. A VM
+restored from a snapshot maps its memory file, as Firecracker does, and its init is
+already running.
+"""
+
+import argparse
+import asyncio
+import json
+import mmap
+import os
+
+from aiohttp import web
+
+MIB = 1024 * 1024
+
+
+class StubFirecracker:
+    def __init__(self, config_file=None):
+        self.config = {}
+        self.memory = None
+        if config_file:
+            with open(config_file) as fd:
+                self.config = json.load(fd)
+
+    async def boot(self):
+        uds_path = self.config["vsock"]["uds_path"]
+        await asyncio.start_unix_server(self.serve_vsock, path=uds_path)
+        await asyncio.sleep(float(os.environ.get("STUB_BOOT_SECONDS", 0)))
+        _, writer = await asyncio.open_unix_connection(f"{uds_path}_52")
+        writer.close()
+
+    async def serve_vsock(self, reader, writer):
+        """Answer the halt command of the supervisor, as the init does."""
+        await reader.readline()  # CONNECT 52
+        writer.write(b"OK 1073741824\n")
+        if await reader.read(4) == b"halt":
+            writer.write(b"STOP\nSTOPZ\n")
+            await writer.drain()
+            writer.close()
+            # The VM halted
+            os._exit(0)
+
+    async def patch_vm(self, request: web.Request):
+        return web.Response(status=204)
+
+    async def create_snapshot(self, request: web.Request):
+        body = await request.json()
+        with open(body["snapshot_path"], "w") as fd:
+            json.dump(self.config, fd)
+        with open(body["mem_file_path"], "wb") as fd:
+            fd.truncate(self.config["machine-config"]["mem_size_mib"] * MIB)
+        return web.Response(status=204)
+
+    async def load_snapshot(self, request: web.Request):
+        body = await request.json()
+        with open(body["snapshot_path"]) as fd:
+            self.config = json.load(fd)
+        with open(body["mem_backend"]["backend_path"], "rb") as fd:
+            self.memory = mmap.mmap(fd.fileno(), 0, flags=mmap.MAP_PRIVATE)
+        return web.Response(status=204)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api-sock", required=True)
+    parser.add_argument("--config-file")
+    args = parser.parse_args()
+
+    firecracker = StubFirecracker(args.config_file)
+    app = web.Application()
+    app.router.add_patch("/vm", firecracker.patch_vm)
+    app.router.add_put("/snapshot/create", firecracker.create_snapshot)
+    app.router.add_put("/snapshot/load", firecracker.load_snapshot)
+    if args.config_file:
+
+        async def boot(app):
+            asyncio.create_task(firecracker.boot())
+
+        app.on_startup.append(boot)
+    web.run_app(app, path=args.api_sock, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Peak memory of the supervisor while a program receives a large upload.
+
+    python -m tests.benchmarks.upload_memory [size in MiB]
+
+The body is either buffered by the supervisor and sent with the request, or
+streamed to the VM as it is read. Each mode runs in its own process, as the peak
+resident set size only grows, and the init of the VM runs in another one.
+"""
+
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from tests.fake_vm import FakeVm, make_execution  # noqa: E402
+from vm_supervisor import run  # noqa: E402
+from vm_supervisor.conf import settings  # noqa: E402
+
+CHUNK_SIZE = 65536
+
+
+async def count_body(scope, receive, send):
+    """Respond with the size of the body, without keeping it."""
+    size = 0
+    while True:
+        message = await receive()
+        size += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"%d" % size})
+
+
+async def serve_vm(vsock_path: str):
+    async with FakeVm(vsock_path, count_body):
+        await asyncio.Event().wait()
+
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def upload(vsock_path: str, size: int) -> int:
+    """Upload `size` bytes to the program, return the growth of the peak RSS."""
+    settings.WATCH_FOR_UPDATES = False
+    settings.MAX_REQUEST_BODY_SIZE = size
+    program = SimpleNamespace(code=SimpleNamespace(ref="code"))
+    execution = make_execution(vsock_path, program, seconds=600)
+
+    async def get_or_create_vm_execution(vm_hash):
+        return execution
+
+    run.get_or_create_vm_execution = get_or_create_vm_execution
+
+    async def run_code(request: web.Request):
+        return await run.run_code_on_request("vm", request.path, request)
+
+    # Above the limit of the supervisor, for the sake of comparison
+    app = web.Application(client_max_size=size + 1)
+    app.router.add_post("/", run_code)
+
+    async def body():
+        chunk = b"x" * CHUNK_SIZE
+        for _ in range(size // CHUNK_SIZE):
+            yield chunk
+
+    async with TestClient(TestServer(app)) as client:
+        # Warm up the connections, the channel and the program
+        await (await client.post("/", data=b"x")).read()
+        before = peak_rss()
+        response = await client.post("/", data=body())
+        assert await response.read() == b"%d" % size, response.status
+    if execution.vm.channel:
+        await execution.vm.channel.close()
+    return peak_rss() - before
+
+
+def measure(mode: str, size: int) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        vsock_path = str(Path(directory) / "v.sock")
+        vm = subprocess.Popen(
+            [sys.executable, "-m", __spec__.name, "vm", vsock_path],
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while not os.path.exists(vsock_path):
+                time.sleep(0.01)
+            output = subprocess.check_output(
+                [sys.executable, "-m", __spec__.name, mode, vsock_path, str(size)],
+                stderr=subprocess.DEVNULL,
+            )
+        finally:
+            vm.terminate()
+            vm.wait()
+    return int(output)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "vm":
+        asyncio.run(serve_vm(sys.argv[2]))
+    elif command in ("buffered", "streamed"):
+        settings.STREAM_RESPONSES = command == "streamed"
+        print(asyncio.run(upload(sys.argv[2], int(sys.argv[3]))))
+    else:
+        size = int(command or 256) * 1024 * 1024
+        for mode in ("buffered", "streamed"):
+            growth = measure(mode, size)
+            print(
+                f"BENCHMARK: mode={mode} upload={size / 2**20:.0f}MiB "
+                f"peak_rss_growth={growth / 2**20:.1f}MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
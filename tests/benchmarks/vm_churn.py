@@ -0,0 +1,67 @@
+"""Rate at which VMs can be booted and torn down, one at a time or concurrently.
+
+    python -m tests.benchmarks.vm_churn [VMs]
+
+Firecracker is replaced by `stub_firecracker.py`, which exits when its VM is halted.
+The teardown of the supervisor is compared with the previous one, which waited a
+fixed second after the shutdown of the VM.
+"""
+
+import asyncio
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+from statistics import mean
+
+from tests.benchmarks.snapshot_restore import StubMicroVM
+
+
+class SleepingStubMicroVM(StubMicroVM):
+    """The previous teardown, for comparison."""
+
+    async def teardown(self):
+        await asyncio.wait_for(self.shutdown(), timeout=5)
+        await asyncio.sleep(1)
+        await self.close()
+
+
+async def churn(vm_class, directory: Path, count: int, concurrency: int):
+    """Boot and tear down `count` VMs, return the VMs per second and teardowns."""
+    semaphore = asyncio.Semaphore(concurrency)
+    teardowns = []
+
+    async def cycle(vm_id: int):
+        async with semaphore:
+            vm = vm_class(vm_id, directory)
+            await vm.start(vm.config(memory=128))
+            await vm.wait_for_init()
+            t0 = time.perf_counter()
+            await vm.teardown()
+            teardowns.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(cycle(vm_id) for vm_id in range(count)))
+    return count / (time.perf_counter() - t0), teardowns
+
+
+async def benchmark(count: int):
+    # The VMs torn down are also torn down again when collected
+    logging.getLogger("firecracker.microvm").setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, vm_class in (("wait", StubMicroVM), ("sleep", SleepingStubMicroVM)):
+            for concurrency in (1, 10):
+                rate, teardowns = await churn(
+                    vm_class, Path(directory), count, concurrency
+                )
+                print(
+                    f"BENCHMARK: teardown={name} vms={count} "
+                    f"concurrency={concurrency} rate={rate:.1f}vm/s "
+                    f"teardown_avg={mean(teardowns) * 1000:.0f}ms "
+                    f"teardown_max={max(teardowns) * 1000:.0f}ms"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
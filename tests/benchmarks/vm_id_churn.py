@@ -0,0 +1,88 @@
+"""Time to allocate vm_ids while VMs are started and stopped, by number of VMs running.
+
+    python -m tests.benchmarks.vm_id_churn [allocations]
+
+Each allocation replaces a random running VM. The `VmIdAllocator` is compared with
+the previous allocation, which scanned the ids from the first one for an id not used
+by a running execution, once the counter had reached the capacity.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from vm_supervisor.network.vm_ids import VmIdAllocator  # noqa: E402
+
+FIRST_ID = 4
+CAPACITY = 4096  # /24 subnets of 172.16.0.0/12
+
+
+class ScanningAllocator:
+    """The previous allocation, given the ids of the running executions."""
+
+    def __init__(self, executions: Dict[int, bool]):
+        self.executions = executions
+
+    def allocate(self) -> int:
+        used = set(vm_id for vm_id, running in self.executions.items() if running)
+        for vm_id in range(FIRST_ID, 255**2):
+            if vm_id not in used:
+                return vm_id
+        raise ValueError("No available value for vm_id.")
+
+    def release(self, vm_id: int) -> None:
+        pass
+
+
+def churn(allocator, executions: Dict[int, bool], running: int, count: int) -> float:
+    """Start `running` VMs, then replace one `count` times. Return microseconds per
+    allocation."""
+    rng = random.Random(0)
+    vm_ids: List[int] = []
+    for _ in range(running):
+        vm_id = allocator.allocate()
+        executions[vm_id] = True
+        vm_ids.append(vm_id)
+
+    t0 = time.perf_counter()
+    for _ in range(count):
+        stopped = vm_ids.pop(rng.randrange(len(vm_ids)))
+        executions[stopped] = False
+        allocator.release(stopped)
+        vm_id = allocator.allocate()
+        assert not executions.get(vm_id)
+        executions[vm_id] = True
+        vm_ids.append(vm_id)
+    return (time.perf_counter() - t0) / count * 1e6
+
+
+def benchmark(count: int):
+    with tempfile.TemporaryDirectory() as directory:
+        for running in (100, 1000, 4000):
+            results = []
+            for name in ("free_list", "free_list_saved", "scan"):
+                executions: Dict[int, bool] = {}
+                if name == "scan":
+                    allocator = ScanningAllocator(executions)
+                else:
+                    state_path = Path(directory) / f"vm_ids-{running}.json"
+                    allocator = VmIdAllocator(
+                        FIRST_ID,
+                        CAPACITY,
+                        state_path=state_path if name == "free_list_saved" else None,
+                    )
+                duration = churn(allocator, executions, running, count)
+                results.append(f"{name}={duration:.1f}us")
+            print(
+                f"BENCHMARK: running={running} allocations={count} {' '.join(results)}"
+            )
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 60000)
@@ -0,0 +1,38 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+# The pool of VMs is created when `vm_supervisor.run` is imported and would set up
+# the host network and its firewall.
+os.environ.setdefault("ALEPH_VM_ALLOW_VM_NETWORKING", "false")
+
+from aleph_message.models import ProgramMessage  # noqa: E402
+
+from vm_supervisor import metrics  # noqa: E402
+from vm_supervisor.conf import settings  # noqa: E402
+
+EXAMPLE_MESSAGE = Path(__file__).parent.parent / "examples" / "message_from_aleph.json"
+
+
+@pytest.fixture
+def program_message() -> ProgramMessage:
+    """The example program, with its hash fixed as done for `FAKE_DATA_PROGRAM`."""
+    with open(EXAMPLE_MESSAGE) as fd:
+        msg = json.load(fd)
+    msg["item_content"] = json.dumps(msg["content"])
+    msg["item_hash"] = hashlib.sha256(msg["item_content"].encode("utf-8")).hexdigest()
+    return ProgramMessage(**msg)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """An empty database of execution records."""
+    monkeypatch.setattr(settings, "EXECUTION_DATABASE", tmp_path / "test.sqlite3")
+    monkeypatch.setattr(metrics, "Session", None, raising=False)
+    engine = metrics.setup_engine()
+    metrics.create_tables(engine)
+    yield engine
+    engine.dispose()
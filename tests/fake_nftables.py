@@ -0,0 +1,135 @@
+"""An in-memory ruleset, standing in for libnftables in the firewall module."""
+
+import json
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+Key = Tuple[str, str, str]  # Family, table and name of a chain or a set
+
+
+class NftablesError(Exception):
+    pass
+
+
+class FakeNftables:
+    """Executes the JSON commands used by the supervisor, with handles and echo.
+
+    The commands of a call are not applied as one transaction: the ones preceding
+    an error are kept.
+    """
+
+    def __init__(self):
+        self.tables: Set[Tuple[str, str]] = set()
+        self.chains: Dict[Key, Dict] = {}
+        self.rules: Dict[int, Dict] = {}
+        self.chain_rules: Dict[Key, Set[int]] = defaultdict(set)
+        self.jumps: Dict[Key, int] = defaultdict(int)  # Rules jumping to each chain
+        self.sets: Dict[Key, Set[str]] = {}
+        self.next_handle = 1
+        self.listings = 0
+
+    def add_base_chains(self) -> None:
+        """Add the base chains of a host where the firewall is already set up."""
+        for table, chain, hook, prio in (
+            ("nat", "POSTROUTING", "postrouting", 100),
+            ("filter", "FORWARD", "forward", 0),
+        ):
+            self.add_table({"family": "ip", "name": table})
+            self.add_chain(
+                {
+                    "family": "ip",
+                    "table": table,
+                    "name": chain,
+                    "type": table,
+                    "hook": hook,
+                    "prio": prio,
+                }
+            )
+
+    def json_validate(self, commands: Dict) -> bool:
+        return True
+
+    def json_cmd(self, commands: Dict) -> Tuple[int, Dict, str]:
+        output: List[Dict] = []
+        try:
+            for command in commands["nftables"]:
+                ((action, objects),) = command.items()
+                ((kind, value),) = objects.items()
+                result = getattr(self, f"{action}_{kind}")(value)
+                if result:
+                    output.append({action: {kind: result}})
+        except (NftablesError, KeyError) as error:
+            return 1, {"nftables": output}, repr(error)
+        return 0, {"nftables": output}, ""
+
+    def cmd(self, command: str) -> Tuple[int, str, str]:
+        assert command == "list ruleset"
+        self.listings += 1
+        entries: List[Dict] = [
+            {"table": {"family": family, "name": name}} for family, name in self.tables
+        ]
+        entries += [{"chain": chain} for chain in self.chains.values()]
+        entries += [{"rule": rule} for rule in self.rules.values()]
+        for (family, table, name), elements in self.sets.items():
+            set_ = {"family": family, "table": table, "name": name}
+            if elements:
+                set_["elem"] = sorted(elements)
+            entries.append({"set": set_})
+        return 0, json.dumps({"nftables": entries}), ""
+
+    def add_table(self, table: Dict) -> None:
+        self.tables.add((table["family"], table["name"]))
+
+    def add_chain(self, chain: Dict) -> None:
+        if (chain["family"], chain["table"]) not in self.tables:
+            raise NftablesError(f"No table for {chain}")
+        self.chains.setdefault((chain["family"], chain["table"], chain["name"]), chain)
+
+    def flush_chain(self, chain: Dict) -> None:
+        key = (chain["family"], chain["table"], chain["name"])
+        for handle in list(self.chain_rules[key]):
+            self.delete_rule({"handle": handle})
+
+    def delete_chain(self, chain: Dict) -> None:
+        """Delete a chain and its rules, as the kernel does, unless jumped to."""
+        key = (chain["family"], chain["table"], chain["name"])
+        if self.jumps[key]:
+            raise NftablesError(f"Chain {key} is busy")
+        self.flush_chain(chain)
+        del self.chains[key]
+
+    def add_rule(self, rule: Dict) -> Dict:
+        key = (rule["family"], rule["table"], rule["chain"])
+        if key not in self.chains:
+            raise NftablesError(f"No chain for {rule}")
+        rule = dict(rule, handle=self.next_handle)
+        self.next_handle += 1
+        self.rules[rule["handle"]] = rule
+        self.chain_rules[key].add(rule["handle"])
+        if "jump" in rule["expr"][0]:
+            target = rule["expr"][0]["jump"]["target"]
+            self.jumps[(rule["family"], rule["table"], target)] += 1
+        return rule
+
+    def delete_rule(self, rule: Dict) -> None:
+        rule = self.rules.pop(rule["handle"])
+        self.chain_rules[(rule["family"], rule["table"], rule["chain"])].remove(
+            rule["handle"]
+        )
+        if "jump" in rule["expr"][0]:
+            target = rule["expr"][0]["jump"]["target"]
+            self.jumps[(rule["family"], rule["table"], target)] -= 1
+
+    def add_set(self, set_: Dict) -> None:
+        self.sets.setdefault((set_["family"], set_["table"], set_["name"]), set())
+
+    def delete_set(self, set_: Dict) -> None:
+        del self.sets[(set_["family"], set_["table"], set_["name"])]
+
+    def add_element(self, element: Dict) -> None:
+        key = (element["family"], element["table"], element["name"])
+        self.sets[key].update(element["elem"])
+
+    def delete_element(self, element: Dict) -> None:
+        key = (element["family"], element["table"], element["name"])
+        self.sets[key].difference_update(element["elem"])
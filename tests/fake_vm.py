@@ -0,0 +1,147 @@
+"""The init of a VM, serving ASGI applications of the tests on a fake vsock."""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import socket
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+from aleph_message.models.program import MachineResources
+
+from firecracker.microvm import MicroVM
+from vm_supervisor.vm.firecracker_microvm import AlephFirecrackerVM
+
+INIT_PATH = (
+    Path(__file__).parent.parent / "runtimes" / "aleph-alpine-3.13-python" / "init1.py"
+)
+
+
+class NoSocket:
+    """The vsock sockets opened by the init when it is imported."""
+
+    def __init__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def load_init():
+    """Import the init of the runtime without its side effects on the host."""
+    if "init1" in sys.modules:
+        return sys.modules["init1"]
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    environ = dict(os.environ)
+    spec = importlib.util.spec_from_file_location("init1", INIT_PATH)
+    init = importlib.util.module_from_spec(spec)
+    try:
+        with mock.patch.object(socket, "socket", NoSocket), mock.patch.object(
+            socket, "AF_VSOCK", 40, create=True
+        ), mock.patch.object(socket, "VMADDR_CID_ANY", 0xFFFFFFFF, create=True):
+            spec.loader.exec_module(init)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        root.handlers[:], root.level = handlers, level
+    sys.modules["init1"] = init
+    return init
+
+
+class FakeVm:
+    """Answers the connections of the supervisor to the vsock of a VM.
+
+    Connections are handled as by the `main` function of the init. The multiplexed
+    channel is not offered unless `multiplexed` is set, as by older runtimes.
+    """
+
+    def __init__(
+        self,
+        vsock_path,
+        application,
+        multiplexed: bool = True,
+        interface: str = "asgi",
+    ):
+        self.init = load_init()
+        self.vsock_path = str(vsock_path)
+        self.application = application
+        self.multiplexed = multiplexed
+        self.interface = self.init.Interface(interface)
+        self.connections = 0
+        self.server = None
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        await reader.readline()  # CONNECT 52
+        writer.write(b"OK 1073741824\n")
+        data = await reader.read(1000_1000)
+        try:
+            if data == self.init.MUX_HANDSHAKE:
+                # Older inits fail to parse the handshake and close the connection
+                if self.multiplexed:
+                    await self.init.serve_multiplexed(
+                        reader, writer, self.interface, self.application
+                    )
+            else:
+                async for result in self.init.process_instruction(
+                    data, self.interface, self.application
+                ):
+                    writer.write(result)
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_unix_server(
+            self.handle_connection, path=self.vsock_path
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class UnixMicroVM(MicroVM):
+    """A MicroVM without Firecracker, its vsock is the unix socket of a `FakeVm`."""
+
+    vsock_path = None
+
+
+def make_execution(vsock_path, program, seconds: int = 1) -> SimpleNamespace:
+    """A running execution of `program`, in a VM answering on `vsock_path`.
+
+    The execution records its stops instead of stopping the VM.
+    """
+    vm = AlephFirecrackerVM(
+        vm_id=3,
+        vm_hash="vm",
+        resources=SimpleNamespace(),
+        hardware_resources=MachineResources(seconds=seconds),
+    )
+    vm.fvm = UnixMicroVM(vm_id=3, firecracker_bin_path="firecracker", use_jailer=False)
+    vm.fvm.vsock_path = str(vsock_path)
+    stops = []
+
+    async def becomes_ready():
+        pass
+
+    async def stop():
+        stops.append(vm.vm_id)
+
+    return SimpleNamespace(
+        vm_id=3,
+        vm_hash="vm",
+        vm=vm,
+        program=program,
+        is_running=False,
+        stops=stops,
+        becomes_ready=becomes_ready,
+        run_code=vm.run_code,
+        run_code_streaming=vm.run_code_streaming,
+        stop=stop,
+    )
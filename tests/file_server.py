@@ -0,0 +1,82 @@
+"""An HTTP server standing in for the connector, serving a single file."""
+
+import asyncio
+import hashlib
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from vm_supervisor.storage import ITEM_HASH_HEADER, ITEM_TYPE_HEADER
+
+
+class FileServer:
+    """Serves `content` at `/file`, with range requests, counting the requests.
+
+    The responses can fail with `status`, be delayed by `delay` seconds or be cut
+    after `cut_after` bytes, to test interrupted downloads.
+    """
+
+    def __init__(self, content: bytes, item_hash: Optional[str] = None):
+        self.content = content
+        self.item_hash = item_hash or hashlib.sha256(content).hexdigest()
+        self.ranges: List[Optional[str]] = []  # Range header of each request
+        self.peers: List[Tuple[str, int]] = []  # Client address of each request
+        self.status = 200
+        self.delay = 0.0
+        self.cut_after: Optional[int] = None
+        app = web.Application()
+        app.router.add_get("/file", self.get_file)
+        self.server = TestServer(app)
+
+    @property
+    def url(self) -> str:
+        return str(self.server.make_url("/file"))
+
+    @property
+    def hits(self) -> int:
+        return len(self.ranges)
+
+    async def get_file(self, request: web.Request):
+        self.ranges.append(request.headers.get("Range"))
+        self.peers.append(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.Response(status=self.status)
+
+        headers = {
+            "Accept-Ranges": "bytes",
+            ITEM_TYPE_HEADER: "storage",
+            ITEM_HASH_HEADER: self.item_hash,
+        }
+        total = len(self.content)
+        start, end = 0, total
+        status = 200
+        if request.http_range.start is not None:
+            start = request.http_range.start
+            end = min(request.http_range.stop or total, total)
+            if start >= total:
+                headers["Content-Range"] = f"bytes */{total}"
+                return web.Response(status=416, headers=headers)
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{total}"
+            status = 206
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        body = self.content[start:end]
+        if self.cut_after is not None:
+            cut_after, self.cut_after = self.cut_after, None
+            await response.write(body[:cut_after])
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
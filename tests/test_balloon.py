@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiohttp import web
+from aleph_message.models.program import MachineResources
+
+from firecracker.microvm import MicroVM
+from vm_supervisor.conf import settings
+from vm_supervisor.vm.firecracker_microvm import AlephFirecrackerVM
+
+
+class StubFirecrackerApi:
+    """Firecracker API on a unix socket, recording the balloon targets."""
+
+    def __init__(self, path, delay: float = 0, status: int = 204):
+        self.path = path
+        self.delay = delay
+        self.status = status
+        self.targets = []
+        app = web.Application()
+        app.router.add_patch("/balloon", self.patch_balloon)
+        app.router.add_get("/balloon/statistics", self.get_statistics)
+        self.runner = web.AppRunner(app)
+
+    async def patch_balloon(self, request: web.Request):
+        amount = (await request.json())["amount_mib"]
+        await asyncio.sleep(self.delay if amount else 0)
+        if self.status >= 300:
+            return web.Response(status=self.status, text="error")
+        self.targets.append(amount)
+        return web.Response(status=self.status)
+
+    async def get_statistics(self, request: web.Request):
+        return web.json_response({"target_mib": self.targets[-1]})
+
+    async def __aenter__(self):
+        await self.runner.setup()
+        await web.UnixSite(self.runner, str(self.path)).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def make_vm(tmp_path, monkeypatch) -> AlephFirecrackerVM:
+    socket_path = str(tmp_path / "firecracker.socket")
+    monkeypatch.setattr(MicroVM, "socket_path", property(lambda self: socket_path))
+    monkeypatch.setattr(settings, "BALLOON_RESERVED_MEMORY", 64)
+    vm = AlephFirecrackerVM(
+        vm_id=3,
+        vm_hash="vm",
+        resources=SimpleNamespace(),
+        hardware_resources=MachineResources(memory=256),
+    )
+    vm.fvm = MicroVM(vm_id=3, firecracker_bin_path="firecracker", use_jailer=False)
+    return vm
+
+
+def test_inflate_and_deflate(tmp_path, monkeypatch):
+    vm = make_vm(tmp_path, monkeypatch)
+
+    async def main():
+        async with StubFirecrackerApi(tmp_path / "firecracker.socket") as api:
+            await vm.inflate_balloon()
+            assert vm.balloon_size == 192
+            assert vm.balloon_stats == {"target_mib": 192}
+            await vm.inflate_balloon()
+            await vm.deflate_balloon()
+            await vm.deflate_balloon()
+            assert api.targets == [192, 0]
+
+    asyncio.run(main())
+    assert vm.balloon_size == 0
+    assert vm.balloon_inflations == 1
+
+
+def test_deflate_waits_for_inflation_in_progress(tmp_path, monkeypatch):
+    vm = make_vm(tmp_path, monkeypatch)
+
+    async def main():
+        async with StubFirecrackerApi(tmp_path / "firecracker.socket", 0.1) as api:
+            inflation = asyncio.create_task(vm.inflate_balloon())
+            await asyncio.sleep(0.02)
+            # The request arrives while the PATCH of the inflation is in flight
+            await vm.deflate_balloon()
+            assert inflation.done()
+            assert api.targets == [192, 0]
+
+    asyncio.run(main())
+    assert vm.balloon_size == 0
+
+
+def test_failed_inflation_is_not_deflated(tmp_path, monkeypatch):
+    vm = make_vm(tmp_path, monkeypatch)
+
+    async def main():
+        async with StubFirecrackerApi(tmp_path / "firecracker.socket", status=400):
+            await vm.inflate_balloon()
+            assert vm.balloon_size == 0
+            await vm.deflate_balloon()
+
+    asyncio.run(main())
+    assert vm.balloon_inflations == 0
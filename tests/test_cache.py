@@ -0,0 +1,62 @@
+import os
+
+from vm_supervisor.cache import ContentCache
+
+
+def add_file(cache: ContentCache, key: str, size: int, verified_hash=None):
+    cache.path(key).write_bytes(b"x" * size)
+    cache.add(key, verified_hash=verified_hash)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ContentCache("code", tmp_path, max_size=300)
+    for key in ("a", "b", "c"):
+        add_file(cache, key, size=100)
+    assert cache.lookup("a")
+
+    add_file(cache, "d", size=100)
+    cache.evict(pinned=set())
+
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert not cache.path("b").exists()
+    assert cache.size == 300
+    assert cache.stats()["evictions"] == 1
+
+
+def test_pinned_files_are_kept(tmp_path):
+    cache = ContentCache("code", tmp_path, max_size=100)
+    add_file(cache, "a", size=100)
+    add_file(cache, "b", size=100)
+
+    cache.evict(pinned={"a", "b"})
+    assert cache.size == 200
+
+    cache.evict(pinned={"b"})
+    assert list(cache.entries) == ["b"]
+    assert cache.size == 100
+
+
+def test_order_and_hashes_survive_restarts(tmp_path):
+    cache = ContentCache("data", tmp_path, max_size=1000)
+    add_file(cache, "a", size=10, verified_hash="hash-a")
+    add_file(cache, "b", size=20)
+    os.utime(cache.path("a"), (2, 2))
+    os.utime(cache.path("b"), (1, 1))
+
+    reloaded = ContentCache("data", tmp_path, max_size=1000)
+    reloaded.load()
+
+    assert list(reloaded.entries.items()) == [("b", 20), ("a", 10)]
+    assert reloaded.verified == {"a": "hash-a"}
+    assert reloaded.size == 30
+
+
+def test_lookup_of_removed_file(tmp_path):
+    cache = ContentCache("data", tmp_path, max_size=1000)
+    add_file(cache, "a", size=10, verified_hash="hash-a")
+    os.remove(cache.path("a"))
+
+    assert not cache.lookup("a")
+    assert cache.size == 0
+    assert cache.verified == {}
+    assert cache.stats()["misses"] == 1
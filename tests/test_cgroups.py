@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from vm_supervisor import cgroups
+from vm_supervisor.cgroups import (
+    CgroupSampler,
+    ResourceUsage,
+    VmCgroup,
+    enable_controllers,
+)
+from vm_supervisor.conf import settings
+
+
+@pytest.fixture
+def cgroupfs(tmp_path, monkeypatch):
+    """A cgroup v2 hierarchy, as far as the supervisor is concerned."""
+    (tmp_path / "cgroup.controllers").write_text("cpuset cpu io memory pids\n")
+    root = tmp_path / "aleph-vm.slice"
+    # Created by the supervisor, and populated by the kernel
+    root.mkdir()
+    (root / "cgroup.controllers").write_text("cpu io memory\n")
+    monkeypatch.setattr(settings, "CGROUP_ROOT", root)
+    monkeypatch.setattr(settings, "CGROUP_SAMPLE_INTERVAL", 0.01)
+    return root
+
+
+def write_counters(path, user_usec=1_500_000, memory_current=4096, memory_peak=None):
+    (path / "cpu.stat").write_text(
+        f"usage_usec {user_usec + 250_000}\n"
+        f"user_usec {user_usec}\n"
+        "system_usec 250000\n"
+    )
+    (path / "io.stat").write_text(
+        "8:0 rbytes=100 wbytes=200 rios=1 wios=2 dbytes=0 dios=0\n"
+        "8:16 rbytes=10 wbytes=20 rios=3 wios=4 dbytes=0 dios=0\n"
+    )
+    (path / "memory.current").write_text(f"{memory_current}\n")
+    if memory_peak is not None:
+        (path / "memory.peak").write_text(f"{memory_peak}\n")
+
+
+def test_enable_controllers(tmp_path, monkeypatch):
+    (tmp_path / "cgroup.controllers").write_text("cpuset memory pids\n")
+    written = []
+    monkeypatch.setattr(
+        cgroups.Path, "write_text", lambda path, text: written.append(text)
+    )
+
+    enable_controllers(tmp_path)
+
+    assert written == ["+memory"]
+
+
+def test_create(cgroupfs):
+    cgroup = VmCgroup.create(cgroupfs, "vm3", pid=1234)
+
+    assert cgroup.path == cgroupfs / "vm3"
+    assert (cgroup.path / "cgroup.procs").read_text() == "1234"
+    assert VmCgroup.create(cgroupfs, "vm3", pid=1235).path == cgroup.path
+
+
+def test_read(cgroupfs):
+    cgroup = VmCgroup.create(cgroupfs, "vm3", pid=1234)
+    write_counters(cgroup.path, memory_current=4096)
+
+    assert cgroup.read() == ResourceUsage(
+        cpu_time_user=1.5,
+        cpu_time_system=0.25,
+        io_read_count=4,
+        io_write_count=6,
+        io_read_bytes=110,
+        io_write_bytes=220,
+        memory_current=4096,
+        memory_peak=4096,
+    )
+
+    # The peak is kept when the usage decreases, or read from the kernel
+    write_counters(cgroup.path, memory_current=1024)
+    assert cgroup.read().memory_peak == 4096
+    write_counters(cgroup.path, memory_current=1024, memory_peak=8192)
+    assert cgroup.read().memory_peak == 8192
+
+
+def test_remove(cgroupfs):
+    cgroup = VmCgroup.create(cgroupfs, "vm3", pid=1234)
+    (cgroup.path / "cgroup.procs").unlink()
+
+    cgroup.remove()
+
+    assert not cgroup.path.exists()
+
+
+def test_sampler(cgroupfs):
+    sampler = CgroupSampler()
+
+    async def main():
+        cgroup = sampler.add(vm_id=3, pid=1234)
+        write_counters(cgroup.path, memory_current=8192)
+        await asyncio.sleep(0.05)
+        assert sampler.last_usage[3].memory_current == 8192
+        assert sampler.task
+
+        write_counters(cgroup.path, user_usec=3_000_000, memory_current=1024)
+        usage = sampler.close(3)
+        assert usage.cpu_time_user == 3.0
+        assert usage.memory_peak == 8192
+        assert sampler.cgroups == {}
+        await asyncio.sleep(0.05)
+        # Stops once there are no VMs left
+        assert sampler.task is None
+
+    asyncio.run(main())
+
+
+def test_sampler_falls_back_to_the_last_sample(cgroupfs):
+    sampler = CgroupSampler()
+
+    async def main():
+        cgroup = sampler.add(vm_id=3, pid=1234)
+        write_counters(cgroup.path, memory_current=8192)
+        sampler.sample()
+        (cgroup.path / "cpu.stat").unlink()
+
+        assert sampler.close(3).memory_current == 8192
+        assert sampler.close(3) is None
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+
+
+def test_sampler_without_cgroups(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "CGROUP_ROOT", tmp_path / "missing" / "aleph")
+    sampler = CgroupSampler()
+
+    assert sampler.add(vm_id=3, pid=1234) is None
+    assert sampler.task is None
+
+
+def test_get_cgroup_sampler(cgroupfs, monkeypatch):
+    monkeypatch.setattr(cgroups, "_cgroup_sampler", None)
+    monkeypatch.setattr(settings, "USE_CGROUPS", False)
+    assert cgroups.get_cgroup_sampler() is None
+
+    monkeypatch.setattr(settings, "USE_CGROUPS", True)
+    assert cgroups.get_cgroup_sampler() is cgroups.get_cgroup_sampler()
+
+    monkeypatch.setattr(cgroups, "_cgroup_sampler", None)
+    (cgroupfs.parent / "cgroup.controllers").unlink()
+    assert cgroups.get_cgroup_sampler() is None
+    assert settings.USE_CGROUPS is False
@@ -0,0 +1,248 @@
+import asyncio
+
+import msgpack
+import pytest
+
+from tests.fake_vm import FakeVm
+from vm_supervisor.vm.channel import (
+    CREDIT,
+    FRAME_HEADER,
+    STREAM_WINDOW,
+    FrameType,
+    StreamCancelled,
+    VmChannel,
+)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data: bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def frames(self):
+        data = self.data
+        while data:
+            request_id, frame_type, length = FRAME_HEADER.unpack_from(data)
+            end = FRAME_HEADER.size + length
+            yield request_id, frame_type, data[FRAME_HEADER.size : end]
+            data = data[end:]
+
+
+def frame(request_id: int, frame_type: FrameType, payload: bytes = b"") -> bytes:
+    return FRAME_HEADER.pack(request_id, frame_type, len(payload)) + payload
+
+
+def open_channel() -> VmChannel:
+    return VmChannel(reader=asyncio.StreamReader(), writer=FakeWriter())
+
+
+def test_unconsumed_stream_does_not_block_other_requests():
+    async def main():
+        channel = open_channel()
+        unconsumed: asyncio.Queue = asyncio.Queue()
+        channel.streams[1] = unconsumed
+        response = asyncio.get_running_loop().create_future()
+        channel.pending[2] = response
+
+        for _ in range(STREAM_WINDOW):
+            channel.reader.feed_data(frame(1, FrameType.event, b"event"))
+        channel.reader.feed_data(frame(2, FrameType.response, b"response"))
+        channel.reader.feed_eof()
+
+        await asyncio.wait_for(channel.read_frames(), timeout=1)
+        return channel, unconsumed, response
+
+    channel, unconsumed, response = asyncio.run(main())
+
+    assert response.result() == b"response"
+    # The whole window is kept for the stream
+    assert unconsumed.qsize() == STREAM_WINDOW + 1
+    assert channel.writer.data == b""
+
+
+def test_stream_exceeding_its_window_is_aborted():
+    async def main():
+        channel = open_channel()
+        stream: asyncio.Queue = asyncio.Queue()
+        channel.streams[1] = stream
+        for _ in range(STREAM_WINDOW + 1):
+            channel.reader.feed_data(frame(1, FrameType.event, b"event"))
+        channel.reader.feed_eof()
+
+        await asyncio.wait_for(channel.read_frames(), timeout=1)
+        await asyncio.sleep(0)  # Let the cancel frame be written
+        return channel, stream
+
+    channel, stream = asyncio.run(main())
+
+    assert 1 not in channel.streams
+    frames = [stream.get_nowait() for _ in range(stream.qsize())]
+    assert frames[STREAM_WINDOW] == (FrameType.cancel, b"")
+    assert list(channel.writer.frames()) == [(1, FrameType.cancel, b"")]
+
+
+def test_stream_grants_credit_as_frames_are_consumed():
+    async def main():
+        channel = open_channel()
+        channel.read_task = asyncio.create_task(channel.read_frames())
+        stream = channel.stream(b"request", timeout=1)
+        first_frame = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0)
+        (request_id, _, _), *_ = channel.writer.frames()
+
+        for _ in range(STREAM_WINDOW):
+            channel.reader.feed_data(frame(request_id, FrameType.event, b"event"))
+        channel.reader.feed_data(frame(request_id, FrameType.response, b"result"))
+        frames = [await first_frame]
+        async for item in stream:
+            frames.append(item)
+        channel.read_task.cancel()
+        return channel, frames
+
+    channel, frames = asyncio.run(main())
+
+    assert frames[-1] == (FrameType.response, b"result")
+    credit = (1, FrameType.credit, CREDIT.pack(STREAM_WINDOW // 2))
+    assert list(channel.writer.frames())[1:] == [credit, credit]
+
+
+def test_stream_raises_when_cancelled_by_the_vm():
+    async def main():
+        channel = open_channel()
+        channel.read_task = asyncio.create_task(channel.read_frames())
+        stream = channel.stream(b"request", timeout=1)
+        first_frame = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0)
+
+        channel.reader.feed_data(frame(1, FrameType.event, b"event"))
+        channel.reader.feed_data(frame(1, FrameType.cancel))
+        frames = [await first_frame]
+        with pytest.raises(StreamCancelled):
+            async for item in stream:
+                frames.append(item)
+        await asyncio.sleep(0)
+        channel.read_task.cancel()
+        return channel, frames
+
+    channel, frames = asyncio.run(main())
+
+    # Frames received before the cancellation are still delivered
+    assert frames == [(FrameType.event, b"event")]
+    # Not cancelled back
+    assert [frame_type for _, frame_type, _ in channel.writer.frames()] == [
+        FrameType.stream_request
+    ]
+
+
+def test_closing_an_unfinished_stream_cancels_the_request():
+    async def main():
+        channel = open_channel()
+        channel.read_task = asyncio.create_task(channel.read_frames())
+        stream = channel.stream(b"request", timeout=1)
+        first_frame = asyncio.create_task(stream.__anext__())
+        await asyncio.sleep(0)
+        channel.reader.feed_data(frame(1, FrameType.event, b"event"))
+        await first_frame
+
+        await stream.aclose()
+        await asyncio.sleep(0)
+        channel.read_task.cancel()
+        return channel
+
+    channel = asyncio.run(main())
+
+    assert 1 not in channel.streams
+    assert list(channel.writer.frames())[-1] == (1, FrameType.cancel, b"")
+
+
+async def produce_chunks(scope, receive, send):
+    """Respond with many more chunks than fit in the window of the stream."""
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    for index in range(10 * STREAM_WINDOW):
+        await send({"type": "http.response.body", "body": b"%d" % index})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def respond_immediately(scope, receive, send):
+    await send({"type": "http.response.start", "status": 204, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def request_payload(path: str) -> bytes:
+    return msgpack.dumps({"scope": {"type": "http", "path": path, "body": b""}})
+
+
+def test_slow_consumer_pauses_its_stream_only(tmp_path):
+    vsock_path = tmp_path / "v.sock_52"
+
+    async def application(scope, receive, send):
+        if scope["path"] == "/stream":
+            await produce_chunks(scope, receive, send)
+        else:
+            await respond_immediately(scope, receive, send)
+
+    async def main():
+        async with FakeVm(vsock_path, application):
+            channel = await VmChannel.open(str(vsock_path))
+            in_flight = []
+            chunks = []
+            async for frame_type, payload in channel.stream(
+                request_payload("/stream"), timeout=1
+            ):
+                # Frames received and not consumed yet
+                in_flight.append(channel.streams[1].qsize())
+                if frame_type != FrameType.event:
+                    break
+                event = msgpack.loads(payload)
+                chunks.append(event.get("body"))
+                if len(chunks) == STREAM_WINDOW:
+                    # Other requests are served while this stream is not read
+                    await asyncio.sleep(0.1)
+                    other = await asyncio.wait_for(
+                        channel.request(request_payload("/other")), timeout=0.5
+                    )
+            await channel.close()
+            return in_flight, chunks, other
+
+    in_flight, chunks, other = asyncio.run(main())
+
+    assert max(in_flight) <= STREAM_WINDOW
+    assert chunks[1:-1] == [b"%d" % index for index in range(10 * STREAM_WINDOW)]
+    assert msgpack.loads(other)["headers"]["status"] == 204
+
+
+def test_messages_wait_for_credit():
+    async def main():
+        channel = open_channel()
+        channel.read_task = asyncio.create_task(channel.read_frames())
+        pulled = []
+
+        async def messages():
+            for index in range(2 * STREAM_WINDOW):
+                pulled.append(index)
+                yield b"message"
+
+        channel.streams[1] = asyncio.Queue()
+        channel.send_windows[1] = asyncio.Semaphore(STREAM_WINDOW)
+        sender = asyncio.create_task(channel.send_messages(1, messages()))
+        await asyncio.sleep(0.01)
+        sent_before_credit = len(list(channel.writer.frames()))
+
+        channel.reader.feed_data(frame(1, FrameType.credit, CREDIT.pack(10)))
+        await asyncio.sleep(0.01)
+        sent_after_credit = len(list(channel.writer.frames()))
+        sender.cancel()
+        channel.read_task.cancel()
+        return len(pulled), sent_before_credit, sent_after_credit
+
+    pulled, sent_before_credit, sent_after_credit = asyncio.run(main())
+
+    assert sent_before_credit == STREAM_WINDOW
+    assert sent_after_credit == STREAM_WINDOW + 10
+    # Not read further than the message waiting for credit
+    assert pulled == STREAM_WINDOW + 11
@@ -0,0 +1,310 @@
+import asyncio
+import builtins
+import hashlib
+import os
+import random
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+
+from tests.file_server import FileServer
+from vm_supervisor import storage
+from vm_supervisor.cache import ContentCache
+from vm_supervisor.conf import settings
+from vm_supervisor.sessions import close_sessions
+from vm_supervisor.storage import (
+    ContentHashMismatchError,
+    download_file,
+    fetch_part_file,
+)
+
+CONTENT = random.Random(0).randbytes(100_000)
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def serve(content: bytes = CONTENT, **attributes):
+    """Run `client_function` with a server of `content` as its argument."""
+
+    def decorator(client_function):
+        async def main():
+            async with FileServer(content) as server:
+                for name, value in attributes.items():
+                    setattr(server, name, value)
+                try:
+                    return await client_function(server)
+                finally:
+                    await close_sessions()
+
+        return asyncio.run(main())
+
+    return decorator
+
+
+def test_concurrent_downloads_share_one_request(tmp_path):
+    path = tmp_path / "file"
+
+    @serve(delay=0.05)
+    async def hits(server):
+        await asyncio.gather(
+            *(download_file(server.url, path) for _ in range(10)),
+        )
+        return server.hits
+
+    assert hits == 1
+    assert path.read_bytes() == CONTENT
+    assert storage.downloads_in_progress == {}
+
+
+def test_cancelled_waiter_does_not_cancel_the_download(tmp_path):
+    path = tmp_path / "file"
+
+    @serve(delay=0.05)
+    async def hits(server):
+        cancelled = asyncio.create_task(download_file(server.url, path))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(download_file(server.url, path))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await waiter
+        return server.hits
+
+    assert hits == 1
+    assert path.read_bytes() == CONTENT
+
+
+def test_failed_download_is_seen_by_all_waiters_and_retried(tmp_path):
+    path = tmp_path / "file"
+
+    @serve(delay=0.05, status=404)
+    async def results(server):
+        errors = await asyncio.gather(
+            *(download_file(server.url, path) for _ in range(5)),
+            return_exceptions=True,
+        )
+        assert storage.downloads_in_progress == {}
+        server.status = 200
+        await download_file(server.url, path)
+        return errors, server.hits
+
+    errors, hits = results
+    assert all(isinstance(error, aiohttp.ClientResponseError) for error in errors)
+    assert {error.status for error in errors} == {404}
+    # A new download is started after the failure
+    assert hits == 2
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_resumes_from_a_partial_file(tmp_path):
+    path = tmp_path / "file"
+    Path(f"{path}.part").write_bytes(CONTENT[:40_000])
+
+    @serve()
+    async def ranges(server):
+        await download_file(server.url, path)
+        return server.ranges
+
+    assert ranges == ["bytes=40000-"]
+    assert path.read_bytes() == CONTENT
+
+
+def test_interrupted_download_is_resumed(tmp_path):
+    path = tmp_path / "file"
+
+    @serve(cut_after=30_000)
+    async def ranges(server):
+        await download_file(server.url, path)
+        return server.ranges
+
+    assert ranges == ["bytes=0-", "bytes=30000-"]
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_restarts_when_the_range_is_not_satisfiable(tmp_path):
+    path = tmp_path / "file"
+    # Longer than the file, so not a part of it
+    Path(f"{path}.part").write_bytes(b"x" * (len(CONTENT) + 1))
+
+    @serve()
+    async def ranges(server):
+        await download_file(server.url, path)
+        return server.ranges
+
+    assert ranges == [f"bytes={len(CONTENT) + 1}-", "bytes=0-"]
+    assert path.read_bytes() == CONTENT
+
+
+def test_mismatched_item_hash_header_is_rejected(tmp_path):
+    tmp_path = tmp_path / "file.part"
+
+    @serve(item_hash="0" * 64)
+    async def error(server):
+        with pytest.raises(ContentHashMismatchError) as error:
+            await fetch_part_file(server.url, tmp_path, sha256(CONTENT))
+        return error.value
+
+    assert error.status == 502
+    # Rejected before the content is downloaded
+    assert "serves" in error.message
+    assert not tmp_path.exists()
+
+
+def test_mismatched_content_is_rejected(tmp_path):
+    tmp_path = tmp_path / "file.part"
+    expected_hash = sha256(b"other content")
+
+    @serve(item_hash=expected_hash)
+    async def error(server):
+        with pytest.raises(ContentHashMismatchError) as error:
+            await fetch_part_file(server.url, tmp_path, expected_hash)
+        return error.value
+
+    assert "does not match" in error.message
+    # The content cannot be resumed from
+    assert not tmp_path.exists()
+
+
+def test_parallel_ranges_are_written_at_their_offset(tmp_path, monkeypatch):
+    tmp_path = tmp_path / "file.part"
+    monkeypatch.setattr(settings, "DOWNLOAD_PARALLEL_RANGES", 4)
+    monkeypatch.setattr(settings, "DOWNLOAD_PARALLEL_MIN_SIZE", 1000)
+    writes = []
+    pwrite = os.pwrite
+
+    def record_pwrite(fd, data, offset):
+        writes.append((offset, len(data)))
+        return pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, "pwrite", record_pwrite)
+
+    @serve()
+    async def result(server):
+        verified = await fetch_part_file(server.url, tmp_path, sha256(CONTENT))
+        return verified, server.ranges
+
+    verified, ranges = result
+    assert verified == sha256(CONTENT)
+    assert ranges[0] == "bytes=0-"
+    assert sorted(ranges[1:]) == [
+        "bytes=25000-49999",
+        "bytes=50000-74999",
+        "bytes=75000-99999",
+    ]
+    # Each byte is written once, at its offset
+    assert sum(size for _, size in writes) == len(CONTENT)
+    assert {offset for offset, _ in writes} >= {0, 25_000, 50_000, 75_000}
+    assert tmp_path.read_bytes() == CONTENT
+
+
+@pytest.mark.parametrize(
+    "range_header, status, content_range",
+    [
+        (None, 200, None),
+        ("bytes=1000-", 206, f"bytes 1000-{len(CONTENT) - 1}/{len(CONTENT)}"),
+        (f"bytes={len(CONTENT)}-", 416, f"bytes */{len(CONTENT)}"),
+    ],
+)
+def test_connector_forwards_the_range_headers(range_header, status, content_range):
+    pytest.importorskip("fastapi")
+    from vm_connector.main import stream_url
+
+    @serve()
+    async def response(server):
+        response = await stream_url(
+            server.url, "application/octet-stream", range_header
+        )
+        if status != 416:
+            # Consumed to release the upstream connection
+            async for _ in response.body_iterator:
+                pass
+        return response
+
+    assert response.status_code == status
+    assert response.headers.get("content-range") == content_range
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+@pytest.fixture
+def data_cache(tmp_path, monkeypatch):
+    """A cache of the downloads in `tmp_path`, for files stored by `store-ref`."""
+    cache = ContentCache("data", tmp_path, max_size=10**9)
+    manager = SimpleNamespace(get_cache=lambda path: cache)
+    monkeypatch.setattr(storage, "get_cache_manager", lambda: manager)
+
+    async def get_stored_file_hash(ref: str):
+        assert ref == "store-ref"
+        return sha256(CONTENT)
+
+    monkeypatch.setattr(storage, "get_stored_file_hash", get_stored_file_hash)
+    return cache
+
+
+def record_file_reads(monkeypatch, path: Path) -> list:
+    """Record the opening of `path` and the hashing of its content."""
+    reads = []
+    open_file, os_open = builtins.open, os.open
+
+    def record_open(file, *args, **kwargs):
+        if Path(file) == path:
+            reads.append(file)
+        return open_file(file, *args, **kwargs)
+
+    def record_os_open(file, *args, **kwargs):
+        if Path(file) == path:
+            reads.append(file)
+        return os_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", record_open)
+    monkeypatch.setattr(os, "open", record_os_open)
+    return reads
+
+
+def test_verified_cache_hit_does_not_read_the_file(data_cache, monkeypatch):
+    path = data_cache.path("file")
+
+    @serve()
+    async def hits(server):
+        await download_file(server.url, path, store_ref="store-ref")
+        assert data_cache.verified == {"file": sha256(CONTENT)}
+        reads = record_file_reads(monkeypatch, path)
+        await download_file(server.url, path, store_ref="store-ref")
+        assert reads == []
+        return server.hits
+
+    assert hits == 1
+    assert data_cache.hits == 1
+
+
+def test_unverified_cached_file_is_hashed_once(data_cache, monkeypatch):
+    path = data_cache.path("file")
+    path.write_bytes(CONTENT)
+    reads = record_file_reads(monkeypatch, path)
+
+    @serve()
+    async def hits(server):
+        await download_file(server.url, path, store_ref="store-ref")
+        await download_file(server.url, path, store_ref="store-ref")
+        return server.hits
+
+    assert hits == 0
+    assert len(reads) == 1
+    assert data_cache.verified == {"file": sha256(CONTENT)}
+
+
+def test_cached_file_not_matching_is_downloaded_again(data_cache):
+    path = data_cache.path("file")
+    path.write_bytes(b"corrupted")
+
+    @serve()
+    async def hits(server):
+        await download_file(server.url, path, store_ref="store-ref")
+        return server.hits
+
+    assert hits == 1
+    assert path.read_bytes() == CONTENT
+    assert data_cache.verified == {"file": sha256(CONTENT)}
+    assert data_cache.size == len(CONTENT)
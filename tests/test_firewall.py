@@ -0,0 +1,169 @@
+import json
+from ipaddress import IPv4Network
+
+import pytest
+
+from tests.fake_nftables import FakeNftables
+from vm_supervisor.conf import NftablesLayout, settings
+from vm_supervisor.network import firewall
+from vm_supervisor.network.interfaces import TapInterface
+
+VM_ID = 7
+
+
+@pytest.fixture
+def interface(monkeypatch) -> TapInterface:
+    # Known tables of the base chains, the ruleset of the host is not listed
+    monkeypatch.setattr(
+        firewall,
+        "base_chain_tables",
+        {("postrouting", "ip"): "nat", ("forward", "ip"): "filter"},
+    )
+    monkeypatch.setattr(settings, "NETWORK_INTERFACE", "eth0")
+    return TapInterface(f"vmtap{VM_ID}", IPv4Network("172.16.7.0/24"))
+
+
+def setup_and_teardown(monkeypatch, layout: NftablesLayout, interface, jump_rules):
+    monkeypatch.setattr(settings, "NFTABLES_LAYOUT", layout)
+    setup = firewall.vm_setup_commands(VM_ID, interface)
+    teardown = firewall.vm_teardown_commands(VM_ID, interface, jump_rules)
+    # The commands are sent to libnftables as JSON
+    return json.loads(json.dumps(setup)), json.loads(json.dumps(teardown))
+
+
+def rules_by_table(commands):
+    """Expressions of the rules added, other than jumps, by table."""
+    rules = {}
+    for command in commands:
+        rule = command["add"].get("rule")
+        if rule and "jump" not in rule["expr"][0]:
+            rules[rule["table"]] = rule["expr"]
+    return rules
+
+
+def test_sets_layout(monkeypatch, interface):
+    setup, teardown = setup_and_teardown(
+        monkeypatch, NftablesLayout.sets, interface, jump_rules=[]
+    )
+
+    assert setup == [
+        {
+            "add": {
+                "element": {
+                    "family": "ip",
+                    "table": table,
+                    "name": "aleph-vm-interfaces",
+                    "elem": ["vmtap7"],
+                }
+            }
+        }
+        for table in ("nat", "filter")
+    ]
+    assert teardown == [{"delete": command["add"]} for command in setup]
+
+
+def test_chains_layout(monkeypatch, interface):
+    jump_rules = [
+        {"family": "ip", "table": "nat", "chain": "aleph-supervisor-nat", "handle": 3},
+        {
+            "family": "ip",
+            "table": "filter",
+            "chain": "aleph-supervisor-filter",
+            "handle": 4,
+        },
+    ]
+    setup, teardown = setup_and_teardown(
+        monkeypatch, NftablesLayout.chains, interface, jump_rules=jump_rules
+    )
+
+    added_chains = [command["add"]["chain"] for command in setup[:2]]
+    assert added_chains == [
+        {"family": "ip", "table": "nat", "name": "aleph-vm-nat-7"},
+        {"family": "ip", "table": "filter", "name": "aleph-vm-filter-7"},
+    ]
+    jumps = [command["add"]["rule"] for command in setup[2:4]]
+    assert [(rule["chain"], rule["expr"]) for rule in jumps] == [
+        ("aleph-supervisor-nat", [{"jump": {"target": "aleph-vm-nat-7"}}]),
+        ("aleph-supervisor-filter", [{"jump": {"target": "aleph-vm-filter-7"}}]),
+    ]
+    # Everything added is removed, the jump rules by their handle
+    assert teardown == [{"delete": {"rule": rule}} for rule in jump_rules] + [
+        {action: {"chain": chain}}
+        for chain in added_chains
+        for action in ("flush", "delete")
+    ]
+
+
+def test_layouts_match_the_same_traffic(monkeypatch, interface):
+    chains_setup, _ = setup_and_teardown(
+        monkeypatch, NftablesLayout.chains, interface, jump_rules=[]
+    )
+    sets_setup, _ = setup_and_teardown(
+        monkeypatch, NftablesLayout.sets, interface, jump_rules=[]
+    )
+    set_rules = rules_by_table(
+        json.loads(json.dumps(firewall.vm_interfaces_set_commands()))
+    )
+
+    # Replacing the set by the interfaces it contains gives the rules of the VM
+    elements = {
+        command["add"]["element"]["table"]: command["add"]["element"]["elem"]
+        for command in sets_setup
+    }
+    for table, expr in set_rules.items():
+        assert expr[0]["match"]["right"] == "@aleph-vm-interfaces"
+        expr[0]["match"]["right"] = elements[table][0]
+
+    assert set_rules == rules_by_table(chains_setup)
+
+
+@pytest.fixture
+def nft(monkeypatch) -> FakeNftables:
+    """A fake libnftables, initialized by the supervisor."""
+    nft = FakeNftables()
+    nft.add_base_chains()
+    monkeypatch.setattr(firewall, "get_customized_nftables", lambda: nft)
+    monkeypatch.setattr(firewall, "base_chain_tables", {})
+    monkeypatch.setattr(firewall, "vm_jump_rules", {})
+    monkeypatch.setattr(settings, "NETWORK_INTERFACE", "eth0")
+    return nft
+
+
+def list_ruleset(nft: FakeNftables):
+    listings = nft.listings
+    ruleset = json.loads(nft.cmd("list ruleset")[1])
+    nft.listings = listings
+    return ruleset
+
+
+@pytest.mark.parametrize("layout", list(NftablesLayout))
+def test_vm_setup_and_teardown_do_not_list_the_ruleset(monkeypatch, nft, layout):
+    monkeypatch.setattr(settings, "NFTABLES_LAYOUT", layout)
+    firewall.initialize_nftables()
+    initial = list_ruleset(nft)
+    listings = nft.listings
+    interface = TapInterface(f"vmtap{VM_ID}", IPv4Network("172.16.7.0/24"))
+
+    firewall.setup_nftables_for_vm(VM_ID, interface)
+    assert list_ruleset(nft) != initial
+    firewall.teardown_nftables_for_vm(VM_ID, interface)
+
+    assert list_ruleset(nft) == initial
+    assert nft.listings == listings
+
+
+def test_vm_teardown_without_handles_lists_the_ruleset(monkeypatch, nft):
+    monkeypatch.setattr(settings, "NFTABLES_LAYOUT", NftablesLayout.chains)
+    firewall.initialize_nftables()
+    initial = list_ruleset(nft)
+    interface = TapInterface(f"vmtap{VM_ID}", IPv4Network("172.16.7.0/24"))
+    firewall.setup_nftables_for_vm(VM_ID, interface)
+    # As for a VM set up by a previous run of the supervisor
+    firewall.vm_jump_rules.clear()
+    listings = nft.listings
+
+    firewall.teardown_nftables_for_vm(VM_ID, interface)
+
+    assert list_ruleset(nft) == initial
+    # Once for each of the chains of the VM
+    assert nft.listings == listings + 2
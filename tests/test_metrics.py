@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from vm_supervisor import metrics
+from vm_supervisor.conf import settings
+from vm_supervisor.metrics import (
+    ExecutionRecord,
+    RecordWriter,
+    UsageRollup,
+    aggregate_records,
+    query_execution_records,
+    split_in_periods,
+)
+
+T0 = datetime(2023, 1, 1, 12)
+
+
+def make_record(uuid: str, vm_hash: str = "vm", **fields) -> ExecutionRecord:
+    fields.setdefault("time_defined", T0)
+    fields.setdefault("time_started", fields["time_defined"])
+    fields.setdefault("time_stopping", fields["time_started"] + timedelta(minutes=30))
+    return ExecutionRecord(uuid=uuid, vm_hash=vm_hash, vcpus=1, memory=128, **fields)
+
+
+def query_rollups(period: str = "hour"):
+    session = metrics.Session()
+    try:
+        return {
+            (rollup.vm_hash, rollup.period_start): rollup.executions
+            for rollup in session.query(UsageRollup).filter_by(period=period)
+        }
+    finally:
+        session.close()
+
+
+def test_record_writer_writes_batch(database):
+    writer = RecordWriter()
+    writer.write([make_record("a"), make_record("b", vm_hash="other")])
+    writer.write([make_record("c", time_defined=T0 + timedelta(hours=1))])
+
+    assert [record.uuid for record in query_execution_records()] == ["a", "b", "c"]
+    assert query_rollups() == {
+        ("vm", T0): 1,
+        ("other", T0): 1,
+        ("vm", T0 + timedelta(hours=1)): 1,
+    }
+    day = T0.replace(hour=0)
+    assert query_rollups("day") == {("vm", day): 2, ("other", day): 1}
+
+
+def test_record_writer_saves_the_valid_records_of_a_batch(database):
+    writer = RecordWriter()
+    writer.write([make_record("a")])
+
+    # The duplicate fails the batch, the other records are saved one by one
+    writer.write([make_record("b"), make_record("a"), make_record("c")])
+
+    assert [record.uuid for record in query_execution_records()] == ["a", "b", "c"]
+    assert query_rollups() == {("vm", T0): 3}
+
+
+def test_record_writer_thread(database, monkeypatch):
+    monkeypatch.setattr(settings, "RECORD_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "RECORD_FLUSH_INTERVAL", 0.01)
+    writer = RecordWriter()
+    writer.start()
+    for uuid in "abcde":
+        writer.records.put(make_record(uuid))
+
+    writer.stop()
+
+    assert not writer.thread.is_alive()
+    assert len(query_execution_records()) == 5
+    assert query_rollups() == {("vm", T0): 5}
+
+
+def test_query_records_pages_through_ties(database):
+    # Records defined at the same time are ordered by uuid
+    times = {"e": T0, "c": T0, "a": T0, "d": T0 + timedelta(seconds=1), "b": T0}
+    RecordWriter().write(
+        [make_record(uuid, time_defined=time) for uuid, time in times.items()]
+    )
+
+    pages = []
+    after = None
+    while True:
+        page = query_execution_records(after=after, limit=2)
+        if not page:
+            break
+        pages.append([record.uuid for record in page])
+        after = (page[-1].time_defined, page[-1].uuid)
+
+    assert pages == [["a", "b"], ["c", "e"], ["d"]]
+
+
+def test_query_records_filters(database):
+    RecordWriter().write(
+        [
+            make_record("a", time_defined=T0),
+            make_record("b", time_defined=T0 + timedelta(hours=1)),
+            make_record("c", vm_hash="other", time_defined=T0 + timedelta(hours=1)),
+            make_record("d", time_defined=T0 + timedelta(hours=2)),
+        ]
+    )
+
+    def uuids(**filters):
+        return [record.uuid for record in query_execution_records(**filters)]
+
+    assert uuids(vm_hash="vm") == ["a", "b", "d"]
+    assert uuids(since=T0 + timedelta(hours=1)) == ["b", "c", "d"]
+    assert uuids(until=T0 + timedelta(hours=2)) == ["a", "b", "c"]
+    assert uuids(vm_hash="vm", after=(T0 + timedelta(hours=1), "b")) == ["d"]
+
+
+def test_split_in_periods():
+    end = T0 + timedelta(hours=2, minutes=15)
+    assert list(split_in_periods(T0 + timedelta(minutes=30), end, "hour")) == [
+        (T0, 1800),
+        (T0 + timedelta(hours=1), 3600),
+        (T0 + timedelta(hours=2), 900),
+    ]
+    assert list(split_in_periods(T0, end, "day")) == [(T0.replace(hour=0), 8100)]
+    # Ending on a boundary
+    assert list(split_in_periods(T0, T0 + timedelta(hours=1), "hour")) == [(T0, 3600)]
+    # An execution of no duration still belongs to a period
+    assert list(split_in_periods(T0, T0, "hour")) == [(T0, 0)]
+
+
+def test_aggregate_records():
+    record = make_record(
+        "a",
+        time_started=T0 + timedelta(minutes=30),
+        time_stopping=T0 + timedelta(hours=1, minutes=30),
+        cpu_time_user=60.0,
+        cpu_time_system=20.0,
+        io_read_bytes=1000,
+        io_write_bytes=None,
+    )
+    rollups = aggregate_records([record, make_record("b", vm_hash="other")])
+
+    # Split in halves between the hours, counted as executed in the second one
+    first = {
+        "executions": 0,
+        "duration": 1800.0,
+        "cpu_time": 40.0,
+        "io_read_bytes": 500.0,
+        "io_write_bytes": 0,
+        "memory_hours": 64.0,
+    }
+    assert rollups[("vm", "hour", T0)] == first
+    assert rollups[("vm", "hour", T0 + timedelta(hours=1))] == {
+        **first,
+        "executions": 1,
+    }
+    assert rollups[("vm", "day", T0.replace(hour=0))] == {
+        "executions": 1,
+        "duration": 3600.0,
+        "cpu_time": 80.0,
+        "io_read_bytes": 1000.0,
+        "io_write_bytes": 0,
+        "memory_hours": 128.0,
+    }
+    assert rollups[("other", "hour", T0)]["executions"] == 1
+    assert len(rollups) == 5
+
+
+def test_aggregate_records_without_times():
+    record = make_record("a", cpu_time_user=1.0)
+    # Stopped before it started
+    record.time_started = record.time_stopping = None
+
+    rollups = aggregate_records([record])
+
+    assert rollups[("vm", "hour", T0)]["executions"] == 1
+    assert rollups[("vm", "hour", T0)]["duration"] == 0
+    assert rollups[("vm", "hour", T0)]["cpu_time"] == 1.0
+
+
+def test_backfill_rollups(database, monkeypatch):
+    monkeypatch.setattr(settings, "RECORDS_PAGE_SIZE", 2)
+    RecordWriter().write(
+        [make_record(uuid, time_defined=T0 + timedelta(minutes=10)) for uuid in "abc"]
+        + [make_record("d", time_defined=T0 + timedelta(hours=1))]
+    )
+    expected = query_rollups()
+
+    assert metrics.backfill_rollups() == 4
+    assert (
+        query_rollups()
+        == expected
+        == {
+            ("vm", T0): 3,
+            ("vm", T0 + timedelta(hours=1)): 1,
+        }
+    )
+
+
+def test_failed_backfill_keeps_rollups(database, monkeypatch):
+    monkeypatch.setattr(settings, "RECORDS_PAGE_SIZE", 2)
+    RecordWriter().write([make_record(uuid) for uuid in "abc"])
+    add_to_rollups = metrics.add_to_rollups
+    pages = []
+
+    def fail_on_second_page(session, records):
+        pages.append(records)
+        if len(pages) == 2:
+            raise ValueError("Invalid record")
+        add_to_rollups(session, records)
+
+    monkeypatch.setattr(metrics, "add_to_rollups", fail_on_second_page)
+
+    with pytest.raises(ValueError):
+        metrics.backfill_rollups()
+    assert query_rollups() == {("vm", T0): 3}
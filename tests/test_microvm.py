@@ -0,0 +1,94 @@
+import asyncio
+import signal
+import sys
+import time
+
+from tests.fake_vm import UnixMicroVM
+
+# Stands for Firecracker: exits when the VM halts, or never if it ignores SIGTERM
+FAKE_FIRECRACKER = """
+import signal, socket, sys, time
+
+if sys.argv[2] == "ignore-sigterm":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+server = socket.socket(socket.AF_UNIX)
+server.bind(sys.argv[1])
+server.listen()
+print("ready", flush=True)
+connection, _ = server.accept()
+connection.recv(1024)
+connection.sendall(b"OK 1\\n...\\nSTOPZ\\n")
+connection.close()
+if sys.argv[2] != "halt":
+    time.sleep(60)
+"""
+
+
+async def start_vm(tmp_path, behaviour: str) -> UnixMicroVM:
+    # Named so that the jailer directory removed by the teardown does not exist
+    vm = UnixMicroVM(vm_id=3, firecracker_bin_path="fake-firecracker", use_jailer=False)
+    vm.vsock_path = str(tmp_path / "v.sock")
+    vm.proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        FAKE_FIRECRACKER,
+        vm.vsock_path,
+        behaviour,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    assert await vm.proc.stdout.readline() == b"ready\n"
+    return vm
+
+
+def test_stop_terminates_the_process(tmp_path):
+    async def main():
+        vm = await start_vm(tmp_path, "run")
+        proc = vm.proc
+        t0 = time.monotonic()
+        await vm.stop(timeout=5)
+        return proc, time.monotonic() - t0
+
+    proc, duration = asyncio.run(main())
+    assert proc.returncode == -signal.SIGTERM
+    # Not waiting for the timeout
+    assert duration < 1
+
+
+def test_stop_kills_the_process_ignoring_sigterm(tmp_path):
+    async def main():
+        vm = await start_vm(tmp_path, "ignore-sigterm")
+        proc = vm.proc
+        t0 = time.monotonic()
+        await vm.stop(timeout=0.2)
+        return vm, proc, time.monotonic() - t0
+
+    vm, proc, duration = asyncio.run(main())
+    assert proc.returncode == -signal.SIGKILL
+    assert 0.2 <= duration < 1
+    assert vm.proc is None
+
+
+def test_wait_for_exit_times_out(tmp_path):
+    async def main():
+        vm = await start_vm(tmp_path, "ignore-sigterm")
+        try:
+            return await vm.wait_for_exit(timeout=0.05)
+        finally:
+            await vm.stop(timeout=0)
+
+    assert asyncio.run(main()) is False
+
+
+def test_teardown_returns_when_the_vm_halts(tmp_path):
+    async def main():
+        vm = await start_vm(tmp_path, "halt")
+        proc = vm.proc
+        t0 = time.monotonic()
+        await vm.teardown()
+        return proc, time.monotonic() - t0
+
+    proc, duration = asyncio.run(main())
+    # Exited by itself, without being terminated
+    assert proc.returncode == 0
+    # No fixed delay after the shutdown
+    assert duration < 0.5
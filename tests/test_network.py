@@ -0,0 +1,207 @@
+import asyncio
+import errno
+import time
+from ipaddress import IPv4Network
+from typing import Dict, List
+
+import pytest
+from pyroute2 import NetlinkError
+
+from vm_supervisor.network import interfaces
+from vm_supervisor.network.interfaces import TapInterface, TapPool
+from vm_supervisor.network.ipaddresses import (
+    IPv4NetworkWithInterfaces,
+    SubnetAllocator,
+)
+
+
+def make_interface(vm_id: int) -> TapInterface:
+    network = IPv4NetworkWithInterfaces(f"172.16.{vm_id}.0/24")
+    return TapInterface(f"vmtap{vm_id}", network)
+
+
+class FakeIPRoute:
+    """The netlink calls of the interfaces, blocking for `delay` seconds each.
+
+    Deleting a link fails with EBUSY `busy` times before succeeding.
+    """
+
+    def __init__(self, delay: float = 0.0, busy: int = 0):
+        self.links: Dict[str, int] = {}
+        self.addresses: Dict[int, List] = {}
+        self.states: Dict[int, str] = {}
+        self.delay = delay
+        self.busy = busy
+        self.deletions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def link_lookup(self, ifname: str) -> List[int]:
+        time.sleep(self.delay)
+        return [self.links[ifname]] if ifname in self.links else []
+
+    def link(self, command: str, **kwargs) -> None:
+        time.sleep(self.delay)
+        if command == "add":
+            assert kwargs["kind"] == "tuntap" and kwargs["mode"] == "tap"
+            self.links[kwargs["ifname"]] = len(self.links) + 1
+        elif command == "set":
+            self.states[kwargs["index"]] = kwargs["state"]
+        elif command == "del":
+            self.deletions += 1
+            if self.busy:
+                self.busy -= 1
+                raise NetlinkError(errno.EBUSY, "Device or resource busy")
+            name = next(n for n, i in self.links.items() if i == kwargs["index"])
+            del self.links[name]
+
+    def addr(self, command: str, index: int, address: str, prefixlen: int) -> None:
+        time.sleep(self.delay)
+        assert command == "add"
+        self.addresses.setdefault(index, []).append((address, prefixlen))
+
+
+@pytest.fixture
+def ipr(monkeypatch) -> FakeIPRoute:
+    ipr = FakeIPRoute()
+    monkeypatch.setattr(interfaces, "IPRoute", lambda: ipr)
+    return ipr
+
+
+async def max_event_loop_lag(coroutine) -> float:
+    """Run `coroutine`, return the longest time the event loop was blocked."""
+    lags = []
+
+    async def tick():
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(0)
+            lags.append(time.monotonic() - t0)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0)
+    try:
+        await coroutine
+    finally:
+        ticker.cancel()
+    return max(lags)
+
+
+def test_tap_pool_claims_recycled_interfaces():
+    pool = TapPool(max_size=2)
+    assert pool.claim() is None
+
+    interfaces = {vm_id: make_interface(vm_id) for vm_id in (1, 2, 3)}
+    assert pool.recycle(1, interfaces[1])
+    assert pool.recycle(2, interfaces[2])
+    # The pool is full, the interface must be deleted by the caller
+    assert not pool.recycle(3, interfaces[3])
+    assert len(pool) == 2
+
+    claimed = [pool.claim(), pool.claim()]
+    assert sorted(claimed) == [(1, interfaces[1]), (2, interfaces[2])]
+    assert pool.claim() is None
+    assert len(pool) == 0
+
+
+@pytest.mark.parametrize("max_size", [0, 1])
+def test_tap_pool_size(max_size):
+    pool = TapPool(max_size=max_size)
+    recycled = [pool.recycle(vm_id, make_interface(vm_id)) for vm_id in range(3)]
+    assert recycled.count(True) == max_size
+
+
+def test_subnet_arithmetic():
+    pool = IPv4NetworkWithInterfaces("172.16.0.0/12")
+    subnets = list(pool.subnets(new_prefix=24))
+
+    assert pool.subnet_count(24) == len(subnets) == 4096
+    for index in (0, 1, 255, 256, 4095):
+        assert pool.subnet(index, 24) == subnets[index]
+        assert pool.subnet_index(subnets[index]) == index
+    with pytest.raises(IndexError):
+        pool.subnet(4096, 24)
+    with pytest.raises(ValueError):
+        pool.subnet_index(IPv4Network("10.0.0.0/24"))
+
+
+def test_subnet_allocator():
+    allocator = SubnetAllocator(IPv4NetworkWithInterfaces("172.16.0.0/12"), 24)
+    subnet = allocator.allocate(9)
+
+    assert subnet == IPv4Network("172.16.9.0/24")
+    assert allocator.is_allocated(9)
+    assert not allocator.is_allocated(8) and not allocator.is_allocated(10)
+    with pytest.raises(ValueError):
+        allocator.allocate(9)
+
+    allocator.release(subnet)
+    assert not allocator.is_allocated(9)
+    assert allocator.allocated == 0
+    assert allocator.allocate(9) == subnet
+
+
+def test_tap_create_and_delete(ipr):
+    interface = make_interface(4)
+
+    async def main():
+        await interface.create()
+        created = dict(ipr.links), dict(ipr.addresses), dict(ipr.states)
+        await interface.delete()
+        return created
+
+    links, addresses, states = asyncio.run(main())
+    assert links == {"vmtap4": 1}
+    assert addresses == {1: [("172.16.4.1", 24)]}
+    assert states == {1: "up"}
+    assert ipr.links == {}
+
+
+def test_tap_delete_retries_while_busy(ipr):
+    ipr.busy = 2
+    interface = make_interface(4)
+
+    async def main():
+        await interface.create()
+        await interface.delete()
+
+    asyncio.run(main())
+    assert ipr.deletions == 3
+    assert ipr.links == {}
+
+
+def test_tap_delete_gives_up_when_always_busy(ipr, monkeypatch):
+    monkeypatch.setattr(interfaces, "TAP_DELETE_RETRY_DELAY", 0.001)
+    ipr.busy = interfaces.TAP_DELETE_ATTEMPTS
+    interface = make_interface(4)
+
+    async def main():
+        await interface.create()
+        await interface.delete()
+
+    asyncio.run(main())
+    assert ipr.deletions == interfaces.TAP_DELETE_ATTEMPTS
+    assert ipr.links == {"vmtap4": 1}
+
+
+def test_tap_delete_of_missing_device(ipr):
+    asyncio.run(make_interface(4).delete())
+    assert ipr.deletions == 0
+
+
+def test_netlink_calls_do_not_block_the_event_loop(ipr):
+    ipr.delay = 0.05
+    interface = make_interface(4)
+
+    async def main():
+        return [
+            await max_event_loop_lag(interface.create()),
+            await max_event_loop_lag(interface.delete()),
+        ]
+
+    # Creating the device makes four calls of 50 ms
+    assert max(asyncio.run(main())) < 0.04
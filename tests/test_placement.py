@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from vm_supervisor import placement
+from vm_supervisor.placement import (
+    CpuPlacer,
+    NumaNode,
+    Placement,
+    parse_cpu_list,
+    pin_supervisor,
+    read_topology,
+)
+
+
+def write_topology(path, nodes):
+    for node_id, cpulist in nodes.items():
+        (path / f"node{node_id}").mkdir(parents=True)
+        (path / f"node{node_id}" / "cpulist").write_text(f"{cpulist}\n")
+    # Not a node
+    (path / "possible").write_text("0-1\n")
+
+
+@pytest.fixture
+def usable_cpus(monkeypatch):
+    cpus = set(range(8))
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: cpus)
+    return cpus
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8-9,12\n") == [0, 1, 2, 3, 8, 9, 12]
+    assert parse_cpu_list("") == []
+
+
+def test_read_topology(tmp_path, usable_cpus):
+    write_topology(tmp_path, {0: "0-3", 1: "4-7,8-11", 2: "12-15"})
+    usable_cpus.discard(1)
+
+    assert read_topology(tmp_path) == [
+        NumaNode(id=0, cpus=[0, 2, 3]),
+        NumaNode(id=1, cpus=[4, 5, 6, 7]),
+    ]
+
+
+def test_read_topology_without_numa(tmp_path, usable_cpus):
+    assert read_topology(tmp_path / "missing") == [
+        NumaNode(id=None, cpus=list(range(8)))
+    ]
+
+
+def test_place_within_least_loaded_node(tmp_path, usable_cpus):
+    write_topology(tmp_path, {0: "0-3", 1: "4-7"})
+    placer = CpuPlacer(read_topology(tmp_path), reserved_cpus=1)
+    assert placer.reserved == [0]
+    assert placer.nodes == [NumaNode(0, [1, 2, 3]), NumaNode(1, [4, 5, 6, 7])]
+
+    first = placer.place(2)
+    assert first == Placement(node=1, cpus=[4, 5])
+    second = placer.place(2)
+    assert second == Placement(node=0, cpus=[1, 2])
+    assert placer.place(2) == Placement(node=1, cpus=[6, 7])
+
+    placer.release(first)
+    assert placer.place(3) == Placement(node=1, cpus=[4, 5, 6])
+
+
+def test_place_larger_than_any_node(usable_cpus):
+    placer = CpuPlacer([NumaNode(0, [0, 1]), NumaNode(1, [2, 3])])
+    placer.place(1)
+
+    assert placer.place(3) == Placement(node=None, cpus=[1, 2, 3])
+
+
+def test_reserve_keeps_a_cpu_for_the_vms(usable_cpus):
+    placer = CpuPlacer([NumaNode(None, [0, 1])], reserved_cpus=4)
+    assert placer.reserved == [0]
+    assert placer.place(1) == Placement(node=None, cpus=[1])
+
+    assert CpuPlacer([NumaNode(None, [0])], reserved_cpus=1).reserved == []
+
+
+def test_pin_supervisor(monkeypatch):
+    pinned = []
+    monkeypatch.setattr(
+        placement.os, "sched_setaffinity", lambda pid, cpus: pinned.append(cpus)
+    )
+
+    pin_supervisor(CpuPlacer([NumaNode(None, [0, 1, 2])], reserved_cpus=2))
+    pin_supervisor(CpuPlacer([NumaNode(None, [0, 1, 2])], reserved_cpus=0))
+
+    assert pinned == [[0, 1]]
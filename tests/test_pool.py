@@ -0,0 +1,27 @@
+from aleph_message.models.program import Encoding
+
+from vm_supervisor.pool import get_prealloc_key
+
+
+def test_prealloc_key_requires_no_drive(program_message):
+    program = program_message.content
+    assert get_prealloc_key(program) is None
+
+    program.code.encoding = Encoding.zip
+    assert get_prealloc_key(program) is None
+
+    program.volumes = []
+    assert get_prealloc_key(program) == (program.runtime.ref, 1, 128, True)
+
+
+def test_prealloc_key_separates_internet_access(program_message):
+    program = program_message.content
+    program.code.encoding = Encoding.zip
+    program.volumes = []
+    with_internet = get_prealloc_key(program)
+
+    program.environment.internet = False
+    without_internet = get_prealloc_key(program)
+
+    assert with_internet != without_internet
+    assert without_internet[-1] is False
@@ -0,0 +1,189 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aleph_message.models.program import MachineResources
+
+from vm_supervisor import reaper as reaper_module
+from vm_supervisor.conf import settings
+from vm_supervisor.reaper import WHEEL_SLOTS, WHEEL_TICK, ExecutionReaper
+
+
+class FakeExecution:
+    def __init__(self, vm_hash: str, memory: int = 128):
+        self.vm_hash = vm_hash
+        self.program = SimpleNamespace(resources=MachineResources(memory=memory))
+        self.vm = SimpleNamespace(balloon_size=0)
+        self.is_running = True
+        self.persistent = False
+        self.concurrent_runs = 0
+        self.stop_started = asyncio.Event()
+        self.may_stop = asyncio.Event()
+        self.may_stop.set()
+
+    async def stop(self):
+        self.stop_started.set()
+        await self.may_stop.wait()
+        self.is_running = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+@pytest.fixture
+def reaper(monkeypatch) -> ExecutionReaper:
+    monkeypatch.setattr(settings, "MAX_IDLE_EXECUTIONS", None)
+    monkeypatch.setattr(settings, "MIN_AVAILABLE_MEMORY", None)
+    monkeypatch.setattr(settings, "BALLOON_IDLE_DELAY", None)
+    reaper = ExecutionReaper()
+    clock = FakeClock()
+    reaper.now = clock
+    reaper.clock = clock
+    # The wheel is advanced by the tests, not by the task
+    reaper.current_tick = int(clock.time / WHEEL_TICK)
+    return reaper
+
+
+def run(coroutine_function):
+    asyncio.run(coroutine_function())
+
+
+def advance(reaper: ExecutionReaper, seconds: float):
+    reaper.clock.time += seconds
+    reaper.expire(reaper.now())
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_executions_stop_after_their_timeout(reaper):
+    async def main():
+        short, long = FakeExecution("short"), FakeExecution("long")
+        reaper.schedule(short, timeout=5)
+        reaper.schedule(long, timeout=10)
+
+        advance(reaper, 4)
+        await settle()
+        assert short.is_running and long.is_running
+
+        advance(reaper, 2)
+        await settle()
+        assert not short.is_running and long.is_running
+
+        advance(reaper, 5)
+        await settle()
+        assert not long.is_running
+        assert reaper.stats()["expired"] == 2 and not reaper.idle
+
+    run(main)
+
+
+def test_cancelled_executions_keep_running(reaper):
+    async def main():
+        execution = FakeExecution("used")
+        reaper.schedule(execution, timeout=5)
+        assert reaper.cancel(execution)
+        assert not reaper.cancel(execution)
+        advance(reaper, 10)
+        await settle()
+        assert execution.is_running
+        assert not any(reaper.slots)
+
+    run(main)
+
+
+def test_rescheduling_moves_the_deadline(reaper):
+    async def main():
+        execution = FakeExecution("reused")
+        reaper.schedule(execution, timeout=5)
+        advance(reaper, 4)
+        reaper.schedule(execution, timeout=5)
+        advance(reaper, 4)
+        await settle()
+        assert execution.is_running
+        advance(reaper, 2)
+        await settle()
+        assert not execution.is_running
+
+    run(main)
+
+
+def test_deadlines_beyond_a_turn_of_the_wheel(reaper):
+    async def main():
+        execution = FakeExecution("patient")
+        timeout = WHEEL_SLOTS * WHEEL_TICK + 3
+        reaper.schedule(execution, timeout=timeout)
+        # The slot of the deadline is passed once before the deadline
+        for _ in range(WHEEL_SLOTS):
+            advance(reaper, WHEEL_TICK)
+        await settle()
+        assert execution.is_running
+        advance(reaper, 4)
+        await settle()
+        assert not execution.is_running
+
+    run(main)
+
+
+def test_persistent_executions_are_not_scheduled(reaper):
+    execution = SimpleNamespace(vm_hash="persistent", persistent=True)
+    reaper.schedule(execution, timeout=1)
+    assert not reaper.idle
+
+
+def test_too_many_idle_executions(reaper, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_IDLE_EXECUTIONS", 2)
+
+    async def main():
+        executions = [FakeExecution(f"vm{index}") for index in range(4)]
+        for execution in executions:
+            reaper.schedule(execution, timeout=60)
+        reaper.evict()
+        await settle()
+        # Least recently used first
+        running = [execution.is_running for execution in executions]
+        assert running == [False, False, True, True]
+        assert reaper.stats()["evicted"] == 2
+
+    run(main)
+
+
+def test_low_memory_does_not_cascade(reaper, monkeypatch):
+    """Executions still stopping count as memory released."""
+    monkeypatch.setattr(settings, "MIN_AVAILABLE_MEMORY", 1000)
+    available = SimpleNamespace(available=800 * 2**20)
+    monkeypatch.setattr(reaper_module.psutil, "virtual_memory", lambda: available)
+
+    async def main():
+        executions = [FakeExecution(f"vm{index}", memory=128) for index in range(4)]
+        for execution in executions:
+            execution.may_stop.clear()
+            reaper.schedule(execution, timeout=60)
+
+        reaper.evict()
+        await settle()
+        stopping = [execution.stop_started.is_set() for execution in executions]
+        assert stopping == [True, True, False, False]
+
+        # The memory is not released yet at the next checks
+        reaper.evict()
+        reaper.evict()
+        await settle()
+        assert [execution.stop_started.is_set() for execution in executions] == (
+            stopping
+        )
+        assert set(reaper.stopping) == {"vm0", "vm1"}
+
+        for execution in executions:
+            execution.may_stop.set()
+        await settle()
+        assert not reaper.stopping
+
+    run(main)
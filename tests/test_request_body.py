@@ -0,0 +1,83 @@
+import asyncio
+from typing import Optional
+
+import pytest
+from aiohttp import web
+
+from vm_supervisor.run import REQUEST_BODY_CHUNK_SIZE, RequestBodyReader
+
+
+class FakeContent:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def iter_chunked(self, size: int):
+        for start in range(0, len(self.body), size):
+            yield self.body[start : start + size]
+
+
+class FakeRequest:
+    """The parts of `aiohttp.web.Request` used to read a body."""
+
+    def __init__(self, body: bytes, content_length: Optional[int]):
+        self.content = FakeContent(body)
+        self.content_length = content_length
+
+
+def make_request(body: bytes, content_length: bool = True) -> FakeRequest:
+    return FakeRequest(body, content_length=len(body) if content_length else None)
+
+
+async def read_messages(reader: RequestBodyReader):
+    return [message async for message in reader.messages()]
+
+
+def test_body_is_sent_in_chunks():
+    body = b"x" * (2 * REQUEST_BODY_CHUNK_SIZE + 10)
+
+    async def main():
+        reader = RequestBodyReader(make_request(body), max_size=len(body))
+        reader.check_content_length()
+        return reader, await read_messages(reader)
+
+    reader, messages = asyncio.run(main())
+
+    assert b"".join(message["body"] for message in messages) == body
+    assert all(message["type"] == "http.request" for message in messages)
+    assert [message["more_body"] for message in messages][-1] is False
+    assert all(message["more_body"] for message in messages[:-1])
+    assert max(len(message["body"]) for message in messages) <= (
+        REQUEST_BODY_CHUNK_SIZE
+    )
+    assert reader.size == len(body) and not reader.too_large
+
+
+def test_empty_body():
+    async def main():
+        reader = RequestBodyReader(make_request(b""), max_size=10)
+        return await read_messages(reader)
+
+    messages = asyncio.run(main())
+
+    assert messages == [{"type": "http.request", "body": b"", "more_body": False}]
+
+
+def test_content_length_too_large():
+    reader = RequestBodyReader(make_request(b"x" * 11), max_size=10)
+    with pytest.raises(web.HTTPRequestEntityTooLarge):
+        reader.check_content_length()
+
+
+def test_body_larger_than_announced_is_interrupted():
+    body = b"x" * (REQUEST_BODY_CHUNK_SIZE + 10)
+
+    async def main():
+        request = make_request(body, content_length=False)
+        reader = RequestBodyReader(request, max_size=REQUEST_BODY_CHUNK_SIZE)
+        reader.check_content_length()
+        return reader, await read_messages(reader)
+
+    reader, messages = asyncio.run(main())
+
+    assert messages[-1] == {"type": "http.disconnect"}
+    assert reader.too_large
@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+from vm_supervisor import run
+from vm_supervisor.scheduler import InsufficientCapacityError
+
+CONCURRENT_REQUESTS = 100
+
+
+@pytest.fixture
+def fake_creation(monkeypatch, program_message):
+    """Count the VMs booted by the pool, each taking some time to start."""
+    boots = []
+
+    async def load_updated_message(vm_hash):
+        return program_message, program_message
+
+    async def create_a_vm(vm_hash, program, original):
+        boots.append(vm_hash)
+        await asyncio.sleep(0.05)
+        return SimpleNamespace(vm_hash=vm_hash, vm=object())
+
+    monkeypatch.setattr(run, "load_updated_message", load_updated_message)
+    monkeypatch.setattr(run.pool, "create_a_vm", create_a_vm)
+    monkeypatch.setattr(run.pool, "message_cache", {})
+    return boots
+
+
+def test_concurrent_requests_boot_a_single_vm(fake_creation):
+    async def main():
+        return await asyncio.gather(
+            *(
+                run.get_or_create_vm_execution(vm_hash="hash")
+                for _ in range(CONCURRENT_REQUESTS)
+            )
+        )
+
+    executions = asyncio.run(main())
+
+    assert fake_creation == ["hash"]
+    assert len(set(map(id, executions))) == 1
+    assert not run.pool.creation_tasks
+
+
+def test_creation_errors_are_converted_per_request(fake_creation, monkeypatch):
+    async def create_a_vm(vm_hash, program, original):
+        fake_creation.append(vm_hash)
+        await asyncio.sleep(0.05)
+        raise InsufficientCapacityError(retry_after=3)
+
+    monkeypatch.setattr(run.pool, "create_a_vm", create_a_vm)
+
+    async def request():
+        try:
+            await run.run_code_on_request(vm_hash="hash", path="/", request=None)
+        except web.HTTPServiceUnavailable as error:
+            return error
+
+    async def main():
+        return await asyncio.gather(*(request() for _ in range(10)))
+
+    errors = asyncio.run(main())
+
+    assert fake_creation == ["hash"]
+    assert len(set(map(id, errors))) == len(errors)
+    assert all(error.headers["Retry-After"] == "3" for error in errors)
+
+
+def test_creation_errors_are_converted_per_event(fake_creation, monkeypatch):
+    async def create_a_vm(vm_hash, program, original):
+        raise InsufficientCapacityError(retry_after=3)
+
+    monkeypatch.setattr(run.pool, "create_a_vm", create_a_vm)
+
+    response = asyncio.run(
+        run.run_code_on_event(vm_hash="hash", event="{}", pubsub=None)
+    )
+
+    assert isinstance(response, web.HTTPServiceUnavailable)
+    assert not run.pool.creation_tasks
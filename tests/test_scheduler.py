@@ -0,0 +1,169 @@
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+from aleph_message.models.program import MachineResources
+
+from vm_supervisor import scheduler
+from vm_supervisor.conf import settings
+from vm_supervisor.scheduler import CapacityScheduler, InsufficientCapacityError
+
+
+class FakeExecution:
+    def __init__(self, vm_hash: str, memory: int, vcpus: int = 1):
+        self.vm_hash = vm_hash
+        self.program = SimpleNamespace(
+            resources=MachineResources(memory=memory, vcpus=vcpus)
+        )
+        self.is_running = True
+        self.persistent = False
+        self.concurrent_runs = 0
+
+    async def stop(self):
+        await asyncio.sleep(0)
+        self.is_running = False
+
+
+class FakePool:
+    def __init__(self):
+        self.executions = {}
+        self.preallocated = {}
+        self.preallocating = {}
+        self.idle: List[FakeExecution] = []
+        self.reaper = SimpleNamespace(idle_executions=lambda: list(self.idle))
+
+    def run(self, execution: FakeExecution, idle: bool = False):
+        self.executions[execution.vm_hash] = execution
+        if idle:
+            self.idle.append(execution)
+
+
+def resources(memory: int, vcpus: int = 1) -> MachineResources:
+    return MachineResources(memory=memory, vcpus=vcpus)
+
+
+class FakeClock:
+    """Time advanced by the sleeps of the scheduler, without waiting."""
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self) -> float:
+        return self.time
+
+    async def sleep(self, seconds: float) -> None:
+        self.time += seconds
+        await asyncio.sleep(0)
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(CapacityScheduler, "now", lambda self: clock())
+    monkeypatch.setattr(CapacityScheduler, "sleep", lambda self, s: clock.sleep(s))
+    monkeypatch.setattr(settings, "ADMISSION_TIMEOUT", 10)
+    return clock
+
+
+def test_usage_accounts_for_all_vms():
+    pool = FakePool()
+    pool.run(FakeExecution("running", memory=256, vcpus=2))
+    pool.preallocated[("runtime", 1, 128, True)] = [object(), object()]
+    pool.preallocating[("runtime", 2, 512, False)] = 1
+    capacity = CapacityScheduler(pool, memory_budget=2048, vcpu_budget=8)
+    capacity.reserved["creating"] = resources(64)
+
+    assert capacity.usage() == (256 + 2 * 128 + 512 + 64, 2 + 2 + 2 + 1)
+    assert capacity.fits(resources(2048 - 1088))
+    assert not capacity.fits(resources(2048 - 1088 + 1))
+    assert not capacity.fits(resources(64, vcpus=2))
+
+
+def test_reservation_is_released():
+    capacity = CapacityScheduler(FakePool(), memory_budget=512, vcpu_budget=4)
+
+    async def main():
+        async with capacity.reservation("vm", resources(512)):
+            assert capacity.usage() == (512, 1)
+        assert capacity.usage() == (0, 0)
+
+    asyncio.run(main())
+    assert capacity.stats()["admitted"] == 1
+
+
+def test_vm_larger_than_the_host_is_rejected():
+    capacity = CapacityScheduler(FakePool(), memory_budget=512, vcpu_budget=4)
+
+    async def main():
+        async with capacity.reservation("vm", resources(1024)):
+            pass
+
+    with pytest.raises(InsufficientCapacityError):
+        asyncio.run(main())
+    assert capacity.stats()["rejected"] == 1
+
+
+def test_rejected_after_timeout(clock):
+    pool = FakePool()
+    pool.run(FakeExecution("busy", memory=512))
+    capacity = CapacityScheduler(pool, memory_budget=512, vcpu_budget=4)
+    start = clock()
+
+    async def main():
+        with pytest.raises(InsufficientCapacityError) as error:
+            await capacity.admit(resources(128))
+        return error.value
+
+    error = asyncio.run(main())
+    waited = clock() - start
+    assert (
+        settings.ADMISSION_TIMEOUT
+        <= waited
+        < settings.ADMISSION_TIMEOUT + scheduler.ADMISSION_POLL_INTERVAL
+    )
+    assert error.retry_after == 10
+    assert not capacity.waiters
+
+
+def test_idle_executions_are_evicted_least_recently_used_first():
+    pool = FakePool()
+    oldest = FakeExecution("oldest", memory=256)
+    persistent = FakeExecution("persistent", memory=256)
+    persistent.persistent = True
+    newest = FakeExecution("newest", memory=256)
+    for execution in (persistent, oldest, newest):
+        pool.run(execution, idle=True)
+    capacity = CapacityScheduler(pool, memory_budget=768, vcpu_budget=8)
+
+    asyncio.run(capacity.admit(resources(256)))
+
+    assert not oldest.is_running
+    assert persistent.is_running and newest.is_running
+    assert capacity.stats()["evicted"] == 1
+
+
+def test_waiters_are_admitted_in_order():
+    pool = FakePool()
+    busy = FakeExecution("busy", memory=512)
+    pool.run(busy)
+    capacity = CapacityScheduler(pool, memory_budget=512, vcpu_budget=8)
+    admitted = []
+
+    async def request(name: str, memory: int):
+        async with capacity.reservation(name, resources(memory)):
+            admitted.append(name)
+            await asyncio.sleep(0)
+
+    async def main():
+        tasks = [asyncio.create_task(request("large", 512))]
+        await asyncio.sleep(0)
+        # Would fit before the large VM, but must not overtake it
+        tasks.append(asyncio.create_task(request("small", 64)))
+        await asyncio.sleep(0)
+        assert admitted == [] and len(capacity.waiters) == 2
+        busy.is_running = False
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert admitted == ["large", "small"]
@@ -0,0 +1,63 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from tests.file_server import FileServer
+from vm_supervisor import sessions, supervisor
+from vm_supervisor.conf import settings
+from vm_supervisor.sessions import close_sessions, get_session
+from vm_supervisor.storage import download_file
+
+
+def test_session_is_opened_and_closed_with_the_application(monkeypatch, database):
+    monkeypatch.setattr(type(settings), "check", lambda self: None)
+    monkeypatch.setattr(settings, "WATCH_FOR_MESSAGES", False)
+    monkeypatch.setattr(settings, "CPU_PINNING", False)
+    used = []
+
+    async def use_session(request: web.Request):
+        used.append(get_session())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/", use_session)
+    monkeypatch.setattr(supervisor, "app", app)
+
+    def run_app(app, host, port):
+        async def main():
+            assert sessions._session is None
+            async with TestClient(TestServer(app)) as client:
+                # Opened on startup, before any request
+                opened = sessions._session
+                assert opened and not opened.closed
+                for _ in range(3):
+                    assert (await client.get("/")).status == 200
+            return opened
+
+        used.append(asyncio.run(main()))
+
+    monkeypatch.setattr(supervisor.web, "run_app", run_app)
+    supervisor.run()
+
+    # The requests used the session opened on startup, closed on cleanup
+    opened = used.pop()
+    assert used == [opened] * 3
+    assert opened.closed
+    assert sessions._session is None
+
+
+def test_downloads_reuse_the_connection(tmp_path):
+    async def main():
+        async with FileServer(b"content") as server:
+            try:
+                for name in ("a", "b", "c"):
+                    await download_file(server.url, tmp_path / name)
+            finally:
+                await close_sessions()
+        return server.peers
+
+    peers = asyncio.run(main())
+    assert len(peers) == 3
+    # Kept alive between the downloads
+    assert len(set(peers)) == 1
@@ -0,0 +1,40 @@
+import os
+
+from vm_supervisor.snapshots import SnapshotStore, disk_usage
+
+
+def write_snapshot(store: SnapshotStore, key: str, size: int):
+    snapshot = store.new_snapshot()
+    snapshot.snapshot_path.write_bytes(b"state")
+    snapshot.mem_file_path.write_bytes(b"\1" * size)
+    return store.add(key, snapshot)
+
+
+def test_store_get_and_add(tmp_path):
+    store = SnapshotStore(directory=tmp_path, max_size=1_000_000)
+    assert store.get("key") is None
+
+    added = write_snapshot(store, "key", size=4096)
+    assert added.path == tmp_path / "key"
+    assert store.get("key") == added
+
+    # A concurrent snapshot of the same key is dropped
+    assert write_snapshot(store, "key", size=4096) == added
+    assert [entry.name for entry in os.scandir(tmp_path)] == ["key"]
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = SnapshotStore(directory=tmp_path, max_size=1_000_000)
+    write_snapshot(store, "a", size=8192)
+    store.max_size = 3 * disk_usage(tmp_path / "a")
+    for key in ("b", "c"):
+        write_snapshot(store, key, size=8192)
+    os.utime(tmp_path / "a", (0, 0))
+    os.utime(tmp_path / "b", (1, 1))
+    os.utime(tmp_path / "c", (2, 2))
+    store.get("a")
+
+    write_snapshot(store, "d", size=8192)
+
+    assert store.get("b") is None
+    assert all(store.get(key) for key in ("a", "c", "d"))
@@ -0,0 +1,67 @@
+import asyncio
+import hashlib
+import os
+import random
+
+import pytest
+
+from vm_supervisor.storage import RangeHasher, parse_content_range
+
+CHUNK_SIZE = 1000
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 10-19/100") == (10, 19, 100)
+    assert parse_content_range("bytes */100") is None
+    assert parse_content_range(None) is None
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_range_hasher_matches_the_file(tmp_path, seed):
+    content = random.Random(seed).randbytes(CHUNK_SIZE * 40 + 123)
+    range_size = -(-len(content) // 4)
+    ranges = [
+        [
+            (offset, content[offset : min(offset + CHUNK_SIZE, end)])
+            for offset in range(start, end, CHUNK_SIZE)
+        ]
+        for start, end in (
+            (start, min(start + range_size, len(content)))
+            for start in range(0, len(content), range_size)
+        )
+    ]
+
+    async def receive_range(chunks, range_hasher: RangeHasher, rng: random.Random):
+        for offset, chunk in chunks:
+            await asyncio.sleep(rng.random() / 1000)
+            os.pwrite(range_hasher.fd, chunk, offset)
+            range_hasher.update(offset, chunk)
+
+    async def main():
+        fd = os.open(tmp_path / "file", os.O_RDWR | os.O_CREAT)
+        try:
+            range_hasher = RangeHasher(hashlib.sha256(), fd)
+            rng = random.Random(seed)
+            await asyncio.gather(
+                *(receive_range(chunks, range_hasher, rng) for chunks in ranges)
+            )
+            return await range_hasher.hexdigest(len(content))
+        finally:
+            os.close(fd)
+
+    assert asyncio.run(main()) == hashlib.sha256(content).hexdigest()
+
+
+def test_range_hasher_requires_the_whole_file(tmp_path):
+    async def main():
+        fd = os.open(tmp_path / "file", os.O_RDWR | os.O_CREAT)
+        try:
+            range_hasher = RangeHasher(hashlib.sha256(), fd)
+            os.pwrite(fd, b"end", 10)
+            range_hasher.update(10, b"end")
+            with pytest.raises(ValueError):
+                await range_hasher.hexdigest(13)
+        finally:
+            os.close(fd)
+
+    asyncio.run(main())
@@ -0,0 +1,262 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aleph_message.models.program import MachineResources
+
+from tests.fake_vm import FakeVm, make_execution
+from vm_supervisor import run
+from vm_supervisor.conf import settings
+
+
+@pytest.fixture
+def execution(tmp_path, monkeypatch, program_message):
+    """A running execution, with the init of its VM answering on a unix socket."""
+    monkeypatch.setattr(settings, "WATCH_FOR_UPDATES", False)
+    execution = make_execution(tmp_path / "v.sock", program_message.content)
+
+    async def get_or_create_vm_execution(vm_hash):
+        return execution
+
+    monkeypatch.setattr(run, "get_or_create_vm_execution", get_or_create_vm_execution)
+    return execution
+
+
+def serve(execution, application, multiplexed=True, interface="asgi"):
+    """Run `client` against the supervisor, with `application` running in the VM."""
+    app = web.Application()
+
+    async def run_code(request: web.Request):
+        return await run.run_code_on_request("vm", request.path, request)
+
+    app.router.add_route("*", "/{path:.*}", run_code)
+
+    def decorator(client_function):
+        async def main():
+            vsock_path = execution.vm.fvm.vsock_path
+            async with FakeVm(vsock_path, application, multiplexed, interface):
+                async with TestClient(TestServer(app)) as client:
+                    result = await client_function(client)
+                if execution.vm.channel:
+                    await execution.vm.channel.close()
+            return result
+
+        return asyncio.run(main())
+
+    return decorator
+
+
+async def start(send, status=200):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain")],
+        }
+    )
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def test_multi_chunk_body(execution):
+    async def application(scope, receive, send):
+        size = len(await read_body(receive))
+        await start(send)
+        for chunk in (b"first ", b"second ", b"%d" % size):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    @serve(execution, application)
+    async def result(client):
+        # Uploaded in several messages of `REQUEST_BODY_CHUNK_SIZE`
+        response = await client.post("/", data=b"x" * 200_000)
+        return response.status, response.headers, await response.read()
+
+    status, headers, body = result
+    assert status == 200
+    assert headers["Aleph-Program-ItemHash"] == "vm"
+    assert "Content-Length" not in headers
+    assert body == b"first second 200000"
+    assert execution.vm.channel_supported
+
+
+def test_error_before_the_response(execution):
+    async def application(scope, receive, send):
+        raise ValueError("Broken program")
+
+    @serve(execution, application)
+    async def result(client):
+        response = await client.get("/")
+        return response.status, await response.text()
+
+    status, text = result
+    assert status == 500
+    assert "ValueError: Broken program" in text
+
+
+def test_mid_stream_error_aborts_the_response(execution):
+    async def application(scope, receive, send):
+        await start(send)
+        await send(
+            {"type": "http.response.body", "body": b"partial", "more_body": True}
+        )
+        raise ValueError("Broken program")
+
+    @serve(execution, application)
+    async def result(client):
+        response = await client.get("/")
+        assert response.status == 200
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await response.read()
+        # The channel of the VM is still usable
+        return execution.vm.channel.closed
+
+    assert result is False
+    assert execution.stops == []
+
+
+def test_vm_crash_aborts_the_response(execution):
+    crash = asyncio.Event()
+
+    async def application(scope, receive, send):
+        await start(send)
+        await send(
+            {"type": "http.response.body", "body": b"partial", "more_body": True}
+        )
+        await crash.wait()
+        # Closes the channel, as when the VM stops
+        execution.vm.channel.writer.transport.abort()
+        await asyncio.sleep(10)
+
+    @serve(execution, application)
+    async def result(client):
+        response = await client.get("/")
+        assert await response.content.readany() == b"partial"
+        crash.set()
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await response.read()
+
+    assert execution.stops == [3]
+
+
+def test_client_disconnect_cancels_the_request(execution):
+    cancelled = asyncio.Event()
+
+    async def application(scope, receive, send):
+        await start(send)
+        try:
+            while True:
+                await send(
+                    {"type": "http.response.body", "body": b"data", "more_body": True}
+                )
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    @serve(execution, application)
+    async def result(client):
+        response = await client.get("/")
+        await response.content.readany()
+        response.close()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        # Not waiting for credit anymore
+        return execution.vm.channel.streams
+
+    assert result == {}
+    assert execution.stops == []
+
+
+def test_non_streaming_fallback(execution):
+    async def application(scope, receive, send):
+        body = await read_body(receive)
+        await start(send, status=201)
+        await send({"type": "http.response.body", "body": b"first ", "more_body": True})
+        await send({"type": "http.response.body", "body": body})
+
+    @serve(execution, application, multiplexed=False)
+    async def result(client):
+        responses = []
+        for _ in range(2):
+            response = await client.post("/", data=b"body")
+            responses.append((response.status, await response.read()))
+        return responses
+
+    assert result == [(201, b"first body")] * 2
+    assert execution.vm.channel_supported is False
+
+
+def test_executable_streaming(execution):
+    """Executables are proxied to their HTTP server, on port 8080 in the VM."""
+
+    async def handle(request: web.Request):
+        size = len(await request.read())
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for chunk in (b"first ", b"second ", b"%d" % size):
+            await response.write(chunk)
+            await asyncio.sleep(0.01)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/upload", handle)
+
+    @serve(execution, application=None, interface="executable")
+    async def result(client):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, "localhost", 8080).start()
+        except OSError:
+            await runner.cleanup()
+            pytest.skip("Port 8080 is not available")
+        try:
+            response = await client.post("/upload", data=b"x" * 200_000)
+            return response.status, await response.read()
+        finally:
+            await runner.cleanup()
+
+    assert result == (200, b"first second 200000")
+
+
+def test_upload_waits_for_the_program(execution):
+    """A program not reading its request body pauses the upload."""
+    reading = asyncio.Event()
+    uploaded = []
+
+    async def application(scope, receive, send):
+        await reading.wait()
+        size = len(await read_body(receive))
+        await start(send)
+        await send({"type": "http.response.body", "body": b"%d" % size})
+
+    async def upload():
+        for _ in range(512):
+            uploaded.append(65536)
+            yield b"x" * 65536
+
+    execution.vm.hardware_resources = MachineResources(seconds=10)
+
+    @serve(execution, application)
+    async def result(client):
+        request = asyncio.create_task(client.post("/", data=upload()))
+        await asyncio.sleep(0.5)
+        paused_at = sum(uploaded)
+        reading.set()
+        response = await request
+        return paused_at, await response.read()
+
+    paused_at, body = result
+    # The window of the stream and the buffers of the connections, not the body
+    assert paused_at < 256 * 65536
+    assert body == b"%d" % (512 * 65536)
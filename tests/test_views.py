@@ -0,0 +1,172 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from vm_supervisor.conf import settings
+from vm_supervisor.metrics import ExecutionRecord, RecordWriter
+from vm_supervisor.views import about_execution_records, about_program_usage
+
+T0 = datetime(2023, 1, 1, 12)
+
+
+def seed_records(times):
+    RecordWriter().write(
+        [
+            ExecutionRecord(
+                uuid=uuid,
+                vm_hash="vm",
+                time_defined=time,
+                time_started=time,
+                time_stopping=time + timedelta(minutes=1),
+                vcpus=1,
+                memory=128,
+            )
+            for uuid, time in times.items()
+        ]
+    )
+
+
+def request_records(*urls):
+    """Get the records of a first page, then of all the pages linked from it."""
+    app = web.Application()
+    app.router.add_get("/about/executions/records", about_execution_records)
+
+    async def main():
+        pages = []
+        async with TestClient(TestServer(app)) as client:
+            for url in urls:
+                while url:
+                    response = await client.get(url)
+                    assert response.status == 200
+                    pages.append([record["uuid"] for record in await response.json()])
+                    url = response.links.get("next", {}).get("url")
+                    if url:
+                        url = url.relative()
+        return pages
+
+    return asyncio.run(main())
+
+
+def test_records_link_to_next_page(database, monkeypatch):
+    monkeypatch.setattr(settings, "RECORDS_PAGE_SIZE", 10)
+    seed_records({"e": T0, "c": T0, "a": T0, "d": T0 + timedelta(seconds=1), "b": T0})
+
+    assert request_records("/about/executions/records?limit=2") == [
+        ["a", "b"],
+        ["c", "e"],
+        ["d"],
+    ]
+    # A full last page links to an empty one
+    assert request_records("/about/executions/records?limit=5") == [
+        ["a", "b", "c", "e", "d"],
+        [],
+    ]
+    # The limit is capped by the page size
+    assert request_records("/about/executions/records?limit=100") == [
+        ["a", "b", "c", "e", "d"]
+    ]
+
+
+def test_records_link_keeps_filters(database):
+    seed_records(
+        {uuid: T0 + timedelta(hours=index) for index, uuid in enumerate("abcd")}
+    )
+
+    url = f"/about/executions/records?limit=1&since={T0 + timedelta(hours=1)}"
+    assert request_records(f"{url}&until={T0 + timedelta(hours=3)}") == [
+        ["b"],
+        ["c"],
+        [],
+    ]
+
+
+def test_records_ndjson(database):
+    seed_records({uuid: T0 for uuid in "cab"})
+    app = web.Application()
+    app.router.add_get("/about/executions/records", about_execution_records)
+
+    async def main():
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(
+                "/about/executions/records", params={"format": "ndjson", "limit": 2}
+            )
+            assert "Link" not in response.headers
+            return await response.text()
+
+    lines = asyncio.run(main()).splitlines()
+    assert [json.loads(line)["uuid"] for line in lines] == ["a", "b", "c"]
+
+
+def test_records_invalid_filters(database):
+    app = web.Application()
+    app.router.add_get("/about/executions/records", about_execution_records)
+
+    async def main():
+        async with TestClient(TestServer(app)) as client:
+            for query in ("limit=many", "since=yesterday", "cursor=nope"):
+                response = await client.get(f"/about/executions/records?{query}")
+                assert response.status == 400, query
+
+    asyncio.run(main())
+
+
+def request_usage(*queries):
+    app = web.Application()
+    app.router.add_get("/about/usage/programs", about_program_usage)
+
+    async def main():
+        responses = []
+        async with TestClient(TestServer(app)) as client:
+            for query in queries:
+                response = await client.get("/about/usage/programs", params=query)
+                if response.status == 200:
+                    responses.append(await response.json())
+                else:
+                    responses.append(response.status)
+        return responses
+
+    return asyncio.run(main())
+
+
+def test_program_usage_rounds_bounds_outwards(database):
+    # Executions of one minute starting at 12:00, 13:00 and 14:00
+    seed_records(
+        {uuid: T0 + timedelta(hours=index) for index, uuid in enumerate("abc")}
+    )
+
+    (usage,) = request_usage({"since": "2023-01-01T12:30", "until": "2023-01-01T13:30"})
+
+    assert usage["period"] == "hour"
+    assert usage["since"] == "2023-01-01 12:00:00"
+    assert usage["until"] == "2023-01-01 14:00:00"
+    assert usage["programs"][0]["executions"] == 2
+
+
+def test_program_usage_periods(database):
+    seed_records({"a": T0, "b": T0 + timedelta(days=1)})
+
+    by_day, by_hour, exact = request_usage(
+        {"since": "2023-01-01", "until": "2023-01-02"},
+        {"since": "2023-01-01", "until": "2023-01-02", "period": "hour"},
+        {"since": "2023-01-01T12:00", "until": "2023-01-01T13:00"},
+    )
+
+    assert by_day["period"] == "day"
+    assert by_day["until"] == "2023-01-02 00:00:00"
+    assert by_day["programs"][0]["executions"] == 1
+    assert by_hour["period"] == "hour"
+    assert by_hour["programs"][0]["executions"] == 1
+    assert exact["until"] == "2023-01-01 13:00:00"
+    assert exact["programs"][0]["executions"] == 1
+
+
+def test_program_usage_invalid_filters(database):
+    assert request_usage(
+        {"since": "2023-01-02", "until": "2023-01-01"},
+        {"since": "2023-01-01T12:00", "until": "2023-01-01T12:00"},
+        {"until": "tomorrow"},
+        {"period": "week"},
+    ) == [400, 400, 400, 400]
@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+from vm_supervisor.network import vm_ids
+from vm_supervisor.network.vm_ids import VmIdAllocator
+
+
+def test_ids_are_increasing_then_reused_in_release_order():
+    allocator = VmIdAllocator(first_id=4, capacity=8)
+    assert [allocator.allocate() for _ in range(4)] == [4, 5, 6, 7]
+    with pytest.raises(ValueError):
+        allocator.allocate()
+
+    allocator.release(6)
+    allocator.release(4)
+    allocator.release(4)  # Released twice, reused once
+    assert [allocator.allocate(), allocator.allocate()] == [6, 4]
+    with pytest.raises(ValueError):
+        allocator.allocate()
+
+
+def test_churn_keeps_ids_unique_and_bounded():
+    allocator = VmIdAllocator(first_id=1, capacity=256)
+    rng = random.Random(0)
+    used = set()
+    for _ in range(100_000):
+        if used and (len(used) == 255 or rng.random() < 0.5):
+            vm_id = rng.choice(sorted(used))
+            used.remove(vm_id)
+            allocator.release(vm_id)
+        else:
+            vm_id = allocator.allocate()
+            assert vm_id not in used
+            assert 1 <= vm_id < 256
+            used.add(vm_id)
+    assert allocator.allocated == used
+    assert allocator.stats() == {"capacity": 255, "allocated": len(used)}
+
+
+def test_ids_of_existing_taps_are_kept_across_restarts(tmp_path, monkeypatch):
+    state_path = tmp_path / "vm_ids.json"
+    allocator = VmIdAllocator(first_id=1, capacity=100, state_path=state_path)
+    allocated = [allocator.allocate() for _ in range(5)]
+    assert allocated == [1, 2, 3, 4, 5]
+
+    # Only the interfaces of vm_ids 2 and 4 were left by the previous run
+    monkeypatch.setattr(vm_ids, "tap_interface_exists", lambda vm_id: vm_id in (2, 4))
+    restarted = VmIdAllocator(first_id=1, capacity=100, state_path=state_path)
+
+    assert restarted.allocated == {2, 4}
+    assert [restarted.allocate() for _ in range(4)] == [6, 7, 8, 9]
+    assert sorted(restarted.free) == [1, 3, 5]
+
+
+def test_invalid_state_file(tmp_path):
+    state_path = tmp_path / "vm_ids.json"
+    state_path.write_text("not json")
+    allocator = VmIdAllocator(first_id=1, capacity=10, state_path=state_path)
+    assert allocator.allocate() == 1
+
+
+def test_state_file_is_not_written_when_ids_are_reused(tmp_path, monkeypatch):
+    allocator = VmIdAllocator(first_id=1, capacity=4, state_path=tmp_path / "ids.json")
+    saves = []
+    monkeypatch.setattr(allocator, "save", lambda: saves.append(allocator.next_id))
+    assert [allocator.allocate() for _ in range(3)] == [1, 2, 3]
+    assert saves == [2, 3, 4]
+
+    for _ in range(100):
+        allocator.release(2)
+        assert allocator.allocate() == 2
+    assert saves == [2, 3, 4]
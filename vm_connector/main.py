@@ -48,19 +48,58 @@ async def get_message(hash_: str) -> Optional[Dict]:
         return resp_data["messages"][0] if resp_data["messages"] else None
 
 
-async def stream_url_chunks(url):
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(url)
-        resp.raise_for_status()
-        # with open(local_path, 'wb') as cache_file:
-        if True:
-            while True:
-                chunk = await resp.content.read(65536)
-                if not chunk:
-                    break
-                # cache_file.write(chunk)
-                yield chunk
+# Headers of upstream responses forwarded to the client, needed by range requests
+FORWARDED_HEADERS = ("Content-Length", "Content-Range", "Accept-Ranges")
+
+
+async def stream_url_chunks(
+    session: aiohttp.ClientSession, resp: aiohttp.ClientResponse
+):
+    try:
+        while True:
+            chunk = await resp.content.read(65536)
+            if not chunk:
+                break
+            yield chunk
         logger.debug("Download complete")
+    finally:
+        resp.release()
+        await session.close()
+
+
+async def stream_url(
+    url: str,
+    media_type: str,
+    range_header: Optional[str] = None,
+    extra_headers: Optional[Dict[str, str]] = None,
+) -> Union[StreamingResponse, Response]:
+    """Stream a file from upstream, passing the `Range` of the request through."""
+    session = aiohttp.ClientSession()
+    try:
+        resp = await session.get(
+            url, headers={"Range": range_header} if range_header else {}
+        )
+        if resp.status != 416:  # Range Not Satisfiable
+            resp.raise_for_status()
+    except Exception:
+        await session.close()
+        raise
+
+    headers = {
+        key: resp.headers[key] for key in FORWARDED_HEADERS if key in resp.headers
+    }
+    headers.update(extra_headers or {})
+    if resp.status == 416:
+        resp.release()
+        await session.close()
+        return Response(status_code=416, headers=headers)
+
+    return StreamingResponse(
+        stream_url_chunks(session, resp),
+        status_code=resp.status,
+        headers=headers,
+        media_type=media_type,
+    )
 
 
 @app.get("/download/message/{ref}")
@@ -82,7 +121,9 @@ async def download_message(ref: str) -> Union[Dict, Response]:
 
 
 @app.get("/download/code/{ref}")
-async def download_code(ref: str) -> Union[StreamingResponse, Response]:
+async def download_code(
+    ref: str, request: Request
+) -> Union[StreamingResponse, Response]:
     """
     Fetch on Aleph and return a VM code file, after checking its validity.
     Used by the VM Supervisor to download function source code.
@@ -91,15 +132,20 @@ async def download_code(ref: str) -> Union[StreamingResponse, Response]:
     :param use_latest: should the last amend to the code be used
     :return: a file containing the code file
     """
-    return await download_data(ref=ref)
+    return await download_data(ref=ref, request=request)
 
 
 @app.get("/download/data/{ref}")
-async def download_data(ref: str) -> Union[StreamingResponse, Response]:
+async def download_data(
+    ref: str, request: Request
+) -> Union[StreamingResponse, Response]:
     """
     Fetch on Aleph and return a VM data file, after checking its validity.
     Used by the VM Supervisor to download state data.
 
+    The `Range` header of the request is passed to the upstream server, allowing
+    to resume and parallelize downloads.
+
     :param ref: item_hash of the data
     :param use_latest: should the last amend to the data be used
     :return: a file containing the data
@@ -118,11 +164,22 @@ async def download_data(ref: str) -> Union[StreamingResponse, Response]:
     else:
         url = f"{settings.API_SERVER}/api/v0/storage/raw/{data_hash}"
 
-    return StreamingResponse(stream_url_chunks(url), media_type=media_type)
+    # The hash of the file is checked by the supervisor while downloading it
+    return await stream_url(
+        url,
+        media_type=media_type,
+        range_header=request.headers.get("Range"),
+        extra_headers={
+            "Aleph-Item-Hash": data_hash,
+            "Aleph-Item-Type": msg["content"]["item_type"],
+        },
+    )
 
 
 @app.get("/download/runtime/{ref}")
-async def download_runtime(ref: str) -> Union[StreamingResponse, Response]:
+async def download_runtime(
+    ref: str, request: Request
+) -> Union[StreamingResponse, Response]:
     """
     Fetch on Aleph and return a VM runtime, after checking its validity.
     Used by the VM Supervisor to download a runtime.
@@ -131,7 +188,7 @@ async def download_runtime(ref: str) -> Union[StreamingResponse, Response]:
     :param use_latest: should the last amend to the runtime be used
     :return: a file containing the runtime
     """
-    return await download_data(ref=ref)
+    return await download_data(ref=ref, request=request)
 
 
 @app.get("/compute/latest_amend/{item_hash}")
@@ -1,3 +1,4 @@
+from . import cache
 from . import conf
 from . import messages
 from . import metrics
@@ -7,6 +8,8 @@ from . import pubsub
 from . import reactor
 from . import resources
 from . import run
+from . import sessions
+from . import snapshots
 from . import status
 from . import storage
 from . import supervisor
@@ -19,6 +22,7 @@ from . import vm
 __version__ = version.__version__
 
 __all__ = (
+    "cache",
     "conf",
     "messages",
     "metrics",
@@ -28,6 +32,8 @@ __all__ = (
     "reactor",
     "resources",
     "run",
+    "sessions",
+    "snapshots",
     "status",
     "storage",
     "supervisor",
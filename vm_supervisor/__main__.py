@@ -2,9 +2,13 @@ import argparse
 import asyncio
 import logging
 import sys
+import tempfile
 import time
+from datetime import datetime
+from pathlib import Path
 from statistics import mean
 from typing import List, Tuple, Dict, Callable
+from uuid import uuid4
 
 from aiohttp.web import Response, Request
 
@@ -49,6 +53,7 @@ def parse_args(args):
     )
     parser.add_argument(
         "--prealloc",
+        "--prealloc-vm-count",
         action="store",
         type=int,
         dest="prealloc_vm_count",
@@ -101,6 +106,13 @@ def parse_args(args):
         default=False,
         help="Add extra info for profiling",
     )
+    parser.add_argument(
+        "--backfill-usage-rollups",
+        dest="backfill_usage_rollups",
+        action="store_true",
+        default=False,
+        help="Rebuild the usage rollups from the execution records and exit",
+    )
     parser.add_argument(
         "--benchmark",
         dest="benchmark",
@@ -108,6 +120,13 @@ def parse_args(args):
         default=0,
         help="Number of benchmarks to run",
     )
+    parser.add_argument(
+        "--benchmark-records",
+        dest="benchmark_records",
+        type=int,
+        default=0,
+        help="Number of execution records to save in a benchmark of the database",
+    )
     parser.add_argument(
         "-f",
         "--fake-data-program",
@@ -161,6 +180,8 @@ async def benchmark(runs: int):
     # Does not make sense in benchmarks
     settings.WATCH_FOR_MESSAGES = False
     settings.WATCH_FOR_UPDATES = False
+    # The fake request cannot receive a streamed response
+    settings.STREAM_RESPONSES = False
 
     # First test all methods
     settings.REUSE_TIMEOUT = 0.1
@@ -203,6 +224,64 @@ async def benchmark(runs: int):
     print("Event result", result)
 
 
+async def benchmark_records(count: int, rate: int = 10_000):
+    """Save execution records at `rate` per second in a temporary database, and
+    measure how long the event loop is stalled meanwhile.
+    """
+    loop = asyncio.get_event_loop()
+    stalls: List[float] = []
+    saving = True
+
+    async def monitor_loop():
+        interval = 0.001
+        while saving:
+            t0 = loop.time()
+            await asyncio.sleep(interval)
+            stalls.append(loop.time() - t0 - interval)
+
+    with tempfile.TemporaryDirectory() as directory:
+        settings.EXECUTION_DATABASE = Path(directory) / "executions.sqlite3"
+        engine = metrics.setup_engine()
+        metrics.create_tables(engine)
+
+        monitor = asyncio.create_task(monitor_loop())
+        per_tick = max(rate // 100, 1)
+        t0 = loop.time()
+        for index in range(count):
+            now = datetime.utcnow()
+            await metrics.save_record(
+                metrics.ExecutionRecord(
+                    uuid=str(uuid4()),
+                    vm_hash=f"benchmark-{index % 100}",
+                    time_defined=now,
+                    time_prepared=now,
+                    time_started=now,
+                    time_stopping=now,
+                    cpu_time_user=0.1,
+                    cpu_time_system=0.1,
+                    vcpus=1,
+                    memory=128,
+                )
+            )
+            if (index + 1) % per_tick == 0:
+                # Wait until the time of the next records
+                await asyncio.sleep(max(t0 + (index + 1) / rate - loop.time(), 0))
+        queued = loop.time() - t0
+        await metrics.stop_record_writer()
+        written = loop.time() - t0
+        saving = False
+        await monitor
+
+        saved = len(metrics.query_execution_records())
+        engine.dispose()
+
+    print(
+        f"BENCHMARK: {saved}/{count} records saved in {written:.2f}s "
+        f"({count / queued:.0f} records/s queued), event loop stalled "
+        f"avg={mean(stalls) * 1000:.2f}ms max={max(stalls) * 1000:.2f}ms"
+    )
+
+
 def main():
     args = parse_args(sys.argv[1:])
 
@@ -257,6 +336,13 @@ def main():
     if args.benchmark > 0:
         loop.run_until_complete(benchmark(runs=args.benchmark))
         print("Finished")
+    elif args.benchmark_records > 0:
+        loop.run_until_complete(benchmark_records(count=args.benchmark_records))
+    elif args.backfill_usage_rollups:
+        engine = metrics.setup_engine()
+        metrics.create_tables(engine)
+        count = metrics.backfill_rollups()
+        print(f"Usage rollups rebuilt from {count} execution records")
     elif args.do_not_run:
         logger.info("Option --do-not-run, exiting")
     else:
@@ -0,0 +1,202 @@
+"""
+Bounded caches of the files downloaded from the Aleph network.
+
+Each category of files (messages, code, runtimes, data) has its own directory and
+budget in bytes. When a budget is exceeded, the least recently used files are removed,
+except the ones used by executions that have not stopped.
+
+The hashes of the files verified while downloading them are kept in an index next to
+the files, so that the files do not need to be read again to be trusted.
+"""
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+VERIFIED_INDEX_FILENAME = ".verified.json"
+
+
+class ContentCache:
+    """Files of a category, evicted in least recently used order.
+
+    Files are identified by their name in the directory. The order of use is kept
+    across restarts using the modification time of the files.
+    """
+
+    name: str
+    directory: Path
+    max_size: int
+    entries: "OrderedDict[str, int]"  # Size of the files, least recently used first
+    verified: Dict[str, str]  # SHA-256 of the files verified when downloaded
+    size: int
+    loaded: bool
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, name: str, directory: Path, max_size: int):
+        self.name = name
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.verified = {}
+        self.size = 0
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key: str) -> Path:
+        return self.directory / key
+
+    def load(self) -> None:
+        """Index the files already present in the directory."""
+        files = []
+        if self.directory.is_dir():
+            for entry in os.scandir(self.directory):
+                if (
+                    entry.is_file()
+                    and not entry.name.endswith(".part")
+                    and not entry.name.startswith(".")
+                ):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.size = sum(self.entries.values())
+        self.verified = {}
+        try:
+            with open(self.directory / VERIFIED_INDEX_FILENAME) as index_file:
+                self.verified = {
+                    key: value
+                    for key, value in json.load(index_file).items()
+                    if key in self.entries
+                }
+        except (FileNotFoundError, ValueError):
+            pass
+        self.loaded = True
+
+    def save_verified(self) -> None:
+        tmp_path = self.directory / f"{VERIFIED_INDEX_FILENAME}.tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump(self.verified, index_file)
+        os.rename(tmp_path, self.directory / VERIFIED_INDEX_FILENAME)
+
+    def lookup(self, key: str) -> bool:
+        """Return whether the file is in the cache and mark it as recently used."""
+        if not self.loaded:
+            self.load()
+        if key in self.entries:
+            try:
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                # Removed by something else than the cache
+                self.size -= self.entries.pop(key)
+                self.verified.pop(key, None)
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def add(self, key: str, verified_hash: Optional[str] = None) -> None:
+        """Account for a file that was just written in the directory."""
+        if not self.loaded:
+            self.load()
+        size = os.path.getsize(self.path(key))
+        self.size += size - self.entries.get(key, 0)
+        self.entries[key] = size
+        self.entries.move_to_end(key)
+        if verified_hash:
+            self.verified[key] = verified_hash
+            self.save_verified()
+
+    def evict(self, pinned: Set[str]) -> None:
+        """Remove the least recently used files until the cache fits in its budget."""
+        if not self.loaded:
+            self.load()
+        if self.size <= self.max_size:
+            return
+        for key in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if key in pinned:
+                continue
+            logger.debug(f"Evicting {key} from the {self.name} cache")
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.size -= self.entries.pop(key)
+            self.verified.pop(key, None)
+            self.evictions += 1
+        self.save_verified()
+
+        if self.size > self.max_size:
+            logger.warning(
+                f"The {self.name} cache exceeds its budget with files in use: "
+                f"{self.size} > {self.max_size} bytes"
+            )
+
+    def stats(self) -> Dict:
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "files": len(self.entries),
+            "verified_files": len(self.verified),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class CacheManager:
+    caches: Dict[str, ContentCache]
+
+    def __init__(self):
+        self.caches = {
+            "message": ContentCache(
+                "message", settings.MESSAGE_CACHE, settings.MAX_MESSAGE_CACHE_SIZE
+            ),
+            "code": ContentCache(
+                "code", settings.CODE_CACHE, settings.MAX_CODE_CACHE_SIZE
+            ),
+            "runtime": ContentCache(
+                "runtime", settings.RUNTIME_CACHE, settings.MAX_RUNTIME_CACHE_SIZE
+            ),
+            "data": ContentCache(
+                "data", settings.DATA_CACHE, settings.MAX_DATA_CACHE_SIZE
+            ),
+        }
+
+    def get_cache(self, path: Path) -> Optional[ContentCache]:
+        """Return the cache containing a file, if any."""
+        for cache in self.caches.values():
+            if path.parent == cache.directory:
+                return cache
+        return None
+
+    def evict(self, pinned: Dict[str, Set[str]]) -> None:
+        """Evict files from all caches, except the `pinned` names of each category."""
+        for name, cache in self.caches.items():
+            cache.evict(pinned.get(name, set()))
+
+    def stats(self) -> Dict:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+
+_cache_manager: Optional[CacheManager] = None
+
+
+def get_cache_manager() -> CacheManager:
+    """Return the cache manager, created once the settings are loaded."""
+    global _cache_manager
+    if _cache_manager is None:
+        _cache_manager = CacheManager()
+    return _cache_manager
@@ -0,0 +1,190 @@
+"""
+Resource accounting of the VMs with cgroups v2.
+
+Each Firecracker process is moved to its own cgroup under `CGROUP_ROOT`. The counters
+of the cgroup cover all the threads of the VM and remain readable after the process
+has exited, until the cgroup is removed. A single task samples the cgroups of all VMs
+periodically to follow their memory usage.
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from .conf import settings
+from .utils import create_task_log_exceptions
+
+logger = logging.getLogger(__name__)
+
+CONTROLLERS = ("cpu", "memory", "io")
+
+
+@dataclass
+class ResourceUsage:
+    cpu_time_user: Optional[float] = None  # Seconds
+    cpu_time_system: Optional[float] = None
+    io_read_count: Optional[int] = None
+    io_write_count: Optional[int] = None
+    io_read_bytes: Optional[int] = None
+    io_write_bytes: Optional[int] = None
+    memory_current: Optional[int] = None  # Bytes
+    memory_peak: Optional[int] = None
+
+
+def read_key_values(path: Path) -> Dict[str, int]:
+    """Parse a flat keyed file such as `cpu.stat`."""
+    values = {}
+    for line in path.read_text().splitlines():
+        key, value = line.split()
+        values[key] = int(value)
+    return values
+
+
+def read_io_stat(path: Path) -> Dict[str, int]:
+    """Sum the counters of all devices from `io.stat`."""
+    totals: Dict[str, int] = {}
+    for line in path.read_text().splitlines():
+        # "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0"
+        for field in line.split()[1:]:
+            key, value = field.split("=")
+            totals[key] = totals.get(key, 0) + int(value)
+    return totals
+
+
+def enable_controllers(path: Path) -> None:
+    """Enable the controllers available for the children of a cgroup."""
+    available = (path / "cgroup.controllers").read_text().split()
+    for controller in CONTROLLERS:
+        if controller not in available:
+            continue
+        try:
+            (path / "cgroup.subtree_control").write_text(f"+{controller}")
+        except OSError as error:
+            logger.warning(f"Cannot enable the {controller} controller: {error}")
+
+
+class VmCgroup:
+    path: Path
+    memory_peak: int  # Highest memory usage sampled
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.memory_peak = 0
+
+    @classmethod
+    def create(cls, root: Path, name: str, pid: int) -> "VmCgroup":
+        if not root.exists():
+            root.mkdir()
+            enable_controllers(root.parent)
+            enable_controllers(root)
+        path = root / name
+        path.mkdir(exist_ok=True)
+        (path / "cgroup.procs").write_text(str(pid))
+        return cls(path)
+
+    def read(self) -> ResourceUsage:
+        usage = ResourceUsage()
+        cpu = read_key_values(self.path / "cpu.stat")
+        usage.cpu_time_user = cpu["user_usec"] / 1_000_000
+        usage.cpu_time_system = cpu["system_usec"] / 1_000_000
+        io_stat_path = self.path / "io.stat"
+        if io_stat_path.exists():
+            io = read_io_stat(io_stat_path)
+            usage.io_read_count = io.get("rios", 0)
+            usage.io_write_count = io.get("wios", 0)
+            usage.io_read_bytes = io.get("rbytes", 0)
+            usage.io_write_bytes = io.get("wbytes", 0)
+        memory_current_path = self.path / "memory.current"
+        if memory_current_path.exists():
+            usage.memory_current = int(memory_current_path.read_text())
+            self.memory_peak = max(self.memory_peak, usage.memory_current)
+            # Only available on recent kernels
+            memory_peak_path = self.path / "memory.peak"
+            if memory_peak_path.exists():
+                self.memory_peak = max(
+                    self.memory_peak, int(memory_peak_path.read_text())
+                )
+            usage.memory_peak = self.memory_peak
+        return usage
+
+    def to_dict(self) -> Dict:
+        return {"path": str(self.path), "memory_peak": self.memory_peak}
+
+    def remove(self) -> None:
+        try:
+            os.rmdir(self.path)
+        except OSError as error:
+            logger.warning(f"Cannot remove cgroup {self.path}: {error}")
+
+
+class CgroupSampler:
+    """Samples the cgroups of the VMs from a single task, while there are any."""
+
+    cgroups: Dict[int, VmCgroup]  # By vm_id
+    last_usage: Dict[int, ResourceUsage]
+    task: Optional[asyncio.Task] = None
+
+    def __init__(self):
+        self.cgroups = {}
+        self.last_usage = {}
+
+    def add(self, vm_id: int, pid: int) -> Optional[VmCgroup]:
+        """Move the process of a VM to its own cgroup, if cgroups are available."""
+        try:
+            cgroup = VmCgroup.create(settings.CGROUP_ROOT, f"vm{vm_id}", pid)
+        except OSError as error:
+            logger.warning(f"Cannot create the cgroup of vm {vm_id}: {error}")
+            return None
+        self.cgroups[vm_id] = cgroup
+        if not self.task:
+            self.task = create_task_log_exceptions(self.run(), name="cgroup sampler")
+        return cgroup
+
+    def close(self, vm_id: int) -> Optional[ResourceUsage]:
+        """Read the final usage of a VM after its process has exited, and remove
+        its cgroup."""
+        cgroup = self.cgroups.pop(vm_id, None)
+        last_usage = self.last_usage.pop(vm_id, None)
+        if not cgroup:
+            return None
+        try:
+            usage = cgroup.read()
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"Cannot read the usage of vm {vm_id}: {error}")
+            usage = last_usage
+        cgroup.remove()
+        return usage
+
+    def sample(self) -> None:
+        for vm_id, cgroup in list(self.cgroups.items()):
+            try:
+                self.last_usage[vm_id] = cgroup.read()
+            except (OSError, ValueError, KeyError) as error:
+                logger.debug(f"Cannot sample the usage of vm {vm_id}: {error}")
+
+    async def run(self) -> None:
+        try:
+            while self.cgroups:
+                await asyncio.sleep(settings.CGROUP_SAMPLE_INTERVAL)
+                self.sample()
+        finally:
+            self.task = None
+
+
+_cgroup_sampler: Optional[CgroupSampler] = None
+
+
+def get_cgroup_sampler() -> Optional[CgroupSampler]:
+    """Return the cgroup sampler, if the host supports cgroups v2."""
+    global _cgroup_sampler
+    if not settings.USE_CGROUPS:
+        return None
+    if _cgroup_sampler is None:
+        if not (settings.CGROUP_ROOT.parent / "cgroup.controllers").exists():
+            logger.warning("Cgroups v2 are not available, not using them")
+            settings.USE_CGROUPS = False
+            return None
+        _cgroup_sampler = CgroupSampler()
+    return _cgroup_sampler
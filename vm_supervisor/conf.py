@@ -19,6 +19,11 @@ class DnsResolver(str, Enum):
     resolvectl = "resolvectl"  # Systemd-resolved, common on Ubuntu
 
 
+class NftablesLayout(str, Enum):
+    chains = "chains"  # A chain per VM, jumped to from the supervisor chains
+    sets = "sets"  # A set of the VM interfaces, matched by the supervisor chains
+
+
 def etc_resolv_conf_dns_servers():
     with open("/etc/resolv.conf", "r") as resolv_file:
         for line in resolv_file.readlines():
@@ -70,6 +75,16 @@ class Settings(BaseSettings):
     START_ID_INDEX: int = 4
     PREALLOC_VM_COUNT: int = 0
     REUSE_TIMEOUT: float = 60 * 60.0
+    # Idle VMs are stopped earlier, least recently used first, beyond this count or
+    # when the memory available on the host drops below this amount in MiB
+    MAX_IDLE_EXECUTIONS: Optional[int] = None
+    MIN_AVAILABLE_MEMORY: int = 0
+    # Budgets of the host for VMs, in MiB of memory and vcpus. Default to the memory
+    # of the host and to 4 vcpus per CPU.
+    CAPACITY_MEMORY: Optional[int] = None
+    CAPACITY_VCPUS: Optional[int] = None
+    # Seconds a new VM waits for capacity before being rejected
+    ADMISSION_TIMEOUT: float = 10.0
     WATCH_FOR_MESSAGES = True
     WATCH_FOR_UPDATES = True
 
@@ -85,6 +100,9 @@ class Settings(BaseSettings):
     IPV4_ADDRESS_POOL = "172.16.0.0/12"
     IPV4_NETWORK_SIZE = 24
     NFTABLES_CHAIN_PREFIX = "aleph"
+    NFTABLES_LAYOUT: NftablesLayout = NftablesLayout.chains
+    # Tap interfaces created in advance and recycled after use by VMs
+    TAP_POOL_SIZE = 0
 
     DNS_RESOLUTION: Optional[DnsResolver] = DnsResolver.resolv_conf
     DNS_NAMESERVERS: Optional[List[str]] = None
@@ -93,24 +111,70 @@ class Settings(BaseSettings):
     JAILER_PATH = "/opt/firecracker/jailer"
     LINUX_PATH = "/opt/firecracker/vmlinux.bin"
     INIT_TIMEOUT: float = 20.0
+    # Forward HTTP responses from VMs to clients as they are produced
+    STREAM_RESPONSES = True
+    # Restore VMs from Firecracker snapshots instead of booting them when possible.
+    # Snapshots are taken from preallocated VMs without internet, see PREALLOC_VM_COUNT
+    USE_SNAPSHOTS = False
+    # Reclaim the memory of VMs idle for this many seconds with a balloon device,
+    # leaving them BALLOON_RESERVED_MEMORY MiB. Disabled when None.
+    BALLOON_IDLE_DELAY: Optional[float] = None
+    BALLOON_RESERVED_MEMORY: int = 64
+    BALLOON_STATS_INTERVAL: int = 5  # Seconds
+    # Pin the vcpus of VMs to CPUs of a single NUMA node, leaving the first CPUs of
+    # the host to the supervisor
+    CPU_PINNING = False
+    SUPERVISOR_RESERVED_CPUS = 1
+    # Account for the resources of each VM in its own cgroup v2
+    USE_CGROUPS = False
+    CGROUP_ROOT = Path("/sys/fs/cgroup/aleph-vm.slice")
+    CGROUP_SAMPLE_INTERVAL: float = 10.0  # Seconds
 
     CONNECTOR_URL = Url("http://localhost:4021")
 
+    # Shared HTTP session used to reach the connector and the VMs
+    HTTP_CONNECTION_LIMIT = 100
+    HTTP_CONNECTION_LIMIT_PER_HOST = 20
+    HTTP_KEEPALIVE_TIMEOUT = 30.0
+    HTTP_CONNECT_TIMEOUT = 10.0
+    HTTP_READ_TIMEOUT = 60.0
+
     CACHE_ROOT = Path("/var/cache/aleph/vm")
     MESSAGE_CACHE = CACHE_ROOT / "message"
     CODE_CACHE = CACHE_ROOT / "code"
     RUNTIME_CACHE = CACHE_ROOT / "runtime"
     DATA_CACHE = CACHE_ROOT / "data"
+    # Budgets of the caches, least recently used files are evicted above them
+    MAX_MESSAGE_CACHE_SIZE = 100_000_000  # 100 MB
+    MAX_CODE_CACHE_SIZE = 5_000_000_000  # 5 GB
+    MAX_RUNTIME_CACHE_SIZE = 10_000_000_000  # 10 GB
+    MAX_DATA_CACHE_SIZE = 10_000_000_000  # 10 GB
+    # Interrupted downloads are resumed from where they stopped
+    DOWNLOAD_ATTEMPTS = 3
+    # Large files are downloaded in parallel ranges
+    DOWNLOAD_PARALLEL_RANGES = 4
+    DOWNLOAD_PARALLEL_MIN_SIZE = 64_000_000  # 64 MB
 
     EXECUTION_ROOT = Path("/var/lib/aleph/vm")
     EXECUTION_DATABASE = EXECUTION_ROOT / "executions.sqlite3"
     EXECUTION_LOG_ENABLED = False
+    # Execution records are written to the database in batches
+    RECORD_BATCH_SIZE = 100
+    RECORD_FLUSH_INTERVAL: float = 1.0  # Seconds
+    # Maximum number of records per page on /about/executions/records
+    RECORDS_PAGE_SIZE = 1000
     EXECUTION_LOG_DIRECTORY = EXECUTION_ROOT / "executions"
+    # Ids of the VMs in use, kept across restarts
+    VM_ID_STATE_FILE = EXECUTION_ROOT / "vm_ids.json"
 
     PERSISTENT_VOLUMES_DIR = EXECUTION_ROOT / "volumes" / "persistent"
+    SNAPSHOTS_DIRECTORY = EXECUTION_ROOT / "snapshots"
+    MAX_SNAPSHOTS_SIZE = 10_000_000_000  # 10 GB
 
     MAX_PROGRAM_ARCHIVE_SIZE = 10_000_000  # 10 MB
     MAX_DATA_ARCHIVE_SIZE = 10_000_000  # 10 MB
+    # Bodies of requests streamed to VMs, see `STREAM_RESPONSES`
+    MAX_REQUEST_BODY_SIZE = 100_000_000  # 100 MB
 
     # hashlib.sha256(b"secret-token").hexdigest()
     ALLOCATION_TOKEN_HASH = (
@@ -1,11 +1,15 @@
+import asyncio
 import logging
 import os
+import queue
+import threading
 from os.path import join
-from typing import Iterable, Optional
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from uuid import UUID
 
-from sqlalchemy import Column, Integer, String, Float, DateTime
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
+from sqlalchemy import and_, create_engine, event, func, inspect, or_
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -19,19 +23,62 @@ logger = logging.getLogger(__name__)
 Base = declarative_base()
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Readers do not block the writer and commits do not wait for a full sync
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 def setup_engine():
     global Session
-    engine = create_engine(f"sqlite:///{settings.EXECUTION_DATABASE}", echo=True)
+    engine = create_engine(f"sqlite:///{settings.EXECUTION_DATABASE}")
+    event.listen(engine, "connect", set_sqlite_pragmas)
     Session = sessionmaker(bind=engine)
     return engine
 
 
 def create_tables(engine: Engine):
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    add_missing_indexes(engine)
+
+
+def add_missing_columns(engine: Engine):
+    """Add the nullable columns introduced since the tables were created."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                logger.info(f"Adding column {column.name} to table {table.name}")
+                column_type = column.type.compile(engine.dialect)
+                with engine.begin() as connection:
+                    connection.execute(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}"
+                    )
+
+
+def add_missing_indexes(engine: Engine):
+    """Create the indexes introduced since the tables were created."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Creating index {index.name}")
+                index.create(engine)
 
 
 class ExecutionRecord(Base):
     __tablename__ = "records"
+    __table_args__ = (
+        # Pagination by time, optionally for a VM
+        Index("ix_records_time_defined_uuid", "time_defined", "uuid"),
+        Index("ix_records_vm_hash_time_defined", "vm_hash", "time_defined", "uuid"),
+    )
 
     uuid = Column(String, primary_key=True)
     vm_hash = Column(String, nullable=False)
@@ -49,6 +96,8 @@ class ExecutionRecord(Base):
     io_read_bytes: Optional[int] = Column(Integer, nullable=True)
     io_write_bytes: Optional[int] = Column(Integer, nullable=True)
 
+    memory_peak: Optional[int] = Column(Integer, nullable=True)  # Bytes
+
     vcpus = Column(Integer, nullable=False)
     memory = Column(Integer, nullable=False)
 
@@ -59,6 +108,186 @@ class ExecutionRecord(Base):
         return {c.name: getattr(self, c.name) for c in self.__table__.c}
 
 
+class UsageRollup(Base):
+    """Usage of the executions of a program per hour or day, for billing."""
+
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        Index("ix_usage_rollups_period_start", "period", "period_start"),
+    )
+
+    vm_hash = Column(String, primary_key=True)
+    period = Column(String, primary_key=True)  # "hour" or "day"
+    period_start = Column(DateTime, primary_key=True)
+
+    executions = Column(Integer, nullable=False)  # Stopped during the period
+    duration = Column(Float, nullable=False)  # Seconds of execution
+    cpu_time = Column(Float, nullable=False)  # Seconds, user and system
+    io_read_bytes = Column(Integer, nullable=False)
+    io_write_bytes = Column(Integer, nullable=False)
+    memory_hours = Column(Float, nullable=False)  # MiB of memory allocated x hours
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.c}
+
+
+ROLLUP_PERIODS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+ROLLUP_FIELDS = (
+    "executions",
+    "duration",
+    "cpu_time",
+    "io_read_bytes",
+    "io_write_bytes",
+    "memory_hours",
+)
+
+RollupKey = Tuple[str, str, datetime]  # vm_hash, period, period_start
+
+
+def period_start(time: datetime, period: str) -> datetime:
+    time = time.replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        time = time.replace(hour=0)
+    return time
+
+
+def split_in_periods(
+    start: datetime, end: datetime, period: str
+) -> Iterator[Tuple[datetime, float]]:
+    """Start of the periods between `start` and `end`, with the seconds in each."""
+    current = period_start(start, period)
+    while True:
+        next_start = current + ROLLUP_PERIODS[period]
+        yield current, (min(end, next_start) - max(start, current)).total_seconds()
+        if next_start >= end:
+            return
+        current = next_start
+
+
+def aggregate_records(
+    records: Iterable[ExecutionRecord],
+) -> Dict[RollupKey, Dict[str, float]]:
+    """Usage of the records per program and period.
+
+    The usage of an execution is split between the periods it ran in, proportionally
+    to its duration in each. It counts as an execution of the period it stopped in.
+    """
+    rollups: Dict[RollupKey, Dict[str, float]] = {}
+    for record in records:
+        start = record.time_started or record.time_defined
+        end = max(record.time_stopping or start, start)
+        total = (end - start).total_seconds()
+        cpu_time = (record.cpu_time_user or 0) + (record.cpu_time_system or 0)
+        for period in ROLLUP_PERIODS:
+            for current, seconds in split_in_periods(start, end, period):
+                share = seconds / total if total else 1.0
+                key = (record.vm_hash, period, current)
+                rollup = rollups.setdefault(key, dict.fromkeys(ROLLUP_FIELDS, 0))
+                rollup["duration"] += seconds
+                rollup["cpu_time"] += cpu_time * share
+                rollup["io_read_bytes"] += (record.io_read_bytes or 0) * share
+                rollup["io_write_bytes"] += (record.io_write_bytes or 0) * share
+                rollup["memory_hours"] += record.memory * seconds / 3600
+            # The last period, in which the execution stopped
+            rollup["executions"] += 1
+    return rollups
+
+
+def add_to_rollups(session, records: Iterable[ExecutionRecord]) -> None:
+    """Add the usage of records to the rollups, in the transaction of the session."""
+    rollups = aggregate_records(records)
+    if not rollups:
+        return
+    # Load the rollups to update at once, not with a query and a flush per rollup
+    with session.no_autoflush:
+        existing = {
+            (rollup.vm_hash, rollup.period, rollup.period_start): rollup
+            for rollup in session.query(UsageRollup).filter(
+                UsageRollup.vm_hash.in_({vm_hash for vm_hash, _, _ in rollups}),
+                UsageRollup.period_start.in_({start for _, _, start in rollups}),
+            )
+        }
+    for key, values in rollups.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            vm_hash, period, start = key
+            rollup = UsageRollup(vm_hash=vm_hash, period=period, period_start=start)
+            rollup.executions = rollup.duration = rollup.cpu_time = 0
+            rollup.io_read_bytes = rollup.io_write_bytes = rollup.memory_hours = 0
+            session.add(rollup)
+        rollup.executions += values["executions"]
+        rollup.duration += values["duration"]
+        rollup.cpu_time += values["cpu_time"]
+        rollup.io_read_bytes += round(values["io_read_bytes"])
+        rollup.io_write_bytes += round(values["io_write_bytes"])
+        rollup.memory_hours += values["memory_hours"]
+
+
+def backfill_rollups() -> int:
+    """Rebuild the rollups from all the execution records. Blocking.
+
+    Run while the supervisor is stopped, records saved in the meantime would be
+    counted twice. The rollups are replaced in a single transaction, so they are
+    left unchanged if the rebuild fails.
+    """
+    session = Session()
+    try:
+        session.query(UsageRollup).delete()
+        count = 0
+        after: Optional[RecordCursor] = None
+        while True:
+            records = query_execution_records(
+                after=after, limit=settings.RECORDS_PAGE_SIZE
+            )
+            if not records:
+                break
+            add_to_rollups(session, records)
+            # The rollups of the next pages are looked up in the database
+            session.flush()
+            count += len(records)
+            after = (records[-1].time_defined, records[-1].uuid)
+        session.commit()
+        return count
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def query_program_usage(
+    period: str,
+    since: datetime,
+    until: datetime,
+    vm_hash: Optional[str] = None,
+) -> List[Dict]:
+    """Usage of each program over the periods from `since` to `until`. Blocking."""
+    session = Session()
+    try:
+        query = session.query(
+            UsageRollup.vm_hash,
+            *(func.sum(getattr(UsageRollup, field)) for field in ROLLUP_FIELDS),
+        ).filter(
+            UsageRollup.period == period,
+            UsageRollup.period_start >= since,
+            UsageRollup.period_start < until,
+        )
+        if vm_hash:
+            query = query.filter(UsageRollup.vm_hash == vm_hash)
+        return [
+            {"vm_hash": row[0], **dict(zip(ROLLUP_FIELDS, row[1:]))}
+            for row in query.group_by(UsageRollup.vm_hash)
+        ]
+    finally:
+        session.close()
+
+
+async def get_program_usage(**filters) -> List[Dict]:
+    """Usage of each program from the rollups, see `query_program_usage`."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: query_program_usage(**filters))
+
+
 async def save_execution_data(execution_uuid: UUID, execution_data: str):
     """Save the execution data in a file on disk"""
     os.makedirs(settings.EXECUTION_LOG_DIRECTORY, exist_ok=True)
@@ -67,20 +296,162 @@ async def save_execution_data(execution_uuid: UUID, execution_data: str):
         fd.write(execution_data)
 
 
+class RecordWriter:
+    """Write the execution records to the database in batches, from a thread.
+
+    The usage rollups are updated in the same transaction.
+
+    Records are written in a single transaction once `RECORD_BATCH_SIZE` are
+    queued, or `RECORD_FLUSH_INTERVAL` seconds after the first one. When a batch
+    fails, its records are written one by one so that a single invalid record does
+    not lose the others.
+    """
+
+    records: "queue.Queue[Optional[ExecutionRecord]]"  # None stops the thread
+    thread: threading.Thread
+
+    def __init__(self):
+        self.records = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name="record writer", daemon=True
+        )
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Write the records queued and stop the thread. Blocking."""
+        self.records.put(None)
+        self.thread.join()
+
+    def next_batch(self) -> Optional[List[ExecutionRecord]]:
+        """Wait for records to write, return None once stopped."""
+        record = self.records.get()
+        if record is None:
+            return None
+        batch = [record]
+        stopping = False
+        try:
+            while len(batch) < settings.RECORD_BATCH_SIZE:
+                record = self.records.get(timeout=settings.RECORD_FLUSH_INTERVAL)
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+        except queue.Empty:
+            pass
+        if stopping:
+            # Stop after this batch
+            self.records.put(None)
+        return batch
+
+    def commit(self, records: List[ExecutionRecord]) -> None:
+        session = Session()
+        try:
+            session.add_all(records)
+            add_to_rollups(session, records)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def write(self, batch: List[ExecutionRecord]) -> None:
+        try:
+            self.commit(batch)
+            return
+        except Exception as error:
+            if len(batch) == 1:
+                logger.exception(f"Could not save execution record: {error}")
+                return
+            logger.warning(
+                f"Could not save {len(batch)} execution records at once, "
+                f"saving them one by one: {error}"
+            )
+        for record in batch:
+            try:
+                self.commit([record])
+            except Exception as error:
+                logger.exception(
+                    f"Could not save execution record {record.uuid}: {error}"
+                )
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.write(batch)
+
+
+_record_writer: Optional[RecordWriter] = None
+
+
 async def save_record(record: ExecutionRecord):
-    """Record the resource usage in database"""
-    session = Session()
-    try:
-        session.add(record)
-        session.commit()
-    finally:
-        session.close()
+    """Record the resource usage in database, in the background"""
+    global _record_writer
+    if _record_writer is None:
+        _record_writer = RecordWriter()
+        _record_writer.start()
+    _record_writer.records.put(record)
+
+
+async def stop_record_writer(app=None):
+    """Write the records still queued, on shutdown."""
+    global _record_writer
+    if _record_writer:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, _record_writer.stop)
+        _record_writer = None
+
 
+RecordCursor = Tuple[datetime, str]  # Time defined and uuid of the last record
 
-async def get_execution_records() -> Iterable[ExecutionRecord]:
-    """Get the execution records from the database."""
+
+def query_execution_records(
+    vm_hash: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[RecordCursor] = None,
+    limit: Optional[int] = None,
+) -> List[ExecutionRecord]:
+    """Get execution records from the database, ordered by time defined. Blocking.
+
+    `since` is inclusive and `until` exclusive. Use the time defined and uuid of the
+    last record as `after` to get the next records.
+    """
     session = Session()
     try:
-        return session.query(ExecutionRecord).all()
+        query = session.query(ExecutionRecord)
+        if vm_hash:
+            query = query.filter(ExecutionRecord.vm_hash == vm_hash)
+        if since:
+            query = query.filter(ExecutionRecord.time_defined >= since)
+        if until:
+            query = query.filter(ExecutionRecord.time_defined < until)
+        if after:
+            time_defined, uuid = after
+            query = query.filter(
+                or_(
+                    ExecutionRecord.time_defined > time_defined,
+                    and_(
+                        ExecutionRecord.time_defined == time_defined,
+                        ExecutionRecord.uuid > uuid,
+                    ),
+                )
+            )
+        query = query.order_by(ExecutionRecord.time_defined, ExecutionRecord.uuid)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
     finally:
         session.close()
+
+
+async def get_execution_records(**filters) -> Iterable[ExecutionRecord]:
+    """Get the execution records from the database, see `query_execution_records`."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, lambda: query_execution_records(**filters)
+    )
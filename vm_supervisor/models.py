@@ -1,19 +1,19 @@
 import asyncio
 import logging
-import sys
 import uuid
-from asyncio import Task
 from dataclasses import dataclass
 from datetime import datetime
-from typing import NewType, Optional, Dict
+from typing import NewType, Optional, Dict, AsyncIterator, Tuple, AsyncIterable
 
 from aleph_message.models import ProgramContent
 
+from .cgroups import ResourceUsage
 from .conf import settings
 from .metrics import save_record, save_execution_data, ExecutionRecord
 from .pubsub import PubSub
 from .utils import dumps_for_json, create_task_log_exceptions
 from .vm import AlephFirecrackerVM
+from .vm.channel import FrameType
 from .vm.firecracker_microvm import AlephFirecrackerResources
 from .network.interfaces import TapInterface
 
@@ -31,6 +31,7 @@ class VmExecutionTimes:
     started_at: Optional[datetime] = None
     stopping_at: Optional[datetime] = None
     stopped_at: Optional[datetime] = None
+    last_used_at: Optional[datetime] = None
 
     def to_dict(self):
         return self.__dict__
@@ -55,7 +56,6 @@ class VmExecution:
     ready_event: asyncio.Event
     concurrent_runs: int
     runs_done_event: asyncio.Event
-    expire_task: Optional[asyncio.Task] = None
     update_task: Optional[asyncio.Task] = None
 
     persistent: bool = False
@@ -120,46 +120,36 @@ class VmExecution:
             await vm.start()
             await vm.configure()
             await vm.start_guest_api()
-            self.times.started_at = datetime.now()
+            self.times.started_at = self.times.last_used_at = datetime.now()
             self.ready_event.set()
             return vm
         except Exception:
             await vm.teardown()
             raise
 
-    def stop_after_timeout(self, timeout: float = 5.0) -> Optional[Task]:
-        if self.persistent:
-            logger.debug("VM marked as long running. Ignoring timeout.")
-            return
-
-        if self.expire_task:
-            logger.debug("VM already has a timeout. Extending it.")
-            self.expire_task.cancel()
-
-        if sys.version_info.major >= 3 and sys.version_info.minor >= 8:
-            # Task can be named
-            vm_id: str = str(self.vm.vm_id if self.vm else None)
-            self.expire_task = create_task_log_exceptions(
-                self.expire(timeout), name=f"expire {vm_id}"
-            )
-        else:
-            self.expire_task = create_task_log_exceptions(self.expire(timeout))
-        return self.expire_task
-
-    async def expire(self, timeout: float) -> None:
-        """Coroutine that will stop the VM after 'timeout' seconds."""
-        await asyncio.sleep(timeout)
-        assert self.times.started_at
-        if self.times.stopping_at or self.times.stopped_at:
-            return
-        await self.stop()
-
-    def cancel_expiration(self) -> bool:
-        if self.expire_task:
-            self.expire_task.cancel()
-            return True
-        else:
-            return False
+    async def create_from_preallocated(
+        self, vm: AlephFirecrackerVM
+    ) -> AlephFirecrackerVM:
+        """Use a VM already booted by the pool and only send it the program configuration."""
+        if not self.resources:
+            raise ValueError("Execution resources must be configured first")
+        self.times.starting_at = datetime.now()
+        vm.assign(
+            vm_hash=self.vm_hash,
+            resources=self.resources,
+            enable_networking=self.program.environment.internet,
+            hardware_resources=self.program.resources,
+        )
+        self.vm = vm
+        try:
+            await vm.configure()
+            await vm.start_guest_api()
+            self.times.started_at = self.times.last_used_at = datetime.now()
+            self.ready_event.set()
+            return vm
+        except Exception:
+            await vm.teardown()
+            raise
 
     def cancel_update(self) -> bool:
         if self.update_task:
@@ -174,10 +164,13 @@ class VmExecution:
             return
         await self.all_runs_complete()
         self.times.stopping_at = datetime.now()
-        await self.record_usage()
+        if settings.EXECUTION_LOG_ENABLED:
+            await save_execution_data(
+                execution_uuid=self.uuid, execution_data=self.to_json()
+            )
         await self.vm.teardown()
         self.times.stopped_at = datetime.now()
-        self.cancel_expiration()
+        await self.record_usage()
         self.cancel_update()
 
     def start_watching_for_updates(self, pubsub: PubSub):
@@ -210,61 +203,58 @@ class VmExecution:
             await self.runs_done_event.wait()
 
     async def record_usage(self):
-        if settings.EXECUTION_LOG_ENABLED:
-            await save_execution_data(
-                execution_uuid=self.uuid, execution_data=self.to_json()
-            )
-        pid_info = self.vm.to_dict()
-        # Handle cases when the process cannot be accessed
-        if pid_info and pid_info.get("process"):
-            await save_record(
-                ExecutionRecord(
-                    uuid=str(self.uuid),
-                    vm_hash=self.vm_hash,
-                    time_defined=self.times.defined_at,
-                    time_prepared=self.times.prepared_at,
-                    time_started=self.times.started_at,
-                    time_stopping=self.times.stopping_at,
-                    cpu_time_user=pid_info["process"]["cpu_times"].user,
-                    cpu_time_system=pid_info["process"]["cpu_times"].system,
-                    io_read_count=pid_info["process"]["io_counters"][0],
-                    io_write_count=pid_info["process"]["io_counters"][1],
-                    io_read_bytes=pid_info["process"]["io_counters"][2],
-                    io_write_bytes=pid_info["process"]["io_counters"][3],
-                    vcpus=self.vm.hardware_resources.vcpus,
-                    memory=self.vm.hardware_resources.memory,
-                )
-            )
-        else:
-            # The process cannot be accessed. It has probably already exited
-            # and its metrics are not available anymore.
-            await save_record(
-                ExecutionRecord(
-                    uuid=str(self.uuid),
-                    vm_hash=self.vm_hash,
-                    time_defined=self.times.defined_at,
-                    time_prepared=self.times.prepared_at,
-                    time_started=self.times.started_at,
-                    time_stopping=self.times.stopping_at,
-                    cpu_time_user=None,
-                    cpu_time_system=None,
-                    io_read_count=None,
-                    io_write_count=None,
-                    io_read_bytes=None,
-                    io_write_bytes=None,
-                    vcpus=self.vm.hardware_resources.vcpus,
-                    memory=self.vm.hardware_resources.memory,
-                )
+        """Record the usage of the VM, read when it was torn down."""
+        # None when the usage of the process could not be read
+        usage = self.vm.usage or ResourceUsage()
+        await save_record(
+            ExecutionRecord(
+                uuid=str(self.uuid),
+                vm_hash=self.vm_hash,
+                time_defined=self.times.defined_at,
+                time_prepared=self.times.prepared_at,
+                time_started=self.times.started_at,
+                time_stopping=self.times.stopping_at,
+                cpu_time_user=usage.cpu_time_user,
+                cpu_time_system=usage.cpu_time_system,
+                io_read_count=usage.io_read_count,
+                io_write_count=usage.io_write_count,
+                io_read_bytes=usage.io_read_bytes,
+                io_write_bytes=usage.io_write_bytes,
+                memory_peak=usage.memory_peak,
+                vcpus=self.vm.hardware_resources.vcpus,
+                memory=self.vm.hardware_resources.memory,
             )
+        )
 
     async def run_code(self, scope: dict = None) -> bytes:
         if not self.vm:
             raise ValueError("The VM has not been created yet")
         self.concurrent_runs += 1
         self.runs_done_event.clear()
+        self.times.last_used_at = datetime.now()
         try:
             return await self.vm.run_code(scope=scope)
         finally:
+            self.times.last_used_at = datetime.now()
+            self.concurrent_runs -= 1
+            if self.concurrent_runs == 0:
+                self.runs_done_event.set()
+
+    async def run_code_streaming(
+        self, scope: dict, receive: AsyncIterable[Dict]
+    ) -> AsyncIterator[Tuple[FrameType, bytes]]:
+        if not self.vm:
+            raise ValueError("The VM has not been created yet")
+        self.concurrent_runs += 1
+        self.runs_done_event.clear()
+        self.times.last_used_at = datetime.now()
+        try:
+            async for frame in self.vm.run_code_streaming(
+                scope=scope, receive=receive
+            ):
+                yield frame
+        finally:
+            self.times.last_used_at = datetime.now()
             self.concurrent_runs -= 1
             if self.concurrent_runs == 0:
                 self.runs_done_event.set()
@@ -1,15 +1,33 @@
+import asyncio
 import json
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Callable, Any
 import logging
 
 from nftables import Nftables
 from functools import lru_cache
 
-from ..conf import settings
+from ..conf import settings, NftablesLayout
 from .interfaces import TapInterface
 
 logger = logging.getLogger(__name__)
 
+# Tables of the base chains, by hook and family, found when initializing nftables.
+# Avoids listing the full ruleset when VMs are started and stopped.
+base_chain_tables: Dict[Tuple[str, str], str] = {}
+
+# Rules jumping to the chains of each VM, deleted by handle when the VM stops
+vm_jump_rules: Dict[int, List[Dict]] = {}
+
+# libnftables is not thread safe, all commands are run by the same worker thread
+nftables_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nftables")
+
+
+async def run_in_nftables_thread(func: Callable, *args) -> Any:
+    """Run a function of this module without blocking the event loop."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(nftables_executor, func, *args)
+
 
 @lru_cache()
 def get_customized_nftables() -> Nftables:
@@ -19,11 +37,15 @@ def get_customized_nftables() -> Nftables:
     nft.set_service_output(False)
     nft.set_reversedns_output(False)
     nft.set_numeric_proto_output(True)
+    # Return the objects added with their handle
+    nft.set_echo_output(True)
+    nft.set_handle_output(True)
     return nft
 
 
-def execute_json_nft_commands(commands: List[Dict]) -> int:
-    """Executes a list of nftables commands, and returns the exit status"""
+def run_json_nft_commands(commands: List[Dict]) -> Tuple[int, Dict]:
+    """Executes a list of nftables commands as a single transaction, and returns
+    the exit status and the objects added"""
     nft = get_customized_nftables()
     commands_dict = {"nftables": commands}
     try:
@@ -37,6 +59,12 @@ def execute_json_nft_commands(commands: List[Dict]) -> int:
     if return_code != 0:
         logger.error(f"Failed to add nftables rules: {error}")
 
+    return return_code, output or {"nftables": []}
+
+
+def execute_json_nft_commands(commands: List[Dict]) -> int:
+    """Executes a list of nftables commands, and returns the exit status"""
+    return_code, _ = run_json_nft_commands(commands)
     return return_code
 
 
@@ -76,8 +104,11 @@ def get_base_chains_for_hook(hook: str, family: str = "ip") -> List:
 
 
 def get_table_for_hook(hook: str, family: str = "ip") -> str:
-    chains = get_base_chains_for_hook(hook, family)
-    table = chains.pop()["chain"]["table"]
+    table = base_chain_tables.get((hook, family))
+    if not table:
+        chains = get_base_chains_for_hook(hook, family)
+        table = chains.pop()["chain"]["table"]
+        base_chain_tables[(hook, family)] = table
     return table
 
 
@@ -128,6 +159,7 @@ def initialize_nftables() -> None:
                 f"Multiple base chains for an nftables basechain are not supported: {hook}"
             )
         base_chains[hook] = chains.pop()["chain"]
+        base_chain_tables[(hook, "ip")] = base_chains[hook]["table"]
 
     add_chain(
         "ip",
@@ -198,6 +230,9 @@ def initialize_nftables() -> None:
         }
     )
 
+    if settings.NFTABLES_LAYOUT == NftablesLayout.sets:
+        commands += vm_interfaces_set_commands()
+
     execute_json_nft_commands(commands)
     return
 
@@ -207,6 +242,15 @@ def teardown_nftables() -> None:
     logger.debug("Tearing down nftables setup")
     remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-nat")
     remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-filter")
+    if settings.NFTABLES_LAYOUT == NftablesLayout.sets:
+        execute_json_nft_commands(
+            [
+                {"delete": {"set": {"family": "ip", "table": table, "name": name}}}
+                for table, name in get_vm_interfaces_sets()
+            ]
+        )
+    base_chain_tables.clear()
+    vm_jump_rules.clear()
     return
 
 
@@ -275,22 +319,92 @@ def remove_chain(name: str) -> int:
     return execute_json_nft_commands(commands)
 
 
+def chain_command(family: str, table: str, name: str) -> Dict:
+    return {"add": {"chain": {"family": family, "table": table, "name": name}}}
+
+
+def jump_rule_command(table: str, chain: str, target: str) -> Dict:
+    return {
+        "add": {
+            "rule": {
+                "family": "ip",
+                "table": table,
+                "chain": chain,
+                "expr": [{"jump": {"target": target}}],
+            }
+        }
+    }
+
+
+def masquerading_rule_command(vm_id: int, interface: TapInterface, table: str) -> Dict:
+    return {
+        "add": {
+            "rule": {
+                "family": "ip",
+                "table": table,
+                "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}",
+                "expr": [
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"meta": {"key": "iifname"}},
+                            "right": interface.device_name,
+                        }
+                    },
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"meta": {"key": "oifname"}},
+                            "right": settings.NETWORK_INTERFACE,
+                        }
+                    },
+                    {"masquerade": None},
+                ],
+            }
+        }
+    }
+
+
+def forward_rule_to_external_command(
+    vm_id: int, interface: TapInterface, table: str
+) -> Dict:
+    return {
+        "add": {
+            "rule": {
+                "family": "ip",
+                "table": table,
+                "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}",
+                "expr": [
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"meta": {"key": "iifname"}},
+                            "right": interface.device_name,
+                        }
+                    },
+                    {
+                        "match": {
+                            "op": "==",
+                            "left": {"meta": {"key": "oifname"}},
+                            "right": settings.NETWORK_INTERFACE,
+                        }
+                    },
+                    {"accept": None},
+                ],
+            }
+        }
+    }
+
+
 def add_postrouting_chain(name: str) -> int:
     """Adds a chain and creates a rule from the base chain with the postrouting hook.
     Returns the exit code from executing the nftables commands"""
     table = get_table_for_hook("postrouting")
     add_chain("ip", table, name)
     command = [
-        {
-            "add": {
-                "rule": {
-                    "family": "ip",
-                    "table": table,
-                    "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-nat",
-                    "expr": [{"jump": {"target": name}}],
-                }
-            }
-        }
+        jump_rule_command(
+            table, f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-nat", name
+        )
     ]
     return execute_json_nft_commands(command)
 
@@ -301,16 +415,9 @@ def add_forward_chain(name: str) -> int:
     table = get_table_for_hook("forward")
     add_chain("ip", table, name)
     command = [
-        {
-            "add": {
-                "rule": {
-                    "family": "ip",
-                    "table": table,
-                    "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-filter",
-                    "expr": [{"jump": {"target": name}}],
-                }
-            }
-        }
+        jump_rule_command(
+            table, f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-filter", name
+        )
     ]
     return execute_json_nft_commands(command)
 
@@ -319,35 +426,7 @@ def add_masquerading_rule(vm_id: int, interface: TapInterface) -> int:
     """Creates a rule for the VM with the specified id to allow outbound traffic to be masqueraded (NAT)
     Returns the exit code from executing the nftables commands"""
     table = get_table_for_hook("postrouting")
-    command = [
-        {
-            "add": {
-                "rule": {
-                    "family": "ip",
-                    "table": table,
-                    "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}",
-                    "expr": [
-                        {
-                            "match": {
-                                "op": "==",
-                                "left": {"meta": {"key": "iifname"}},
-                                "right": interface.device_name,
-                            }
-                        },
-                        {
-                            "match": {
-                                "op": "==",
-                                "left": {"meta": {"key": "oifname"}},
-                                "right": settings.NETWORK_INTERFACE,
-                            }
-                        },
-                        {"masquerade": None},
-                    ],
-                }
-            }
-        }
-    ]
-
+    command = [masquerading_rule_command(vm_id, interface, table)]
     return execute_json_nft_commands(command)
 
 
@@ -355,47 +434,177 @@ def add_forward_rule_to_external(vm_id: int, interface: TapInterface) -> int:
     """Creates a rule for the VM with the specified id to allow outbound traffic
     Returns the exit code from executing the nftables commands"""
     table = get_table_for_hook("forward")
-    command = [
+    command = [forward_rule_to_external_command(vm_id, interface, table)]
+    return execute_json_nft_commands(command)
+
+
+def get_vm_interfaces_sets() -> List[Tuple[str, str]]:
+    """Table and name of the sets of VM interfaces, one in each table of the base
+    chains, used with the `sets` layout."""
+    name = f"{settings.NFTABLES_CHAIN_PREFIX}-vm-interfaces"
+    tables = dict.fromkeys(
+        (get_table_for_hook("postrouting"), get_table_for_hook("forward"))
+    )
+    return [(table, name) for table in tables]
+
+
+def vm_interfaces_set_commands() -> List[Dict]:
+    """Create the sets of VM interfaces and the rules allowing their outbound traffic,
+    replacing the chains per VM."""
+    commands: List[Dict] = [
         {
             "add": {
-                "rule": {
-                    "family": "ip",
-                    "table": table,
-                    "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}",
-                    "expr": [
-                        {
-                            "match": {
-                                "op": "==",
-                                "left": {"meta": {"key": "iifname"}},
-                                "right": interface.device_name,
-                            }
-                        },
-                        {
-                            "match": {
-                                "op": "==",
-                                "left": {"meta": {"key": "oifname"}},
-                                "right": settings.NETWORK_INTERFACE,
-                            }
-                        },
-                        {"accept": None},
-                    ],
-                }
+                "set": {"family": "ip", "table": table, "name": name, "type": "ifname"}
             }
         }
+        for table, name in get_vm_interfaces_sets()
+    ]
+    set_name = f"{settings.NFTABLES_CHAIN_PREFIX}-vm-interfaces"
+    for hook, chain, verdict in (
+        ("postrouting", "supervisor-nat", {"masquerade": None}),
+        ("forward", "supervisor-filter", {"accept": None}),
+    ):
+        commands.append(
+            {
+                "add": {
+                    "rule": {
+                        "family": "ip",
+                        "table": get_table_for_hook(hook),
+                        "chain": f"{settings.NFTABLES_CHAIN_PREFIX}-{chain}",
+                        "expr": [
+                            {
+                                "match": {
+                                    "op": "==",
+                                    "left": {"meta": {"key": "iifname"}},
+                                    "right": f"@{set_name}",
+                                }
+                            },
+                            {
+                                "match": {
+                                    "op": "==",
+                                    "left": {"meta": {"key": "oifname"}},
+                                    "right": settings.NETWORK_INTERFACE,
+                                }
+                            },
+                            verdict,
+                        ],
+                    }
+                }
+            }
+        )
+    return commands
+
+
+def vm_setup_commands(vm_id: int, interface: TapInterface) -> List[Dict]:
+    """Commands allowing the outbound traffic of a VM, in the configured layout."""
+    if settings.NFTABLES_LAYOUT == NftablesLayout.sets:
+        return [
+            {
+                "add": {
+                    "element": {
+                        "family": "ip",
+                        "table": table,
+                        "name": name,
+                        "elem": [interface.device_name],
+                    }
+                }
+            }
+            for table, name in get_vm_interfaces_sets()
+        ]
+
+    nat_table = get_table_for_hook("postrouting")
+    filter_table = get_table_for_hook("forward")
+    nat_chain = f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}"
+    filter_chain = f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}"
+    return [
+        chain_command("ip", nat_table, nat_chain),
+        chain_command("ip", filter_table, filter_chain),
+        jump_rule_command(
+            nat_table, f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-nat", nat_chain
+        ),
+        jump_rule_command(
+            filter_table,
+            f"{settings.NFTABLES_CHAIN_PREFIX}-supervisor-filter",
+            filter_chain,
+        ),
+        masquerading_rule_command(vm_id, interface, nat_table),
+        forward_rule_to_external_command(vm_id, interface, filter_table),
     ]
 
-    return execute_json_nft_commands(command)
+
+def vm_teardown_commands(
+    vm_id: int, interface: TapInterface, jump_rules: List[Dict]
+) -> List[Dict]:
+    """Commands removing what `vm_setup_commands` added, in the configured layout.
+
+    `jump_rules` are the rules to the chains of the VM, in the `chains` layout.
+    """
+    if settings.NFTABLES_LAYOUT == NftablesLayout.sets:
+        return [
+            {
+                "delete": {
+                    "element": {
+                        "family": "ip",
+                        "table": table,
+                        "name": name,
+                        "elem": [interface.device_name],
+                    }
+                }
+            }
+            for table, name in get_vm_interfaces_sets()
+        ]
+
+    commands: List[Dict] = [{"delete": {"rule": rule}} for rule in jump_rules]
+    for hook, name in (
+        ("postrouting", f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}"),
+        ("forward", f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}"),
+    ):
+        chain = {"family": "ip", "table": get_table_for_hook(hook), "name": name}
+        commands.append({"flush": {"chain": chain}})
+        commands.append({"delete": {"chain": chain}})
+    return commands
+
+
+def get_added_jump_rules(output: Dict) -> List[Dict]:
+    """Return the references of the jump rules in the output of added objects."""
+    rules = []
+    for entry in output.get("nftables", []):
+        rule = entry.get("add", {}).get("rule") if isinstance(entry, dict) else None
+        if rule and "handle" in rule and "jump" in rule["expr"][0]:
+            rules.append(
+                {
+                    "family": rule["family"],
+                    "table": rule["table"],
+                    "chain": rule["chain"],
+                    "handle": rule["handle"],
+                }
+            )
+    return rules
 
 
 def setup_nftables_for_vm(vm_id: int, interface: TapInterface) -> None:
-    """Sets up chains for filter and nat purposes specific to this VM, and makes sure those chains are jumped to"""
-    add_postrouting_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}")
-    add_forward_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}")
-    add_masquerading_rule(vm_id, interface)
-    add_forward_rule_to_external(vm_id, interface)
+    """Allows the outbound traffic of the VM, in a single transaction.
+
+    With the `chains` layout, sets up chains for filter and nat purposes specific to
+    this VM and makes sure those chains are jumped to. With the `sets` layout, adds
+    the interface of the VM to the sets matched by the supervisor chains.
+    """
+    return_code, output = run_json_nft_commands(vm_setup_commands(vm_id, interface))
+    if return_code == 0 and settings.NFTABLES_LAYOUT == NftablesLayout.chains:
+        jump_rules = get_added_jump_rules(output)
+        if len(jump_rules) == 2:
+            vm_jump_rules[vm_id] = jump_rules
 
 
-def teardown_nftables_for_vm(vm_id: int) -> None:
+def teardown_nftables_for_vm(vm_id: int, interface: TapInterface) -> None:
     """Remove all nftables rules related to the specified VM"""
-    remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}")
-    remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}")
+    jump_rules = vm_jump_rules.pop(vm_id, None)
+    if settings.NFTABLES_LAYOUT == NftablesLayout.chains and not jump_rules:
+        # The handles of the rules are unknown, look for them in the ruleset
+        remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-nat-{vm_id}")
+        remove_chain(f"{settings.NFTABLES_CHAIN_PREFIX}-vm-filter-{vm_id}")
+        return
+
+    execute_json_nft_commands(
+        vm_teardown_commands(vm_id, interface, jump_rules=jump_rules or [])
+    )
@@ -1,8 +1,17 @@
 import logging
+from pathlib import Path
+from typing import Optional, Tuple
 
-from .firewall import initialize_nftables, teardown_nftables, setup_nftables_for_vm
-from .interfaces import TapInterface
-from .ipaddresses import IPv4NetworkWithInterfaces
+from .firewall import (
+    initialize_nftables,
+    teardown_nftables,
+    setup_nftables_for_vm,
+    teardown_nftables_for_vm,
+    run_in_nftables_thread,
+)
+from .interfaces import TapInterface, TapPool
+from .ipaddresses import IPv4NetworkWithInterfaces, SubnetAllocator
+from .vm_ids import VmIdAllocator
 
 logger = logging.getLogger(__name__)
 
@@ -18,10 +27,12 @@ class Network:
     address_pool: IPv4NetworkWithInterfaces = IPv4NetworkWithInterfaces("172.16.0.0/12")
     network_size: int
     external_interface: str
+    tap_pool: TapPool
+    subnets: SubnetAllocator  # Subnets of the address pool used by tap interfaces
+    vm_ids: VmIdAllocator
 
     def get_network_for_tap(self, vm_id: int) -> IPv4NetworkWithInterfaces:
-        subnets = list(self.address_pool.subnets(new_prefix=self.network_size))
-        return subnets[vm_id]
+        return self.address_pool.subnet(vm_id, self.network_size)
 
     def enable_ipv4_forwarding(self) -> None:
         """Saves the hosts IPv4 forwarding state, and if it was disabled, enables it"""
@@ -38,7 +49,15 @@ class Network:
             with open("/proc/sys/net/ipv4/ip_forward", "w") as f:
                 f.write(str(self.ipv4_forward_state_before_setup))
 
-    def __init__(self, vm_address_pool_range: str, vm_network_size: int, external_interface: str) -> None:
+    def __init__(
+        self,
+        vm_address_pool_range: str,
+        vm_network_size: int,
+        external_interface: str,
+        tap_pool_size: int = 0,
+        first_vm_id: int = 0,
+        vm_id_state_path: Optional[Path] = None,
+    ) -> None:
         """Sets up the Network class with some information it needs so future function calls work as expected"""
         self.address_pool = IPv4NetworkWithInterfaces(vm_address_pool_range)
         if not self.address_pool.is_private:
@@ -46,7 +65,14 @@ class Network:
                 f"Using a network range that is not private: {self.address_pool}"
             )
         self.network_size = vm_network_size
+        self.subnets = SubnetAllocator(self.address_pool, vm_network_size)
+        self.vm_ids = VmIdAllocator(
+            first_id=first_vm_id,
+            capacity=self.subnets.count,
+            state_path=vm_id_state_path,
+        )
         self.external_interface = external_interface
+        self.tap_pool = TapPool(max_size=tap_pool_size)
         self.enable_ipv4_forwarding()
         initialize_nftables()
 
@@ -56,8 +82,53 @@ class Network:
 
     async def create_tap(self, vm_id: int) -> TapInterface:
         """ Create TAP interface to be used by VM
+
+        Raises `ValueError` if the subnet of the VM is already used by another tap.
         """
-        interface = TapInterface(f"vmtap{vm_id}", self.get_network_for_tap(vm_id))
-        await interface.create()
-        setup_nftables_for_vm(vm_id, interface)
+        interface = TapInterface(f"vmtap{vm_id}", self.subnets.allocate(vm_id))
+        try:
+            await interface.create()
+        except Exception:
+            self.subnets.release(interface.ip_network)
+            self.vm_ids.release(vm_id)
+            raise
+        interface.subnets = self.subnets
+        interface.vm_ids = self.vm_ids
+        if self.tap_pool.max_size > 0:
+            interface.pool = self.tap_pool
+        await run_in_nftables_thread(setup_nftables_for_vm, vm_id, interface)
         return interface
+
+    def claim_tap(self) -> Optional[Tuple[int, TapInterface]]:
+        """Return the vm_id and interface of a tap created in advance, if any."""
+        return self.tap_pool.claim()
+
+    async def fill_tap_pool(self, vm_id: int) -> None:
+        """Create a tap in advance, to be claimed by a VM."""
+        interface = await self.create_tap(vm_id)
+        if not self.tap_pool.recycle(vm_id, interface):
+            await delete_tap(vm_id, interface)
+
+    async def empty_tap_pool(self) -> None:
+        while True:
+            claimed = self.tap_pool.claim()
+            if not claimed:
+                return
+            await delete_tap(*claimed)
+
+
+async def delete_tap(vm_id: int, interface: TapInterface) -> None:
+    """Remove the firewall rules of a tap interface, then the interface itself."""
+    await run_in_nftables_thread(teardown_nftables_for_vm, vm_id, interface)
+    await interface.delete()
+    if interface.subnets:
+        interface.subnets.release(interface.ip_network)
+    if interface.vm_ids:
+        interface.vm_ids.release(vm_id)
+
+
+async def release_tap(vm_id: int, interface: TapInterface) -> None:
+    """Recycle a tap interface that is not used anymore, or delete it."""
+    if interface.pool and interface.pool.recycle(vm_id, interface):
+        return
+    await delete_tap(vm_id, interface)
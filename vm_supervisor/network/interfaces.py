@@ -1,16 +1,48 @@
 import asyncio
+import errno
 from ipaddress import IPv4Interface
-from subprocess import run
 import logging
+from typing import Dict, Optional, Tuple
 
-from .ipaddresses import IPv4NetworkWithInterfaces
+from pyroute2 import IPRoute, NetlinkError
+
+from .ipaddresses import IPv4NetworkWithInterfaces, SubnetAllocator
+from .vm_ids import VmIdAllocator
 
 logger = logging.getLogger(__name__)
 
+# The device may still be busy right after the VM using it has stopped
+TAP_DELETE_ATTEMPTS = 5
+TAP_DELETE_RETRY_DELAY = 0.02
+
+
+def create_tap_device(device_name: str, host_ip: IPv4Interface) -> None:
+    """Create a tap device with the address of the host, using netlink."""
+    with IPRoute() as ipr:
+        ipr.link("add", ifname=device_name, kind="tuntap", mode="tap")
+        index = ipr.link_lookup(ifname=device_name)[0]
+        ipr.addr(
+            "add",
+            index=index,
+            address=str(host_ip.ip),
+            prefixlen=host_ip.network.prefixlen,
+        )
+        ipr.link("set", index=index, state="up")
+
+
+def delete_tap_device(device_name: str) -> None:
+    with IPRoute() as ipr:
+        indexes = ipr.link_lookup(ifname=device_name)
+        if indexes:
+            ipr.link("del", index=indexes[0])
+
 
 class TapInterface:
     device_name: str
     ip_network: IPv4NetworkWithInterfaces
+    pool: Optional["TapPool"] = None  # Where the interface is recycled after use
+    subnets: Optional[SubnetAllocator] = None  # Where the subnet is released after use
+    vm_ids: Optional[VmIdAllocator] = None  # Where the vm_id is released after use
 
     def __init__(
         self, device_name: str, ip_network: IPv4NetworkWithInterfaces
@@ -28,24 +60,58 @@ class TapInterface:
 
     async def create(self):
         logger.debug("Create network interface")
-
-        run(["/usr/bin/ip", "tuntap", "add", self.device_name, "mode", "tap"])
-        run(
-            [
-                "/usr/bin/ip",
-                "addr",
-                "add",
-                str(self.host_ip.with_prefixlen),
-                "dev",
-                self.device_name,
-            ]
+        # Netlink calls are blocking
+        await asyncio.get_event_loop().run_in_executor(
+            None, create_tap_device, self.device_name, self.host_ip
         )
-        run(["/usr/bin/ip", "link", "set", self.device_name, "up"])
         logger.debug(f"Network interface created: {self.device_name}")
 
     async def delete(self) -> None:
         """Asks the firewall to teardown any rules for the VM with id provided.
         Then removes the interface from the host."""
         logger.debug(f"Removing interface {self.device_name}")
-        await asyncio.sleep(0.1)  # Avoids Device/Resource busy bug
-        run(["ip", "tuntap", "del", self.device_name, "mode", "tap"])
+        loop = asyncio.get_event_loop()
+        for attempt in range(TAP_DELETE_ATTEMPTS):
+            try:
+                await loop.run_in_executor(None, delete_tap_device, self.device_name)
+                return
+            except NetlinkError as error:
+                if error.code != errno.EBUSY:
+                    logger.warning(
+                        f"Could not remove interface {self.device_name}: {error}"
+                    )
+                    return
+            await asyncio.sleep(TAP_DELETE_RETRY_DELAY * 2**attempt)
+        logger.warning(f"Could not remove interface {self.device_name}: busy")
+
+
+class TapPool:
+    """Tap interfaces created in advance, with their address and firewall rules.
+
+    VMs claim them instead of creating their own interface, and they are recycled
+    once the VM has stopped.
+    """
+
+    max_size: int
+    interfaces: Dict[int, TapInterface]  # By vm_id
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.interfaces = {}
+
+    def __len__(self) -> int:
+        return len(self.interfaces)
+
+    def claim(self) -> Optional[Tuple[int, TapInterface]]:
+        """Return the vm_id and the interface of an available tap, if any."""
+        if not self.interfaces:
+            return None
+        return self.interfaces.popitem()
+
+    def recycle(self, vm_id: int, interface: TapInterface) -> bool:
+        """Keep an interface that is not used anymore, if the pool is not full."""
+        if len(self.interfaces) >= self.max_size:
+            return False
+        logger.debug(f"Recycling interface {interface.device_name}")
+        self.interfaces[vm_id] = interface
+        return True
@@ -21,3 +21,67 @@ class IPv4NetworkWithInterfaces(IPv4Network):
             if broadcast + n < network:
                 raise IndexError("address out of range")
             return IPv4Interface((broadcast + n, self.prefixlen))
+
+    def subnet_count(self, new_prefix: int) -> int:
+        """Number of subnets of the network with the prefix `new_prefix`."""
+        if not self.prefixlen <= new_prefix <= self.max_prefixlen:
+            raise ValueError(f"Invalid prefix length for subnets: {new_prefix}")
+        return 2 ** (new_prefix - self.prefixlen)
+
+    def subnet(self, index: int, new_prefix: int) -> "IPv4NetworkWithInterfaces":
+        """Return `list(self.subnets(new_prefix=new_prefix))[index]`, without
+        enumerating the subnets."""
+        if not 0 <= index < self.subnet_count(new_prefix):
+            raise IndexError("subnet out of range")
+        subnet_size = 2 ** (self.max_prefixlen - new_prefix)
+        network = int(self.network_address) + index * subnet_size
+        return IPv4NetworkWithInterfaces((network, new_prefix))
+
+    def subnet_index(self, subnet: IPv4Network) -> int:
+        """Return the index of a subnet, as in `self.subnet(index, ...)`."""
+        if not subnet.subnet_of(self):
+            raise ValueError(f"{subnet} is not a subnet of {self}")
+        subnet_size = 2 ** (self.max_prefixlen - subnet.prefixlen)
+        return (int(subnet.network_address) - int(self.network_address)) // subnet_size
+
+
+class SubnetAllocator:
+    """Tracks the subnets of a network that are in use, in a bitmap.
+
+    The index of the subnet of a tap interface is its vm_id, chosen by the
+    `VmIdAllocator`. The bitmap guards against two interfaces using the same subnet.
+    """
+
+    network: IPv4NetworkWithInterfaces
+    new_prefix: int
+    count: int
+    bitmap: bytearray
+    allocated: int
+
+    def __init__(self, network: IPv4NetworkWithInterfaces, new_prefix: int):
+        self.network = network
+        self.new_prefix = new_prefix
+        self.count = network.subnet_count(new_prefix)
+        self.bitmap = bytearray((self.count + 7) // 8)
+        self.allocated = 0
+
+    def is_allocated(self, index: int) -> bool:
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def allocate(self, index: int) -> IPv4NetworkWithInterfaces:
+        """Mark the subnet at `index` as used and return it.
+
+        Raises `ValueError` if the subnet is already in use.
+        """
+        subnet = self.network.subnet(index, self.new_prefix)
+        if self.is_allocated(index):
+            raise ValueError(f"Subnet {subnet} is already in use")
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.allocated += 1
+        return subnet
+
+    def release(self, subnet: IPv4Network) -> None:
+        index = self.network.subnet_index(subnet)
+        if self.is_allocated(index):
+            self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.allocated -= 1
@@ -0,0 +1,101 @@
+"""
+Allocation of the ids of the VMs.
+
+The id of a VM names its tap interface and selects its subnet in the address pool, so
+ids are bounded by the number of subnets. Ids are handed out in increasing order at
+first, which eases debugging, then the ids released the longest time ago are reused.
+
+The highest id handed out is saved in a file, so that the ids of the tap interfaces
+left by a previous run of the supervisor are not reused while these interfaces still
+exist. The file is only written while new ids are handed out, not when ids are reused.
+"""
+import json
+import logging
+import os
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+def tap_interface_exists(vm_id: int) -> bool:
+    return os.path.exists(f"/sys/class/net/vmtap{vm_id}")
+
+
+class VmIdAllocator:
+    first_id: int
+    capacity: int  # Ids are lower than the capacity
+    state_path: Optional[Path]
+    next_id: int  # Lowest id never allocated
+    allocated: Set[int]
+    free: Deque[int]  # Released ids, least recently released first
+
+    def __init__(self, first_id: int, capacity: int, state_path: Optional[Path] = None):
+        if first_id >= capacity:
+            raise ValueError(f"No vm_id available below {capacity}")
+        self.first_id = first_id
+        self.capacity = capacity
+        self.state_path = state_path
+        self.next_id = first_id
+        self.allocated = set()
+        self.free = deque()
+        if state_path:
+            self.load()
+
+    def load(self) -> None:
+        """Keep the ids of the previous run whose tap interface still exists."""
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning(f"Ignoring invalid vm_id state file {self.state_path}")
+            return
+        self.next_id = min(max(state["next_id"], self.first_id), self.capacity)
+        self.allocated = {
+            vm_id
+            for vm_id in range(self.first_id, self.next_id)
+            if tap_interface_exists(vm_id)
+        }
+        if self.allocated:
+            logger.warning(
+                f"Not reusing the ids of stale tap interfaces: {sorted(self.allocated)}"
+            )
+        self.free = deque(
+            vm_id
+            for vm_id in range(self.first_id, self.next_id)
+            if vm_id not in self.allocated
+        )
+
+    def save(self) -> None:
+        tmp_path = self.state_path.with_suffix(".tmp")
+        os.makedirs(self.state_path.parent, exist_ok=True)
+        with open(tmp_path, "w") as state_file:
+            json.dump({"next_id": self.next_id}, state_file)
+        os.rename(tmp_path, self.state_path)
+
+    def allocate(self) -> int:
+        if self.next_id < self.capacity:
+            vm_id = self.next_id
+            self.next_id += 1
+            if self.state_path:
+                self.save()
+        elif self.free:
+            vm_id = self.free.popleft()
+        else:
+            raise ValueError("No available value for vm_id.")
+        self.allocated.add(vm_id)
+        return vm_id
+
+    def release(self, vm_id: int) -> None:
+        if vm_id in self.allocated:
+            self.allocated.remove(vm_id)
+            self.free.append(vm_id)
+
+    def stats(self) -> Dict:
+        return {
+            "capacity": self.capacity - self.first_id,
+            "allocated": len(self.allocated),
+        }
@@ -0,0 +1,155 @@
+"""
+Placement of the vcpus of the VMs on the CPUs of the host.
+
+Each VM is assigned as many CPUs as it has vcpus, within a single NUMA node when the
+VM fits in one, on the least loaded CPUs. The Firecracker process is then pinned to
+these CPUs, so that its vcpu threads do not move between nodes and the memory they
+touch first is allocated on their node.
+
+The first `SUPERVISOR_RESERVED_CPUS` CPUs are left to the supervisor, which is pinned
+to them so that it does not compete with the vcpus of the VMs.
+"""
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+NODES_PATH = Path("/sys/devices/system/node")
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Parse a list of CPUs in the format of the kernel, such as "0-3,8-11"."""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+@dataclass
+class NumaNode:
+    id: Optional[int]
+    cpus: List[int]
+
+
+@dataclass
+class Placement:
+    node: Optional[int]  # None when the VM spans several nodes
+    cpus: List[int]
+
+
+def read_topology(nodes_path: Path = NODES_PATH) -> List[NumaNode]:
+    """NUMA nodes of the host with the CPUs usable by the supervisor.
+
+    Hosts without NUMA information are considered as a single node.
+    """
+    usable = os.sched_getaffinity(0)
+    nodes = []
+    if nodes_path.is_dir():
+        for node_path in sorted(nodes_path.glob("node[0-9]*")):
+            cpus = parse_cpu_list((node_path / "cpulist").read_text())
+            cpus = [cpu for cpu in cpus if cpu in usable]
+            if cpus:
+                nodes.append(NumaNode(id=int(node_path.name[4:]), cpus=cpus))
+    if not nodes:
+        nodes.append(NumaNode(id=None, cpus=sorted(usable)))
+    return nodes
+
+
+class CpuPlacer:
+    nodes: List[NumaNode]
+    reserved: List[int]  # CPUs left to the supervisor
+    load: Dict[int, int]  # Vcpus placed per CPU
+
+    def __init__(self, nodes: List[NumaNode], reserved_cpus: int = 0):
+        all_cpus = [cpu for node in nodes for cpu in node.cpus]
+        # Keep at least one CPU for the VMs
+        self.reserved = all_cpus[: max(min(reserved_cpus, len(all_cpus) - 1), 0)]
+        self.nodes = [
+            NumaNode(
+                id=node.id,
+                cpus=[cpu for cpu in node.cpus if cpu not in self.reserved],
+            )
+            for node in nodes
+        ]
+        self.nodes = [node for node in self.nodes if node.cpus]
+        self.load = {cpu: 0 for node in self.nodes for cpu in node.cpus}
+
+    def node_load(self, node: NumaNode, vcpus: int) -> float:
+        return (sum(self.load[cpu] for cpu in node.cpus) + vcpus) / len(node.cpus)
+
+    def least_loaded(self, cpus: Iterable[int], count: int) -> List[int]:
+        return sorted(sorted(cpus, key=lambda cpu: self.load[cpu])[:count])
+
+    def place(self, vcpus: int) -> Placement:
+        """Assign CPUs to a VM, in the least loaded node it fits in."""
+        vcpus = max(vcpus, 1)
+        nodes = [node for node in self.nodes if len(node.cpus) >= vcpus]
+        if nodes:
+            node = min(nodes, key=lambda node: self.node_load(node, vcpus))
+            placement = Placement(
+                node=node.id, cpus=self.least_loaded(node.cpus, vcpus)
+            )
+        else:
+            # Larger than any node
+            placement = Placement(node=None, cpus=self.least_loaded(self.load, vcpus))
+        for cpu in placement.cpus:
+            self.load[cpu] += 1
+        return placement
+
+    def release(self, placement: Placement) -> None:
+        for cpu in placement.cpus:
+            self.load[cpu] -= 1
+
+
+def apply_placement(pid: int, placement: Placement) -> None:
+    """Pin all the threads of a process to the CPUs of the placement.
+
+    Threads created afterwards inherit the affinity of their parent thread.
+    """
+    try:
+        thread_ids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except FileNotFoundError:
+        logger.debug(f"Process {pid} not found, cannot apply its placement")
+        return
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(thread_id, placement.cpus)
+        except ProcessLookupError:
+            pass
+
+
+def pin_supervisor(placer: CpuPlacer) -> None:
+    """Pin the supervisor to the CPUs reserved for it.
+
+    Processes started afterwards inherit this affinity, the Firecracker ones are
+    then moved to the CPUs of their placement.
+    """
+    if not placer.reserved:
+        logger.warning("No CPU reserved for the supervisor, it is not pinned")
+        return
+    os.sched_setaffinity(0, placer.reserved)
+    logger.info(f"Supervisor pinned to CPUs {placer.reserved}")
+
+
+_cpu_placer: Optional[CpuPlacer] = None
+
+
+def get_cpu_placer() -> CpuPlacer:
+    """Return the CPU placer, created once the settings are loaded."""
+    global _cpu_placer
+    if _cpu_placer is None:
+        _cpu_placer = CpuPlacer(
+            read_topology(), reserved_cpus=settings.SUPERVISOR_RESERVED_CPUS
+        )
+    return _cpu_placer
@@ -1,87 +1,261 @@
 import asyncio
 import logging
-from typing import Dict, Optional, Iterable
+from typing import Dict, Optional, Iterable, List, Set, Tuple
 
 from aleph_message.models import ProgramContent, ProgramMessage
+from aleph_message.models.program import Encoding, MachineResources
 
+from .cache import get_cache_manager
 from .conf import settings
 from .models import VmHash, VmExecution
+from .reaper import ExecutionReaper
+from .scheduler import CapacityScheduler
+from .utils import create_task_log_exceptions
+from .vm import AlephFirecrackerVM
+from .vm.firecracker_microvm import AlephFirecrackerResources
 from vm_supervisor.network.hostnetwork import Network
+from vm_supervisor.network.interfaces import TapInterface
 
 logger = logging.getLogger(__name__)
 
+# Runtime ref, vcpus, memory and internet access of preallocated VMs
+PreallocKey = Tuple[str, int, int, bool]
+
+
+def get_prealloc_key(program: ProgramContent) -> Optional[PreallocKey]:
+    """Return the key of the preallocated VMs compatible with a program, if any.
+
+    Preallocated VMs are booted with the kernel and the runtime only. Programs that
+    require additional drives (squashfs code, volumes) cannot use them. The network
+    interface is attached at boot as well, so VMs with and without internet access
+    are kept apart.
+    """
+    if program.code.encoding == Encoding.squashfs or program.volumes:
+        return None
+    return (
+        program.runtime.ref,
+        program.resources.vcpus,
+        program.resources.memory,
+        program.environment.internet,
+    )
+
 
 class VmPool:
     """Pool of VMs already started and used to decrease response time.
     After running, a VM is saved for future reuse from the same function during a
     configurable duration.
 
-    The counter is used by the VMs to set their tap interface name and the corresponding
-    IPv4 subnet.
+    The pool also keeps `PREALLOC_VM_COUNT` generic VMs booted per runtime, waiting for
+    their configuration. These are refilled in the background once a runtime has been
+    used.
+
+    Idle executions are stopped by the reaper. New VMs are admitted by the scheduler
+    depending on the capacity of the host.
+
+    When `TAP_POOL_SIZE` is set, tap interfaces are created in advance as well and
+    recycled after use.
+
+    The ids of the VMs, allocated by the network, set the name of their tap interface
+    and the corresponding IPv4 subnet.
     """
 
-    counter: int  # Used to provide distinct ids to network interfaces
     executions: Dict[VmHash, VmExecution]
+    creation_tasks: Dict[VmHash, asyncio.Task]  # Executions being created
     message_cache: Dict[str, ProgramMessage] = {}
     network: Optional[Network]
+    reaper: ExecutionReaper
+    scheduler: CapacityScheduler
+    preallocated: Dict[PreallocKey, List[AlephFirecrackerVM]]
+    preallocating: Dict[PreallocKey, int]
+    prealloc_tasks: Set[asyncio.Task]  # Also fill the pool of taps
+    prealloc_hits: int
+    prealloc_misses: int
+    tap_pool_filling: int
 
     def __init__(self):
-        self.counter = settings.START_ID_INDEX
         self.executions = {}
+        self.creation_tasks = {}
         self.network = Network(
             vm_address_pool_range=settings.IPV4_ADDRESS_POOL,
             vm_network_size=settings.IPV4_NETWORK_SIZE,
             external_interface=settings.NETWORK_INTERFACE,
+            tap_pool_size=settings.TAP_POOL_SIZE,
+            first_vm_id=settings.START_ID_INDEX,
+            vm_id_state_path=settings.VM_ID_STATE_FILE,
         ) if settings.ALLOW_VM_NETWORKING else None
+        self.reaper = ExecutionReaper()
+        self.scheduler = CapacityScheduler.from_settings(self)
+        self.preallocated = {}
+        self.preallocating = {}
+        self.prealloc_tasks = set()
+        self.prealloc_hits = 0
+        self.prealloc_misses = 0
+        self.tap_pool_filling = 0
 
     async def create_a_vm(
         self, vm_hash: VmHash, program: ProgramContent, original: ProgramContent
     ) -> VmExecution:
-        """Create a new Aleph Firecracker VM from an Aleph function message."""
-        execution = VmExecution(vm_hash=vm_hash, program=program, original=original)
-        self.executions[vm_hash] = execution
-        await execution.prepare()
+        """Create a new Aleph Firecracker VM from an Aleph function message.
+
+        Raises `InsufficientCapacityError` if the host cannot run the VM.
+        """
+        async with self.scheduler.reservation(vm_hash, program.resources):
+            execution = VmExecution(
+                vm_hash=vm_hash, program=program, original=original
+            )
+            self.executions[vm_hash] = execution
+            await execution.prepare()
+            get_cache_manager().evict(pinned=self.get_pinned_cache_keys())
+
+            prealloc_key = get_prealloc_key(program)
+            if settings.PREALLOC_VM_COUNT > 0 and prealloc_key:
+                vm = self.claim_preallocated_vm(prealloc_key)
+                self.refill_preallocated_vms(prealloc_key, execution.resources)
+            else:
+                vm = None
+
+            if vm:
+                logger.debug(f"Using preallocated vm={vm.vm_id} for {vm_hash}")
+                await execution.create_from_preallocated(vm)
+            else:
+                vm_id, tap_interface = await self.get_vm_network()
+                await execution.create(vm_id=vm_id, tap_interface=tap_interface)
+            return execution
+
+    def claim_preallocated_vm(self, key: PreallocKey) -> Optional[AlephFirecrackerVM]:
+        """Take a booted VM waiting for its configuration from the pool, if any."""
+        vms = self.preallocated.get(key)
+        if vms:
+            self.prealloc_hits += 1
+            return vms.pop(0)
+        else:
+            self.prealloc_misses += 1
+            return None
+
+    def refill_preallocated_vms(
+        self, key: PreallocKey, resources: AlephFirecrackerResources
+    ) -> None:
+        """Boot VMs in the background until `PREALLOC_VM_COUNT` are available for a key.
+
+        Preallocated VMs only use the capacity left by the executions.
+        """
+        _, vcpus, memory, _ = key
+        missing = (
+            settings.PREALLOC_VM_COUNT
+            - len(self.preallocated.get(key, ()))
+            - self.preallocating.get(key, 0)
+        )
+        for _ in range(missing):
+            if not self.scheduler.fits(MachineResources(vcpus=vcpus, memory=memory)):
+                logger.debug(f"Not enough capacity to preallocate VMs for {key[0]}")
+                return
+            self.preallocating[key] = self.preallocating.get(key, 0) + 1
+            task = create_task_log_exceptions(
+                self.preallocate_vm(key, resources), name=f"prealloc {key[0]}"
+            )
+            self.prealloc_tasks.add(task)
+            task.add_done_callback(self.prealloc_tasks.discard)
+
+    async def preallocate_vm(
+        self, key: PreallocKey, resources: AlephFirecrackerResources
+    ) -> None:
+        """Boot a VM up to its init, without sending any program configuration.
+
+        Only the kernel and the rootfs of `resources` are used to boot the VM, the
+        program specific resources are assigned when the VM is claimed.
+        """
+        try:
+            vm_id, tap_interface = await self.get_vm_network()
+            _, vcpus, memory, internet = key
+            vm = AlephFirecrackerVM(
+                vm_id=vm_id,
+                vm_hash=None,
+                resources=resources,
+                enable_networking=internet,
+                hardware_resources=MachineResources(vcpus=vcpus, memory=memory),
+                tap_interface=tap_interface,
+            )
+            try:
+                await vm.setup()
+                await vm.start()
+                await vm.snapshot()
+            except (Exception, asyncio.CancelledError):
+                await vm.teardown()
+                raise
+            self.preallocated.setdefault(key, []).append(vm)
+            logger.debug(f"Preallocated vm={vm_id} for runtime {key[0]}")
+        finally:
+            self.preallocating[key] -= 1
+
+    async def get_vm_network(self) -> Tuple[int, TapInterface]:
+        """Return a vm_id and its tap interface, from the pool of taps if possible."""
+        claimed = self.network.claim_tap()
+        self.refill_tap_pool()
+        if claimed:
+            return claimed
         vm_id = self.get_unique_vm_id()
+        return vm_id, await self.network.create_tap(vm_id)
 
-        tap_interface = await self.network.create_tap(vm_id)
-        await execution.create(vm_id=vm_id, tap_interface=tap_interface)
-        return execution
+    def refill_tap_pool(self) -> None:
+        """Create taps in the background until `TAP_POOL_SIZE` are available."""
+        missing = (
+            settings.TAP_POOL_SIZE - len(self.network.tap_pool) - self.tap_pool_filling
+        )
+        for _ in range(missing):
+            self.tap_pool_filling += 1
+            task = create_task_log_exceptions(self.fill_tap_pool(), name="tap pool")
+            self.prealloc_tasks.add(task)
+            task.add_done_callback(self.prealloc_tasks.discard)
+
+    async def fill_tap_pool(self) -> None:
+        try:
+            await self.network.fill_tap_pool(self.get_unique_vm_id())
+        finally:
+            self.tap_pool_filling -= 1
 
     def get_unique_vm_id(self) -> int:
         """Get a unique identifier for the VM.
 
         This identifier is used to name the network interface and in the IPv4 range
-        dedicated to the VM.
+        dedicated to the VM. It is released when the interface is deleted.
         """
-        _, network_range = settings.IPV4_ADDRESS_POOL.split("/")
-        available_bits = int(network_range) - settings.IPV4_NETWORK_SIZE
-        self.counter += 1
-        if self.counter < 2**available_bits:
-            # In common cases, use the counter itself as the vm_id. This makes it
-            # easier to debug.
-            return self.counter
-        else:
-            # The value of the counter is too high and some functions such as the
-            # IPv4 range dedicated to the VM do not support such high values.
-            #
-            # We therefore recycle vm_id values from executions that are not running
-            # anymore.
-            currently_used_vm_ids = set(
-                execution.vm_id
-                for execution in self.executions.values()
-                if execution.is_running
+        return self.network.vm_ids.allocate()
+
+    def get_pinned_cache_keys(self) -> Dict[str, Set[str]]:
+        """Names of the cached files used by executions and preallocated VMs, per cache.
+
+        Executions are considered until they are stopped, including while their
+        files are being downloaded.
+        """
+        pinned: Dict[str, Set[str]] = {
+            "message": set(),
+            "code": set(),
+            "runtime": set(),
+            "data": set(),
+        }
+        for vm_hash, execution in self.executions.items():
+            if execution.times.stopped_at:
+                continue
+            program = execution.program
+            pinned["message"].add(f"{vm_hash}.json")
+            pinned["code"].add(program.code.ref)
+            pinned["runtime"].add(program.runtime.ref)
+            if program.data:
+                pinned["data"].add(program.data.ref)
+            pinned["data"].update(
+                volume.ref
+                for volume in (program.volumes or [])
+                if hasattr(volume, "ref")
             )
-            for i in range(settings.START_ID_INDEX, 255**2):
-                if i not in currently_used_vm_ids:
-                    return i
-            else:
-                raise ValueError("No available value for vm_id.")
+        for runtime_ref, *_ in (*self.preallocated, *self.preallocating):
+            pinned["runtime"].add(runtime_ref)
+        return pinned
 
     async def get_running_vm(self, vm_hash: VmHash) -> Optional[VmExecution]:
         """Return a running VM or None. Disables the VM expiration task."""
         execution = self.executions.get(vm_hash)
         if execution and execution.is_running:
-            execution.cancel_expiration()
+            self.reaper.cancel(execution)
             return execution
         else:
             return None
@@ -100,13 +274,44 @@ class VmPool:
 
     async def stop(self):
         """Stop all VMs in the pool."""
+        await self.reaper.stop()
+        for task in list(self.prealloc_tasks):
+            task.cancel()
+        preallocated = [vm for vms in self.preallocated.values() for vm in vms]
+        self.preallocated = {}
 
         # Stop executions in parallel:
         await asyncio.gather(
-            *(execution.stop() for vm_hash, execution in self.executions.items())
+            *(execution.stop() for vm_hash, execution in self.executions.items()),
+            *(vm.teardown() for vm in preallocated),
         )
+        if self.network:
+            await self.network.empty_tap_pool()
 
     def get_persistent_executions(self) -> Iterable[VmExecution]:
         for vm_hash, execution in self.executions.items():
             if execution.persistent and execution.is_running:
                 yield execution
+
+    def prealloc_stats(self) -> Dict:
+        """Counters of the preallocated VMs, exposed on `/about/executions`."""
+        return {
+            "prealloc_vm_count": settings.PREALLOC_VM_COUNT,
+            "hits": self.prealloc_hits,
+            "misses": self.prealloc_misses,
+            "available": [
+                {
+                    "runtime": runtime_ref,
+                    "vcpus": vcpus,
+                    "memory": memory,
+                    "internet": internet,
+                    "count": len(vms),
+                }
+                for (
+                    runtime_ref,
+                    vcpus,
+                    memory,
+                    internet,
+                ), vms in self.preallocated.items()
+            ],
+        }
@@ -0,0 +1,198 @@
+"""
+Stopping of the idle executions of the pool.
+
+A single task stops the executions that have not been used for `REUSE_TIMEOUT`
+seconds, instead of a sleeping task per execution. The deadlines are kept in a hashed
+timer wheel, so that scheduling, cancelling and expiring an execution are O(1).
+
+Idle executions are also kept in least recently used order, and the oldest ones are
+stopped when there are more than `MAX_IDLE_EXECUTIONS` or when the available memory of
+the host drops below `MIN_AVAILABLE_MEMORY`.
+
+With `BALLOON_IDLE_DELAY`, the balloon of executions idle for that long is inflated to
+reclaim their memory until they are used again.
+"""
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Set
+
+import psutil
+
+from .conf import settings
+from .utils import create_task_log_exceptions
+
+if TYPE_CHECKING:
+    from .models import VmExecution, VmHash
+
+logger = logging.getLogger(__name__)
+
+WHEEL_TICK = 1.0  # Seconds
+WHEEL_SLOTS = 512
+
+
+class IdleExecution(NamedTuple):
+    execution: "VmExecution"
+    deadline: float  # Loop time
+    slot: int
+
+
+def releasable_memory(execution: "VmExecution") -> int:
+    """Memory in MiB released by stopping an execution, not reclaimed by its balloon."""
+    balloon_size = execution.vm.balloon_size if execution.vm else 0
+    return execution.program.resources.memory - balloon_size
+
+
+class ExecutionReaper:
+    idle: "OrderedDict[VmHash, IdleExecution]"  # Least recently used first
+    stopping: Dict["VmHash", int]  # Memory released by the stops in progress
+    balloon_pending: "OrderedDict[VmHash, float]"  # Loop time since idle, oldest first
+    slots: List[Set["VmHash"]]
+    current_tick: Optional[int]  # Last tick of the wheel processed
+    task: Optional[asyncio.Task] = None
+    expired: int
+    evicted: int
+    balloons_inflated: int
+
+    def __init__(self):
+        self.idle = OrderedDict()
+        self.balloon_pending = OrderedDict()
+        self.stopping = {}
+        self.slots = [set() for _ in range(WHEEL_SLOTS)]
+        self.current_tick = None
+        self.expired = 0
+        self.evicted = 0
+        self.balloons_inflated = 0
+
+    def start(self) -> None:
+        if not self.task:
+            self.current_tick = math.floor(self.now() / WHEEL_TICK)
+            self.task = create_task_log_exceptions(self.run(), name="reaper")
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def now(self) -> float:
+        return asyncio.get_event_loop().time()
+
+    def schedule(self, execution: "VmExecution", timeout: float) -> None:
+        """Stop the execution after `timeout` seconds, unless used in the meantime."""
+        if execution.persistent:
+            logger.debug("VM marked as long running. Ignoring timeout.")
+            return
+        self.start()
+        self.cancel(execution)
+        deadline = self.now() + timeout
+        # Never before the tick being processed
+        tick = max(math.ceil(deadline / WHEEL_TICK), self.current_tick + 1)
+        slot = tick % WHEEL_SLOTS
+        self.slots[slot].add(execution.vm_hash)
+        self.idle[execution.vm_hash] = IdleExecution(execution, deadline, slot)
+        if settings.BALLOON_IDLE_DELAY is not None:
+            self.balloon_pending[execution.vm_hash] = self.now()
+
+    def cancel(self, execution: "VmExecution") -> bool:
+        """Keep the execution running, as it is being used."""
+        self.balloon_pending.pop(execution.vm_hash, None)
+        entry = self.idle.pop(execution.vm_hash, None)
+        if not entry:
+            return False
+        self.slots[entry.slot].discard(execution.vm_hash)
+        return True
+
+    def idle_executions(self) -> List["VmExecution"]:
+        """Idle executions still running, least recently used first."""
+        return [
+            entry.execution
+            for entry in self.idle.values()
+            if entry.execution.is_running
+        ]
+
+    def reap(self, execution: "VmExecution") -> None:
+        self.cancel(execution)
+        if execution.is_running and execution.concurrent_runs == 0:
+            vm_hash = execution.vm_hash
+            self.stopping[vm_hash] = releasable_memory(execution)
+            task = create_task_log_exceptions(execution.stop(), name=f"stop {vm_hash}")
+            task.add_done_callback(lambda _: self.stopping.pop(vm_hash, None))
+
+    def expire(self, now: float) -> None:
+        """Stop the executions of the slots of the ticks elapsed."""
+        target_tick = math.floor(now / WHEEL_TICK)
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % WHEEL_SLOTS]
+            for vm_hash in list(slot):
+                entry = self.idle[vm_hash]
+                # Deadlines further than a turn of the wheel stay in the slot
+                if entry.deadline <= now:
+                    logger.debug(f"Stopping {vm_hash} after its timeout")
+                    self.expired += 1
+                    self.reap(entry.execution)
+
+    def inflate_balloons(self, now: float) -> None:
+        """Reclaim the memory of the executions idle for `BALLOON_IDLE_DELAY`."""
+        while self.balloon_pending:
+            vm_hash, idle_since = next(iter(self.balloon_pending.items()))
+            if idle_since + settings.BALLOON_IDLE_DELAY > now:
+                return
+            del self.balloon_pending[vm_hash]
+            execution = self.idle[vm_hash].execution
+            if execution.is_running and execution.vm:
+                self.balloons_inflated += 1
+                create_task_log_exceptions(
+                    execution.vm.inflate_balloon(), name=f"inflate {vm_hash}"
+                )
+
+    def evict(self) -> None:
+        """Stop the least recently used executions beyond the limits."""
+        if settings.MAX_IDLE_EXECUTIONS is not None:
+            if len(self.idle) > settings.MAX_IDLE_EXECUTIONS:
+                # Forget the executions stopped by something else
+                for entry in list(self.idle.values()):
+                    if not entry.execution.is_running:
+                        self.cancel(entry.execution)
+            while len(self.idle) > settings.MAX_IDLE_EXECUTIONS:
+                entry = next(iter(self.idle.values()))
+                logger.debug(f"Stopping {entry.execution.vm_hash}: too many idle VMs")
+                self.evicted += 1
+                self.reap(entry.execution)
+
+        if settings.MIN_AVAILABLE_MEMORY:
+            available = psutil.virtual_memory().available // 2**20
+            # The memory of the executions still stopping is not available yet, but
+            # must not be made up for by stopping more executions at each check.
+            missing = (
+                settings.MIN_AVAILABLE_MEMORY - available - sum(self.stopping.values())
+            )
+            while missing > 0 and self.idle:
+                entry = next(iter(self.idle.values()))
+                if entry.execution.is_running:
+                    logger.debug(
+                        f"Stopping {entry.execution.vm_hash}: low available memory"
+                    )
+                    self.evicted += 1
+                    missing -= releasable_memory(entry.execution)
+                self.reap(entry.execution)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(WHEEL_TICK)
+            now = self.now()
+            self.expire(now)
+            self.evict()
+            self.inflate_balloons(now)
+
+    def stats(self) -> Dict:
+        return {
+            "idle": len(self.idle),
+            "stopping": len(self.stopping),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "balloons_inflated": self.balloons_inflated,
+            "max_idle_executions": settings.MAX_IDLE_EXECUTIONS,
+            "min_available_memory": settings.MIN_AVAILABLE_MEMORY,
+        }
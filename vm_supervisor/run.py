@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Iterable, Tuple, AsyncIterator
 
 import msgpack
 from aiohttp import web
@@ -13,6 +13,8 @@ from .messages import load_updated_message
 from .models import VmHash, VmExecution
 from .pool import VmPool
 from .pubsub import PubSub
+from .scheduler import InsufficientCapacityError
+from .vm.channel import FrameType, StreamCancelled
 from .vm.firecracker_microvm import (
     ResourceDownloadError,
     VmSetupError,
@@ -24,17 +26,61 @@ logger = logging.getLogger(__name__)
 pool = VmPool()
 
 
-async def build_asgi_scope(path: str, request: web.Request) -> Dict[str, Any]:
+# Size of the chunks of request bodies sent to the VM
+REQUEST_BODY_CHUNK_SIZE = 65536
+
+
+async def build_asgi_scope(
+    path: str, request: web.Request, read_body: bool = True
+) -> Dict[str, Any]:
     # ASGI mandates lowercase header names
     headers = tuple((name.lower(), value) for name, value in request.raw_headers)
-    return {
+    scope = {
         "type": "http",
         "path": path,
         "method": request.method,
         "query_string": request.query_string,
         "headers": headers,
-        "body": await request.read(),
     }
+    if read_body:
+        scope["body"] = await request.read()
+    return scope
+
+
+class RequestBodyReader:
+    """Read the body of a request in chunks, as ASGI `receive` messages for the VM.
+
+    The program receives a disconnect message instead of the remainder of a body
+    larger than `max_size`.
+    """
+
+    request: web.Request
+    max_size: int
+    size: int
+    too_large: bool
+
+    def __init__(self, request: web.Request, max_size: int):
+        self.request = request
+        self.max_size = max_size
+        self.size = 0
+        self.too_large = False
+
+    def check_content_length(self) -> None:
+        content_length = self.request.content_length
+        if content_length and content_length > self.max_size:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=self.max_size, actual_size=content_length
+            )
+
+    async def messages(self) -> AsyncIterator[Dict]:
+        async for chunk in self.request.content.iter_chunked(REQUEST_BODY_CHUNK_SIZE):
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                self.too_large = True
+                yield {"type": "http.disconnect"}
+                return
+            yield {"type": "http.request", "body": chunk, "more_body": True}
+        yield {"type": "http.request", "body": b"", "more_body": False}
 
 
 async def build_event_scope(event) -> Dict[str, Any]:
@@ -44,7 +90,22 @@ async def build_event_scope(event) -> Dict[str, Any]:
     }
 
 
+# Errors raised when a VM cannot be created, see `creation_error_response(...)`
+VM_CREATION_ERRORS = (
+    InsufficientCapacityError,
+    ResourceDownloadError,
+    FileTooLargeError,
+    VmSetupError,
+    MicroVMFailedInit,
+)
+
+
 async def create_vm_execution(vm_hash: VmHash) -> VmExecution:
+    """Create the execution of a VM.
+
+    This runs once for all the requests waiting for the VM, so errors are raised as
+    such and converted to a response by each request.
+    """
     message, original_message = await load_updated_message(vm_hash)
     pool.message_cache[vm_hash] = message
 
@@ -54,20 +115,13 @@ async def create_vm_execution(vm_hash: VmHash) -> VmExecution:
             program=message.content,
             original=original_message.content,
         )
-    except ResourceDownloadError as error:
-        logger.exception(error)
-        pool.forget_vm(vm_hash=vm_hash)
-        raise HTTPBadRequest(reason="Code, runtime or data not available")
-    except FileTooLargeError as error:
-        raise HTTPInternalServerError(reason=error.args[0])
-    except VmSetupError as error:
+    except InsufficientCapacityError:
+        logger.warning(f"Not enough capacity to start {vm_hash}")
+        raise
+    except (ResourceDownloadError, VmSetupError, MicroVMFailedInit) as error:
         logger.exception(error)
         pool.forget_vm(vm_hash=vm_hash)
-        raise HTTPInternalServerError(reason="Error during program initialisation")
-    except MicroVMFailedInit as error:
-        logger.exception(error)
-        pool.forget_vm(vm_hash=vm_hash)
-        raise HTTPInternalServerError(reason="Error during runtime initialisation")
+        raise
 
     if not execution.vm:
         raise ValueError("The VM has not been created")
@@ -75,24 +129,205 @@ async def create_vm_execution(vm_hash: VmHash) -> VmExecution:
     return execution
 
 
+def creation_error_response(error: Exception) -> web.HTTPException:
+    """HTTP error to respond with when a VM could not be created."""
+    if isinstance(error, InsufficientCapacityError):
+        return web.HTTPServiceUnavailable(
+            reason=error.args[0], headers={"Retry-After": str(error.retry_after)}
+        )
+    elif isinstance(error, ResourceDownloadError):
+        return HTTPBadRequest(reason="Code, runtime or data not available")
+    elif isinstance(error, FileTooLargeError):
+        return HTTPInternalServerError(reason=error.args[0])
+    elif isinstance(error, VmSetupError):
+        return HTTPInternalServerError(reason="Error during program initialisation")
+    elif isinstance(error, MicroVMFailedInit):
+        return HTTPInternalServerError(reason="Error during runtime initialisation")
+    else:
+        raise ValueError(f"Unexpected error: {error!r}")
+
+
+async def get_or_create_vm_execution(vm_hash: VmHash) -> VmExecution:
+    """Return the running execution of the VM, creating it if necessary.
+
+    Concurrent requests for a VM that is not running share a single creation,
+    instead of each booting a duplicate VM.
+    """
+    execution: Optional[VmExecution] = await pool.get_running_vm(vm_hash=vm_hash)
+    if execution:
+        return execution
+
+    task = pool.creation_tasks.get(vm_hash)
+    if not task:
+        task = asyncio.ensure_future(create_vm_execution(vm_hash=vm_hash))
+        pool.creation_tasks[vm_hash] = task
+
+        def forget_creation_task(_):
+            if pool.creation_tasks.get(vm_hash) is task:
+                del pool.creation_tasks[vm_hash]
+
+        task.add_done_callback(forget_creation_task)
+    else:
+        logger.debug(f"Waiting for the creation of {vm_hash} by another request")
+
+    # A request that is cancelled must not cancel the creation for the others
+    return await asyncio.shield(task)
+
+
+def get_pubsub(request: web.Request) -> Optional[PubSub]:
+    # The PubSub is only set up when watching for updates
+    return request.app["pubsub"] if settings.WATCH_FOR_UPDATES else None
+
+
+async def release_execution(execution: VmExecution, pubsub: Optional[PubSub]):
+    """Keep the VM running for future requests or stop it, once a run is done."""
+    if not execution.is_running:
+        # The VM was stopped during the run
+        return
+    if settings.REUSE_TIMEOUT > 0:
+        if settings.WATCH_FOR_UPDATES:
+            execution.start_watching_for_updates(pubsub=pubsub)
+        pool.reaper.schedule(execution, timeout=settings.REUSE_TIMEOUT)
+    else:
+        await execution.stop()
+
+
+def build_response_headers(
+    raw_headers: Iterable[Tuple[bytes, bytes]], execution: VmExecution
+) -> Dict[str, str]:
+    headers = {key.decode(): value.decode() for key, value in raw_headers}
+    for header in ["Content-Encoding", "Transfer-Encoding", "Vary"]:
+        if header in headers:
+            del headers[header]
+
+    headers.update(
+        {
+            "Aleph-Program-ItemHash": execution.vm_hash,
+            "Aleph-Program-Code-Ref": execution.program.code.ref,
+            # "Aleph-Compute-Vm-Id": str(execution.vm.vm_id),
+        }
+    )
+    return headers
+
+
+def abort_response(request: web.Request, response: web.StreamResponse):
+    """Interrupt a response that has started, so that the client sees it failed.
+
+    Ending the response cleanly would pass a truncated body for a complete one.
+    """
+    if request.transport:
+        request.transport.close()
+    return response
+
+
+async def stream_response_from_vm(
+    execution: VmExecution, scope: Dict, request: web.Request
+) -> web.StreamResponse:
+    """Forward the response of the program to the client as it is produced by the VM.
+
+    The body of the request is forwarded to the VM while the program reads it.
+    Errors that happen after the response has started abort the connection.
+    """
+    # Compared to None, as an empty response is falsy
+    response: Optional[web.StreamResponse] = None
+    result_raw: bytes = b""
+
+    body_reader = RequestBodyReader(request, max_size=settings.MAX_REQUEST_BODY_SIZE)
+    body_reader.check_content_length()
+
+    frames = execution.run_code_streaming(scope=scope, receive=body_reader.messages())
+    try:
+        async for frame_type, payload in frames:
+            if frame_type == FrameType.response:
+                result_raw = payload
+                break
+
+            event = msgpack.loads(payload, raw=False)
+            if event["type"] == "http.response.start":
+                response = web.StreamResponse(
+                    status=event["status"],
+                    headers=build_response_headers(event.get("headers", []), execution),
+                )
+                await response.prepare(request)
+            elif event["type"] == "http.response.body" and response is not None:
+                await response.write(event.get("body", b""))
+    except asyncio.TimeoutError:
+        if response is None:
+            raise
+        logger.warning(f"VM{execution.vm_id} stopped streaming its response")
+        return abort_response(request, response)
+    except StreamCancelled:
+        logger.warning(f"Response of VM{execution.vm_id} aborted")
+        if response is None:
+            return web.Response(status=502, reason="Response aborted")
+        return abort_response(request, response)
+    except ConnectionResetError:
+        # The request is cancelled in the VM when closing the frames
+        logger.debug(f"Client of VM{execution.vm_id} disconnected")
+        return response
+    finally:
+        await frames.aclose()
+
+    if body_reader.too_large and response is None:
+        raise web.HTTPRequestEntityTooLarge(
+            max_size=body_reader.max_size, actual_size=body_reader.size
+        )
+
+    if result_raw == b"":
+        # The VM closed the connection, it may have completely crashed.
+        # It will be restarted on a future request.
+        await execution.stop()
+        if response is not None:
+            return abort_response(request, response)
+        return web.Response(
+            status=502,
+            reason="No response from VM",
+            text="VM did not respond and was shut down",
+        )
+
+    result = msgpack.loads(result_raw, raw=False)
+    if "traceback" in result:
+        logger.warning(result["traceback"])
+        if response is not None:
+            return abort_response(request, response)
+        return web.Response(
+            status=500,
+            reason="Error in VM execution",
+            body=result["traceback"],
+            content_type="text/plain",
+        )
+
+    if response is None:
+        return web.Response(status=502, reason="Invalid response from VM")
+    await response.write_eof()
+    return response
+
+
 async def run_code_on_request(
     vm_hash: VmHash, path: str, request: web.Request
-) -> web.Response:
+) -> web.StreamResponse:
     """
     Execute the code corresponding to the 'code id' in the path.
     """
 
-    execution: Optional[VmExecution] = await pool.get_running_vm(vm_hash=vm_hash)
-
-    if not execution:
-        execution = await create_vm_execution(vm_hash=vm_hash)
+    try:
+        execution: VmExecution = await get_or_create_vm_execution(vm_hash=vm_hash)
+    except VM_CREATION_ERRORS as error:
+        raise creation_error_response(error)
 
     logger.debug(f"Using vm={execution.vm_id}")
 
-    scope: Dict = await build_asgi_scope(path, request)
-
     try:
         await execution.becomes_ready()
+
+        if settings.STREAM_RESPONSES and await execution.vm.can_stream():
+            scope: Dict = await build_asgi_scope(path, request, read_body=False)
+            try:
+                return await stream_response_from_vm(execution, scope, request)
+            finally:
+                await release_execution(execution, pubsub=get_pubsub(request))
+
+        scope = await build_asgi_scope(path, request)
         result_raw: bytes = await execution.run_code(scope=scope)
 
         if result_raw == b"":
@@ -132,22 +367,9 @@ async def run_code_on_request(
                 content_type="text/plain",
             )
 
-        headers = {
-            key.decode(): value.decode() for key, value in result["headers"]["headers"]
-        }
+        headers = build_response_headers(result["headers"]["headers"], execution)
         if "content-length" not in headers:
             headers["Content-Length".lower()] = str(len(result["body"]["body"]))
-        for header in ["Content-Encoding", "Transfer-Encoding", "Vary"]:
-            if header in headers:
-                del headers[header]
-
-        headers.update(
-            {
-                "Aleph-Program-ItemHash": execution.vm_hash,
-                "Aleph-Program-Code-Ref": execution.program.code.ref,
-                # "Aleph-Compute-Vm-Id": str(execution.vm.vm_id),
-            }
-        )
 
         return web.Response(
             status=result["headers"]["status"],
@@ -158,12 +380,7 @@ async def run_code_on_request(
         logger.exception(error)
         return web.Response(status=502, reason="Invalid response from VM")
     finally:
-        if settings.REUSE_TIMEOUT > 0:
-            if settings.WATCH_FOR_UPDATES:
-                execution.start_watching_for_updates(pubsub=request.app["pubsub"])
-            execution.stop_after_timeout(timeout=settings.REUSE_TIMEOUT)
-        else:
-            await execution.stop()
+        await release_execution(execution, pubsub=get_pubsub(request))
 
 
 async def run_code_on_event(vm_hash: VmHash, event, pubsub: PubSub):
@@ -171,10 +388,12 @@ async def run_code_on_event(vm_hash: VmHash, event, pubsub: PubSub):
     Execute code in response to an event.
     """
 
-    execution: Optional[VmExecution] = await pool.get_running_vm(vm_hash=vm_hash)
-
-    if not execution:
-        execution = await create_vm_execution(vm_hash=vm_hash)
+    try:
+        execution: VmExecution = await get_or_create_vm_execution(vm_hash=vm_hash)
+    except VM_CREATION_ERRORS as error:
+        # Nobody waits for the response, the error is only logged
+        logger.warning(f"Event not processed by {vm_hash}: {error!r}")
+        return creation_error_response(error)
 
     logger.debug(f"Using vm={execution.vm_id}")
 
@@ -208,12 +427,7 @@ async def run_code_on_event(vm_hash: VmHash, event, pubsub: PubSub):
         logger.exception(error)
         return web.Response(status=502, reason="Invalid response from VM")
     finally:
-        if settings.REUSE_TIMEOUT > 0:
-            if settings.WATCH_FOR_UPDATES:
-                execution.start_watching_for_updates(pubsub=pubsub)
-            execution.stop_after_timeout(timeout=settings.REUSE_TIMEOUT)
-        else:
-            await execution.stop()
+        await release_execution(execution, pubsub=pubsub)
 
 
 async def start_persistent_vm(vm_hash: VmHash, pubsub: PubSub) -> VmExecution:
@@ -221,11 +435,11 @@ async def start_persistent_vm(vm_hash: VmHash, pubsub: PubSub) -> VmExecution:
 
     if not execution:
         logger.info(f"Starting persistent VM {vm_hash}")
-        execution = await create_vm_execution(vm_hash=vm_hash)
+        execution = await get_or_create_vm_execution(vm_hash=vm_hash)
     # If the VM was already running in lambda mode, it should not expire
     # as long as it is also scheduled as long-running
     execution.persistent = True
-    execution.cancel_expiration()
+    pool.reaper.cancel(execution)
 
     await execution.becomes_ready()
 
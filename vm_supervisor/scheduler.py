@@ -0,0 +1,180 @@
+"""
+Admission of new VMs depending on the capacity of the host.
+
+The memory and vcpus of the VMs running, being created and preallocated are accounted
+against the budgets of the host. A VM that does not fit waits for capacity in a queue,
+while idle executions are stopped to make room, least recently used first. It is
+rejected if no capacity is available after `ADMISSION_TIMEOUT` seconds.
+"""
+import asyncio
+import logging
+import math
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Deque, Dict, List, Tuple
+
+import psutil
+from aleph_message.models.program import MachineResources
+
+from .conf import settings
+
+if TYPE_CHECKING:
+    from .models import VmExecution, VmHash
+    from .pool import VmPool
+
+logger = logging.getLogger(__name__)
+
+# Interval at which VMs waiting in the queue check for capacity
+ADMISSION_POLL_INTERVAL = 0.2
+# Default vcpu budget per CPU of the host
+VCPUS_PER_CPU = 4
+
+
+class InsufficientCapacityError(Exception):
+    """The host cannot run the VM now, try again after `retry_after` seconds."""
+
+    retry_after: int
+
+    def __init__(self, retry_after: int):
+        super().__init__("Not enough capacity on the host")
+        self.retry_after = retry_after
+
+
+class CapacityScheduler:
+    pool: "VmPool"
+    memory_budget: int  # MiB
+    vcpu_budget: int
+    reserved: Dict["VmHash", MachineResources]  # VMs being created
+    waiters: Deque[object]
+    admitted: int
+    rejected: int
+    evicted: int
+
+    def __init__(self, pool: "VmPool", memory_budget: int, vcpu_budget: int):
+        self.pool = pool
+        self.memory_budget = memory_budget
+        self.vcpu_budget = vcpu_budget
+        self.reserved = {}
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_settings(cls, pool: "VmPool") -> "CapacityScheduler":
+        memory_budget = (
+            settings.CAPACITY_MEMORY or psutil.virtual_memory().total // 2**20
+        )
+        vcpu_budget = settings.CAPACITY_VCPUS or psutil.cpu_count() * VCPUS_PER_CPU
+        return cls(pool, memory_budget=memory_budget, vcpu_budget=vcpu_budget)
+
+    def now(self) -> float:
+        return asyncio.get_event_loop().time()
+
+    async def sleep(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+    def usage(self) -> Tuple[int, int]:
+        """Memory and vcpus used by VMs running, being created or preallocated."""
+        memory = vcpus = 0
+        for execution in self.pool.executions.values():
+            if execution.is_running and execution.vm_hash not in self.reserved:
+                memory += execution.program.resources.memory
+                vcpus += execution.program.resources.vcpus
+        for resources in self.reserved.values():
+            memory += resources.memory
+            vcpus += resources.vcpus
+        for (_, key_vcpus, key_memory, _), vms in self.pool.preallocated.items():
+            memory += key_memory * len(vms)
+            vcpus += key_vcpus * len(vms)
+        for (_, key_vcpus, key_memory, _), count in self.pool.preallocating.items():
+            memory += key_memory * count
+            vcpus += key_vcpus * count
+        return memory, vcpus
+
+    def fits(self, resources: MachineResources) -> bool:
+        memory, vcpus = self.usage()
+        return (
+            memory + resources.memory <= self.memory_budget
+            and vcpus + resources.vcpus <= self.vcpu_budget
+        )
+
+    def idle_executions(self) -> List["VmExecution"]:
+        """Executions that can be stopped, least recently used first."""
+        return [
+            execution
+            for execution in self.pool.reaper.idle_executions()
+            if not execution.persistent
+            and execution.concurrent_runs == 0
+            and execution.vm_hash not in self.reserved
+        ]
+
+    async def evict_idle(self, resources: MachineResources) -> bool:
+        """Stop idle executions until `resources` fit. Return whether any stopped."""
+        stopped = False
+        for execution in self.idle_executions():
+            if self.fits(resources):
+                break
+            if not execution.is_running or execution.concurrent_runs:
+                # Stopped or used again in the meantime
+                continue
+            logger.debug(f"Stopping idle VM {execution.vm_hash} to make room")
+            self.evicted += 1
+            stopped = True
+            await execution.stop()
+        return stopped
+
+    async def admit(self, resources: MachineResources) -> None:
+        """Wait until `resources` fit in the budgets, in order of arrival.
+
+        Raises `InsufficientCapacityError` after `ADMISSION_TIMEOUT` seconds.
+        """
+        if not self.waiters and self.fits(resources):
+            return
+        retry_after = math.ceil(settings.ADMISSION_TIMEOUT) or 1
+        if resources.memory > self.memory_budget or resources.vcpus > self.vcpu_budget:
+            raise InsufficientCapacityError(retry_after)
+
+        deadline = self.now() + settings.ADMISSION_TIMEOUT
+        waiter = object()
+        self.waiters.append(waiter)
+        try:
+            while True:
+                if self.waiters[0] is waiter:
+                    if self.fits(resources):
+                        return
+                    if await self.evict_idle(resources):
+                        continue
+                if self.now() >= deadline:
+                    raise InsufficientCapacityError(retry_after)
+                await self.sleep(ADMISSION_POLL_INTERVAL)
+        finally:
+            self.waiters.remove(waiter)
+
+    @asynccontextmanager
+    async def reservation(self, vm_hash: "VmHash", resources: MachineResources):
+        """Admit a VM and account for its resources while it is being created."""
+        try:
+            await self.admit(resources)
+        except InsufficientCapacityError:
+            self.rejected += 1
+            raise
+        self.admitted += 1
+        self.reserved[vm_hash] = resources
+        try:
+            yield
+        finally:
+            self.reserved.pop(vm_hash, None)
+
+    def stats(self) -> Dict:
+        memory, vcpus = self.usage()
+        return {
+            "memory_budget": self.memory_budget,
+            "vcpu_budget": self.vcpu_budget,
+            "memory_used": memory,
+            "vcpus_used": vcpus,
+            "waiting": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
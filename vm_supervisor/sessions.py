@@ -0,0 +1,66 @@
+"""
+HTTP session and DNS resolver shared by the supervisor.
+
+Opening a session per request pays the TCP, TLS and DNS setup every time. The shared
+session keeps its connections alive between requests instead. It is opened when the
+application starts and closed on cleanup, or on first use outside of the application,
+as in the benchmarks.
+"""
+import logging
+from typing import Optional
+
+import aiodns
+import aiohttp
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+_resolver: Optional[aiodns.DNSResolver] = None
+
+
+def create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=settings.HTTP_CONNECTION_LIMIT,
+        limit_per_host=settings.HTTP_CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    timeout = aiohttp.ClientTimeout(
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        sock_read=settings.HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared HTTP session."""
+    global _session
+    if _session is None or _session.closed:
+        _session = create_session()
+    return _session
+
+
+def get_resolver() -> aiodns.DNSResolver:
+    """Return the shared DNS resolver."""
+    global _resolver
+    if _resolver is None:
+        _resolver = aiodns.DNSResolver()
+    return _resolver
+
+
+async def open_sessions(app=None) -> None:
+    get_session()
+    get_resolver()
+    logger.debug("Shared HTTP session opened")
+
+
+async def close_sessions(app=None) -> None:
+    global _session, _resolver
+    if _session:
+        await _session.close()
+        _session = None
+    if _resolver:
+        _resolver.cancel()
+        _resolver = None
+    logger.debug("Shared HTTP session closed")
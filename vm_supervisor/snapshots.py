@@ -0,0 +1,138 @@
+"""
+Store of Firecracker snapshots, used to restore VMs instead of booting them.
+
+A snapshot is taken from a preallocated VM once its init signals that it is ready,
+before it receives its configuration, outside of the path of any request. It can
+therefore be restored for any program using the same runtime, kernel and machine
+resources.
+
+VMs with internet access are always booted. Their tap interface is part of the
+snapshot, and the Firecracker version in use restores it under the name it had in
+the snapshotted VM, with no way to attach another one. Each VM has its own tap
+interface on the host, so restoring them would require a network namespace per VM
+in which the tap interface of the snapshot can be recreated.
+
+Snapshots are kept in a directory bounded in size, least recently used ones are
+removed first.
+"""
+import hashlib
+import logging
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import mkdtemp
+from typing import Optional, List, Tuple
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = "snapshot"
+MEM_FILENAME = "memory"
+
+
+@dataclass
+class Snapshot:
+    path: Path
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.path / SNAPSHOT_FILENAME
+
+    @property
+    def mem_file_path(self) -> Path:
+        return self.path / MEM_FILENAME
+
+
+def file_signature(path: Path) -> str:
+    """Identify a file by its path, size and modification time."""
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_snapshot_key(
+    runtime_ref: str, kernel_path: Path, vcpus: int, memory: int
+) -> str:
+    """Key of the snapshots compatible with a VM.
+
+    The Firecracker binary is part of the key since snapshots are not portable across
+    versions.
+    """
+    key = "|".join(
+        (
+            runtime_ref,
+            file_signature(kernel_path),
+            file_signature(Path(settings.FIRECRACKER_PATH)),
+            str(vcpus),
+            str(memory),
+        )
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def disk_usage(path: Path) -> int:
+    """Space used on disk by the files in a directory. Memory files may be sparse."""
+    return sum(entry.stat().st_blocks * 512 for entry in os.scandir(path))
+
+
+class SnapshotStore:
+    directory: Path
+    max_size: int
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key: str) -> Optional[Snapshot]:
+        """Return the snapshot for the key, if available, and mark it as recently used."""
+        snapshot = Snapshot(path=self.directory / key)
+        if not (
+            snapshot.snapshot_path.is_file() and snapshot.mem_file_path.is_file()
+        ):
+            return None
+        os.utime(snapshot.path)
+        return snapshot
+
+    def new_snapshot(self) -> Snapshot:
+        """Create a temporary location to write a snapshot to, see `self.add(...)`."""
+        os.makedirs(self.directory, exist_ok=True)
+        return Snapshot(path=Path(mkdtemp(prefix=".tmp-", dir=self.directory)))
+
+    def add(self, key: str, snapshot: Snapshot) -> Optional[Snapshot]:
+        """Move a snapshot written in a temporary location into the store."""
+        target = Snapshot(path=self.directory / key)
+        try:
+            os.rename(snapshot.path, target.path)
+        except OSError:
+            # Another VM with the same key was snapshotted concurrently
+            logger.debug(f"Snapshot {key} already exists, dropping the new one")
+            shutil.rmtree(snapshot.path, ignore_errors=True)
+            return self.get(key)
+        self.evict()
+        return target
+
+    def discard(self, snapshot: Snapshot) -> None:
+        shutil.rmtree(snapshot.path, ignore_errors=True)
+
+    def evict(self) -> None:
+        """Remove the least recently used snapshots until the store fits in its budget."""
+        entries: List[Tuple[float, int, Path]] = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.startswith(".tmp-"):
+                path = Path(entry.path)
+                entries.append((entry.stat().st_mtime, disk_usage(path), path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug(f"Removing snapshot {path.name}")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+
+def get_snapshot_store() -> SnapshotStore:
+    return SnapshotStore(
+        directory=settings.SNAPSHOTS_DIRECTORY, max_size=settings.MAX_SNAPSHOTS_SIZE
+    )
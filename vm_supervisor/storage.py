@@ -10,13 +10,13 @@ import json
 import logging
 import os
 import re
-import sys
 from os.path import isfile, join
 from pathlib import Path
 from shutil import make_archive
+from typing import Dict, Optional, Tuple
 
 import aiohttp
-from aleph_message.models import ProgramMessage
+from aleph_message.models import ItemType, ProgramMessage, StoreMessage
 from aleph_message.models.program import (
     Encoding,
     MachineVolume,
@@ -25,43 +25,371 @@ from aleph_message.models.program import (
     VolumePersistence,
 )
 
+from .cache import get_cache_manager, ContentCache
 from .conf import settings
+from .sessions import get_session
 
 logger = logging.getLogger(__name__)
 
 
-async def download_file(url: str, local_path: Path) -> None:
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Sent by the connector, the hash of files stored with the `storage` item type is
+# the SHA-256 of their content. Only compared to the hash from the STORE message.
+ITEM_HASH_HEADER = "Aleph-Item-Hash"
+ITEM_TYPE_HEADER = "Aleph-Item-Type"
+
+# Downloads in progress, shared by the concurrent requests for the same file
+downloads_in_progress: Dict[Path, asyncio.Task] = {}
+
+# Hash of the file stored by each STORE message, as messages are immutable
+stored_file_hashes: Dict[str, Optional[str]] = {}
+
+
+class ContentHashMismatchError(aiohttp.ClientResponseError):
+    """The content of a downloaded file does not match its hash"""
+
+
+async def verify_cached_file(
+    local_path: Path, cache: ContentCache, store_ref: str
+) -> bool:
+    """Return whether a cached file matches the STORE message `store_ref`.
+
+    Files verified when downloaded are found in the index of the cache and not read.
+    Others are hashed once and added to the index, or removed if they do not match.
+    """
+    expected_hash = await get_stored_file_hash(store_ref)
+    if not expected_hash or cache.verified.get(local_path.name) == expected_hash:
+        return True
+
+    hasher = hashlib.sha256()
+    await asyncio.get_event_loop().run_in_executor(
+        None, update_hash_from_file, hasher, local_path, os.path.getsize(local_path)
+    )
+    if hasher.hexdigest() != expected_hash:
+        logger.warning(f"Cached {local_path} does not match {store_ref}, removing it")
+        os.remove(local_path)
+        return False
+    cache.add(local_path.name, verified_hash=expected_hash)
+    return True
+
+
+async def download_file(
+    url: str, local_path: Path, store_ref: Optional[str] = None
+) -> None:
+    """Download a file, verified against the STORE message `store_ref` if given."""
     # TODO: Limit max size of download to the message specification
-    if isfile(local_path):
-        logger.debug(f"File already exists: {local_path}")
+    cache = get_cache_manager().get_cache(local_path)
+    if cache.lookup(local_path.name) if cache else isfile(local_path):
+        if not (store_ref and cache) or await verify_cached_file(
+            local_path, cache, store_ref
+        ):
+            logger.debug(f"File already exists: {local_path}")
+            return
+
+    task = downloads_in_progress.get(local_path)
+    if not task:
+        task = asyncio.ensure_future(
+            fetch_file(url, local_path, cache, store_ref=store_ref)
+        )
+        downloads_in_progress[local_path] = task
+
+        def forget_download(_):
+            if downloads_in_progress.get(local_path) is task:
+                del downloads_in_progress[local_path]
+
+        task.add_done_callback(forget_download)
     else:
-        tmp_path = f"{local_path}.part"
-        logger.debug(f"Downloading {url} -> {tmp_path}")
-        async with aiohttp.ClientSession() as session:
-            resp = await session.get(url)
+        logger.debug(f"Waiting for the download of {local_path} by another request")
+
+    # A request that is cancelled must not cancel the download for the others
+    await asyncio.shield(task)
+
+
+def parse_content_range(value: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    """Parse the first byte, last byte and total size of a `Content-Range` header."""
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+)", value or "")
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), int(total)
+
+
+def update_hash_from_fd(hasher, fd: int, start: int, end: int) -> None:
+    """Hash the content of an open file from `start` to `end`."""
+    offset = start
+    while offset < end:
+        chunk = os.pread(fd, min(end - offset, 1024 * 1024), offset)
+        if not chunk:
+            raise ValueError(f"File is shorter than {end} bytes")
+        hasher.update(chunk)
+        offset += len(chunk)
+
+
+class RangeHasher:
+    """Hash a file downloaded in parallel ranges while the ranges are received.
+
+    SHA-256 requires the content in order. The chunks that follow the content hashed
+    so far are hashed as they arrive, the ones received ahead are written first and
+    read back from the file once the content before them has been hashed.
+    """
+
+    hasher: "hashlib._Hash"
+    fd: int
+    offset: int  # End of the content hashed
+    ahead: Dict[int, int]  # Content written but not hashed yet, as start: end
+    catching_up: Optional[asyncio.Task] = None
+
+    def __init__(self, hasher, fd: int):
+        self.hasher = hasher
+        self.fd = fd
+        self.offset = 0
+        self.ahead = {}
+        self.catching_up = None
+
+    def update(self, offset: int, chunk: bytes) -> None:
+        """Account for a chunk that was just written at `offset` in the file."""
+        end = offset + len(chunk)
+        if offset == self.offset and not self.catching_up:
+            self.hasher.update(chunk)
+            self.offset = end
+        else:
+            # Chunks of a range are received in order, extend the content ahead
+            for start, ahead_end in self.ahead.items():
+                if ahead_end == offset:
+                    self.ahead[start] = end
+                    break
+            else:
+                self.ahead[offset] = end
+        if self.offset in self.ahead and not self.catching_up:
+            self.catching_up = asyncio.ensure_future(self.catch_up())
+
+    async def catch_up(self) -> None:
+        """Hash the content received ahead that now follows the content hashed."""
+        loop = asyncio.get_event_loop()
+        try:
+            while self.offset in self.ahead:
+                end = self.ahead.pop(self.offset)
+                await loop.run_in_executor(
+                    None, update_hash_from_fd, self.hasher, self.fd, self.offset, end
+                )
+                self.offset = end
+        finally:
+            self.catching_up = None
+
+    async def hexdigest(self, total: int) -> str:
+        """Return the hash of the file once all its content has been received."""
+        if self.catching_up:
+            await self.catching_up
+        if self.offset != total:
+            raise ValueError(f"Hashed {self.offset} bytes out of {total}")
+        return self.hasher.hexdigest()
+
+
+def update_hash_from_file(hasher, path: Path, end: int) -> None:
+    """Hash the content of a file up to `end`."""
+    with open(path, "rb") as file:
+        remaining = end
+        while remaining:
+            chunk = file.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise ValueError(f"File {path} is shorter than {end} bytes")
+            hasher.update(chunk)
+            remaining -= len(chunk)
+
+
+async def write_response(
+    resp: aiohttp.ClientResponse,
+    fd: int,
+    offset: int,
+    end: Optional[int] = None,
+    hasher=None,
+    range_hasher: Optional[RangeHasher] = None,
+) -> int:
+    """Write the body of a response in the file at `offset`, up to `end` if given.
+
+    The chunks written are added to `hasher` or `range_hasher`, if given, as they are
+    received. Returns the offset following the last byte written.
+    """
+    while end is None or offset < end:
+        chunk = await resp.content.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            if end is not None:
+                raise aiohttp.ClientPayloadError(
+                    f"Response ended at {offset} instead of {end}"
+                )
+            break
+        if end is not None:
+            chunk = chunk[: end - offset]
+        os.pwrite(fd, chunk, offset)
+        if hasher:
+            hasher.update(chunk)
+        if range_hasher:
+            range_hasher.update(offset, chunk)
+        offset += len(chunk)
+    return offset
+
+
+async def fetch_ranges(
+    url: str,
+    first_response: aiohttp.ClientResponse,
+    fd: int,
+    total: int,
+    range_hasher: Optional[RangeHasher] = None,
+) -> None:
+    """Download a file in parallel ranges, each written at its offset in the file.
+
+    The first range is read from `first_response`, which requested the whole file.
+    """
+    os.posix_fallocate(fd, 0, total)
+    range_size = -(-total // settings.DOWNLOAD_PARALLEL_RANGES)
+
+    async def fetch_range(start: int) -> None:
+        end = min(start + range_size, total)
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        async with get_session().get(url, headers=headers) as resp:
             resp.raise_for_status()
-            try:
-                with open(tmp_path, "wb") as cache_file:
-                    counter = 0
-                    while True:
-                        chunk = await resp.content.read(65536)
-                        if not chunk:
-                            break
-                        cache_file.write(chunk)
-                        counter += 1
-                        if not (counter % 20):
-                            sys.stdout.write(".")
-                            sys.stdout.flush()
-
-                os.rename(tmp_path, local_path)
-                logger.debug(f"Download complete, moved {tmp_path} -> {local_path}")
-            except Exception:
-                # Ensure no partial file is left
-                try:
-                    os.remove(tmp_path)
-                except FileNotFoundError:
-                    pass
+            if resp.status != 206:
+                raise aiohttp.ClientPayloadError("Range requests are not supported")
+            await write_response(resp, fd, start, end, range_hasher=range_hasher)
+
+    tasks = [
+        asyncio.ensure_future(
+            write_response(
+                first_response, fd, 0, range_size, range_hasher=range_hasher
+            )
+        ),
+        *(
+            asyncio.ensure_future(fetch_range(start))
+            for start in range(range_size, total, range_size)
+        ),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def fetch_part_file(
+    url: str, tmp_path: Path, expected_hash: Optional[str] = None
+) -> Optional[str]:
+    """Download a file, resuming from the content already in `tmp_path`.
+
+    The content is verified against `expected_hash`, if given. Returns the verified
+    SHA-256 of the file, if any.
+    """
+    offset = tmp_path.stat().st_size if tmp_path.exists() else 0
+    headers = {"Range": f"bytes={offset}-"}
+    async with get_session().get(url, headers=headers) as resp:
+        if resp.status == 416 and offset:
+            # Range Not Satisfiable, the partial file is not a prefix of the file
+            logger.debug(f"Cannot resume from {tmp_path}, restarting the download")
+            tmp_path.unlink()
+            return await fetch_part_file(url, tmp_path, expected_hash)
+        resp.raise_for_status()
+
+        header_hash = resp.headers.get(ITEM_HASH_HEADER)
+        if (
+            expected_hash
+            and resp.headers.get(ITEM_TYPE_HEADER) == ItemType.storage
+            and header_hash != expected_hash
+        ):
+            raise ContentHashMismatchError(
+                request_info=resp.request_info,
+                history=resp.history,
+                status=502,
+                message=f"{url} serves {header_hash} instead of {expected_hash}",
+                headers=resp.headers,
+            )
+
+        content_range = parse_content_range(resp.headers.get("Content-Range"))
+        if resp.status != 206 or not content_range or content_range[0] != offset:
+            # The server sent the complete file
+            offset = 0
+            total = resp.content_length
+        else:
+            total = content_range[2]
+        if offset:
+            logger.debug(f"Resuming download of {url} from byte {offset}")
+
+        hasher = None
+        if expected_hash:
+            hasher = hashlib.sha256()
+            if offset:
+                # Only the part downloaded previously is read from the disk
+                await asyncio.get_event_loop().run_in_executor(
+                    None, update_hash_from_file, hasher, tmp_path, offset
+                )
+
+        # Readable to hash the ranges of the file received out of order
+        flags = os.O_RDWR | os.O_CREAT | (0 if offset else os.O_TRUNC)
+        fd = os.open(tmp_path, flags, 0o644)
+        digest: Optional[str] = None
+        range_hasher: Optional[RangeHasher] = None
+        try:
+            if (
+                offset == 0
+                and resp.status == 206
+                and settings.DOWNLOAD_PARALLEL_RANGES > 1
+                and total
+                and total >= settings.DOWNLOAD_PARALLEL_MIN_SIZE
+            ):
+                range_hasher = RangeHasher(hasher, fd) if hasher else None
+                await fetch_ranges(url, resp, fd, total, range_hasher=range_hasher)
+                if range_hasher:
+                    digest = await range_hasher.hexdigest(total)
+            else:
+                await write_response(resp, fd, offset, end=total, hasher=hasher)
+                if hasher:
+                    digest = hasher.hexdigest()
+        finally:
+            if range_hasher and range_hasher.catching_up:
+                # The download failed while content was read back from the file
+                await asyncio.gather(range_hasher.catching_up, return_exceptions=True)
+            os.close(fd)
+
+        if hasher and digest != expected_hash:
+            tmp_path.unlink()
+            raise ContentHashMismatchError(
+                request_info=resp.request_info,
+                history=resp.history,
+                status=502,
+                message=f"Content of {url} does not match its hash {expected_hash}",
+                headers=resp.headers,
+            )
+        return expected_hash
+
+
+async def fetch_file(
+    url: str,
+    local_path: Path,
+    cache: Optional[ContentCache],
+    store_ref: Optional[str] = None,
+) -> None:
+    expected_hash = await get_stored_file_hash(store_ref) if store_ref else None
+    tmp_path = Path(f"{local_path}.part")
+    logger.debug(f"Downloading {url} -> {tmp_path}")
+    verified_hash: Optional[str] = None
+    for attempt in range(1, settings.DOWNLOAD_ATTEMPTS + 1):
+        try:
+            verified_hash = await fetch_part_file(url, tmp_path, expected_hash)
+            break
+        except (
+            aiohttp.ClientPayloadError,
+            aiohttp.ClientConnectionError,
+            asyncio.TimeoutError,
+        ) as error:
+            # The partial file is kept to resume the download
+            if attempt == settings.DOWNLOAD_ATTEMPTS:
                 raise
+            logger.warning(f"Download of {url} interrupted, resuming: {error}")
+
+    os.rename(tmp_path, local_path)
+    logger.debug(f"Download complete, moved {tmp_path} -> {local_path}")
+    if cache:
+        cache.add(local_path.name, verified_hash=verified_hash)
 
 
 async def get_latest_amend(item_hash: str) -> str:
@@ -69,14 +397,40 @@ async def get_latest_amend(item_hash: str) -> str:
         return item_hash
     else:
         url = f"{settings.CONNECTOR_URL}/compute/latest_amend/{item_hash}"
-        async with aiohttp.ClientSession() as session:
-            resp = await session.get(url)
+        async with get_session().get(url) as resp:
             resp.raise_for_status()
             result: str = await resp.json()
             assert isinstance(result, str)
             return result or item_hash
 
 
+async def get_stored_file_hash(ref: str) -> Optional[str]:
+    """Return the SHA-256 of the file stored by the STORE message `ref`, if known.
+
+    The message is checked against `ref`, the item hash referenced by the program, so
+    that the file can be verified without trusting the connector. Files stored on
+    IPFS are identified by a CID instead and are not verified.
+    """
+    if ref in stored_file_hashes:
+        return stored_file_hashes[ref]
+
+    cache_path = Path(join(settings.MESSAGE_CACHE, ref) + ".json")
+    url = f"{settings.CONNECTOR_URL}/download/message/{ref}"
+    await download_file(url, cache_path)
+
+    with open(cache_path, "r") as cache_file:
+        message = StoreMessage(**json.load(cache_file))
+    if message.item_hash != ref:
+        raise ValueError(f"Message {message.item_hash} received instead of {ref}")
+    if message.content.item_type != ItemType.storage:
+        # Computing the CID would require rebuilding the IPFS DAG of the file
+        logger.info(f"File of {ref} is stored on IPFS, it is not verified")
+        stored_file_hashes[ref] = None
+    else:
+        stored_file_hashes[ref] = message.content.item_hash
+    return stored_file_hashes[ref]
+
+
 async def get_message(ref: str) -> ProgramMessage:
     if settings.FAKE_DATA_PROGRAM:
         cache_path = settings.FAKE_DATA_MESSAGE
@@ -117,7 +471,7 @@ async def get_code_path(ref: str) -> Path:
 
     cache_path = Path(join(settings.CODE_CACHE, ref))
     url = f"{settings.CONNECTOR_URL}/download/code/{ref}"
-    await download_file(url, cache_path)
+    await download_file(url, cache_path, store_ref=ref)
     return cache_path
 
 
@@ -129,7 +483,7 @@ async def get_data_path(ref: str) -> Path:
 
     cache_path = Path(join(settings.DATA_CACHE, ref))
     url = f"{settings.CONNECTOR_URL}/download/data/{ref}"
-    await download_file(url, cache_path)
+    await download_file(url, cache_path, store_ref=ref)
     return cache_path
 
 
@@ -139,7 +493,7 @@ async def get_runtime_path(ref: str) -> Path:
 
     cache_path = Path(join(settings.RUNTIME_CACHE, ref))
     url = f"{settings.CONNECTOR_URL}/download/runtime/{ref}"
-    await download_file(url, cache_path)
+    await download_file(url, cache_path, store_ref=ref)
     return cache_path
 
 
@@ -163,7 +517,7 @@ async def get_volume_path(volume: MachineVolume, namespace: str) -> Path:
 
         cache_path = Path(join(settings.DATA_CACHE, ref))
         url = f"{settings.CONNECTOR_URL}/download/data/{ref}"
-        await download_file(url, cache_path)
+        await download_file(url, cache_path, store_ref=ref)
         return cache_path
     elif isinstance(volume, PersistentVolume):
         if volume.persistence != VolumePersistence.host:
@@ -7,14 +7,15 @@ evolve in the future.
 """
 import logging
 from secrets import token_urlsafe
-from typing import Awaitable, Callable
 
 from aiohttp import web
 
 from . import metrics
 from .conf import settings
+from .placement import get_cpu_placer, pin_supervisor
 from .resources import about_system_usage
 from .run import pool
+from .sessions import open_sessions, close_sessions
 from .tasks import start_watch_for_messages_task, stop_watch_for_messages_task
 from .version import __version__
 from .views import (
@@ -22,9 +23,11 @@ from .views import (
     run_code_from_hostname,
     about_login,
     about_executions,
+    about_cache,
     about_config,
     status_check_fastapi,
     about_execution_records,
+    about_program_usage,
     status_check_version,
     update_allocations,
 )
@@ -32,20 +35,21 @@ from .views import (
 logger = logging.getLogger(__name__)
 
 
-@web.middleware
-async def server_version_middleware(
-    request: web.Request,
-    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
-) -> web.StreamResponse:
-    """Add the version of Aleph-VM in the HTTP headers of the responses."""
-    resp: web.StreamResponse = await handler(request)
+async def add_server_version(
+    request: web.Request, resp: web.StreamResponse
+) -> None:
+    """Add the version of Aleph-VM in the HTTP headers of the responses.
+
+    Done when the headers are sent, since streamed responses are sent before the
+    handler returns.
+    """
     resp.headers.update(
         {"Server": f"aleph-vm/{__version__}"},
     )
-    return resp
 
 
-app = web.Application(middlewares=[server_version_middleware])
+app = web.Application()
+app.on_response_prepare.append(add_server_version)
 
 app.add_routes(
     [
@@ -53,6 +57,8 @@ app.add_routes(
         web.get("/about/executions", about_executions),
         web.get("/about/executions/records", about_execution_records),
         web.get("/about/usage/system", about_system_usage),
+        web.get("/about/usage/programs", about_program_usage),
+        web.get("/about/cache", about_cache),
         web.get("/about/config", about_config),
         web.post("/control/allocations", update_allocations),
         web.get("/status/check/fastapi", status_check_fastapi),
@@ -84,11 +90,19 @@ def run():
     engine = metrics.setup_engine()
     metrics.create_tables(engine)
 
+    if settings.CPU_PINNING:
+        # The topology is read before the affinity of the supervisor is reduced
+        pin_supervisor(get_cpu_placer())
+
+    app.on_startup.append(open_sessions)
+
     try:
         if settings.WATCH_FOR_MESSAGES:
             app.on_startup.append(start_watch_for_messages_task)
             app.on_cleanup.append(stop_watch_for_messages_task)
             app.on_cleanup.append(stop_all_vms)
+        app.on_cleanup.append(close_sessions)
+        app.on_cleanup.append(metrics.stop_record_writer)
 
         web.run_app(app, host=settings.SUPERVISOR_HOST, port=settings.SUPERVISOR_PORT)
     finally:
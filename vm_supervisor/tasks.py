@@ -17,6 +17,7 @@ from .messages import load_updated_message
 from .models import VmHash
 from .pubsub import PubSub
 from .reactor import Reactor
+from .sessions import get_session
 from .utils import create_task_log_exceptions
 
 logger = logging.getLogger(__name__)
@@ -38,54 +39,53 @@ async def retry_generator(
 
 async def subscribe_via_ws(url) -> AsyncIterable[BaseMessage]:
     logger.debug("subscribe_via_ws()")
-    async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(url) as ws:
-            logger.debug(f"Websocket connected on {url}")
-            async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    try:
-                        data = json.loads(msg.data)
-                        # Patch data format to match HTTP GET format
-                        data["_id"] = {"$oid": data["_id"]}
-                    except json.JSONDecodeError:
-                        logger.error(
-                            f"Invalid JSON from websocket subscription {msg.data}",
-                            exc_info=True,
-                        )
-
-                    # Chain confirmation messages are published in the WS subscription
-                    # but do not contain the fields "item_type" or "content, hence they
-                    # are not valid Messages.
-                    if "item_type" not in data:
-                        assert "content" not in data
-                        assert "confirmation" in data
-                        logger.info(
-                            f"Ignoring confirmation message '{data['item_hash']}'"
-                        )
-                        continue
-
-                    try:
-                        yield Message(**data)
-                    except pydantic.error_wrappers.ValidationError as error:
-                        logger.error(
-                            f"Invalid Aleph message: \n  {error.json()}\n  {error.raw_errors}",
-                            exc_info=True,
-                        )
-                        continue
-                    except KeyError:
-                        logger.exception(
-                            f"Invalid Aleph message could not be parsed '{data}'",
-                            exc_info=True,
-                        )
-                        continue
-                    except Exception:
-                        logger.exception(
-                            f"Unknown error when parsing Aleph message {data}",
-                            exc_info=True,
-                        )
-                        continue
-                elif msg.type == aiohttp.WSMsgType.ERROR:
-                    break
+    async with get_session().ws_connect(url) as ws:
+        logger.debug(f"Websocket connected on {url}")
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    data = json.loads(msg.data)
+                    # Patch data format to match HTTP GET format
+                    data["_id"] = {"$oid": data["_id"]}
+                except json.JSONDecodeError:
+                    logger.error(
+                        f"Invalid JSON from websocket subscription {msg.data}",
+                        exc_info=True,
+                    )
+
+                # Chain confirmation messages are published in the WS subscription
+                # but do not contain the fields "item_type" or "content, hence they
+                # are not valid Messages.
+                if "item_type" not in data:
+                    assert "content" not in data
+                    assert "confirmation" in data
+                    logger.info(
+                        f"Ignoring confirmation message '{data['item_hash']}'"
+                    )
+                    continue
+
+                try:
+                    yield Message(**data)
+                except pydantic.error_wrappers.ValidationError as error:
+                    logger.error(
+                        f"Invalid Aleph message: \n  {error.json()}\n  {error.raw_errors}",
+                        exc_info=True,
+                    )
+                    continue
+                except KeyError:
+                    logger.exception(
+                        f"Invalid Aleph message could not be parsed '{data}'",
+                        exc_info=True,
+                    )
+                    continue
+                except Exception:
+                    logger.exception(
+                        f"Unknown error when parsing Aleph message {data}",
+                        exc_info=True,
+                    )
+                    continue
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                break
 
 
 async def watch_for_messages(dispatcher: PubSub, reactor: Reactor):
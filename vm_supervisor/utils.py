@@ -5,7 +5,7 @@ from base64 import b32decode, b16encode
 from dataclasses import is_dataclass, asdict as dataclass_as_dict
 from typing import Any, Optional, Coroutine
 
-import aiodns
+from .sessions import get_resolver
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +19,7 @@ def b32_to_b16(hash: str) -> bytes:
 
 
 async def get_ref_from_dns(domain):
-    resolver = aiodns.DNSResolver()
+    resolver = get_resolver()
     record = await resolver.query(domain, "TXT")
     return record[0].text
 
@@ -1,12 +1,12 @@
 import binascii
 import logging
 import os.path
+from datetime import datetime, timedelta
 from hashlib import sha256
 from string import Template
-from typing import Awaitable, Optional
+from typing import Awaitable, Dict, Optional
 
 import aiodns
-import aiohttp
 from aiohttp import web
 from aiohttp.web_exceptions import HTTPNotFound
 from packaging.version import Version, InvalidVersion
@@ -14,12 +14,26 @@ from pydantic import ValidationError
 
 from . import status
 from .version import __version__
+from .cache import get_cache_manager
 from .conf import settings
-from .metrics import get_execution_records
+from .metrics import (
+    get_execution_records,
+    get_program_usage,
+    period_start,
+    RecordCursor,
+    ROLLUP_PERIODS,
+)
 from .models import VmHash
 from .pubsub import PubSub
 from .resources import Allocation
-from .run import run_code_on_request, pool, start_persistent_vm
+from .run import (
+    run_code_on_request,
+    pool,
+    start_persistent_vm,
+    VM_CREATION_ERRORS,
+    creation_error_response,
+)
+from .sessions import get_session
 from .utils import b32_to_b16, get_ref_from_dns, dumps_for_json
 
 logger = logging.getLogger(__name__)
@@ -99,11 +113,21 @@ async def about_login(request: web.Request) -> web.Response:
 async def about_executions(request: web.Request) -> web.Response:
     authenticate_request(request)
     return web.json_response(
-        [{key: value for key, value in pool.executions.items()}],
+        [
+            {key: value for key, value in pool.executions.items()},
+            {"prealloc": pool.prealloc_stats()},
+            {"scheduler": pool.scheduler.stats()},
+            {"reaper": pool.reaper.stats()},
+        ],
         dumps=dumps_for_json,
     )
 
 
+async def about_cache(request: web.Request) -> web.Response:
+    authenticate_request(request)
+    return web.json_response(get_cache_manager().stats(), dumps=dumps_for_json)
+
+
 async def about_config(request: web.Request) -> web.Response:
     authenticate_request(request)
     return web.json_response(
@@ -112,11 +136,110 @@ async def about_config(request: web.Request) -> web.Response:
     )
 
 
+def parse_cursor(cursor: str) -> RecordCursor:
+    time_defined, uuid = cursor.split(",", 1)
+    return datetime.fromisoformat(time_defined), uuid
+
+
+def format_cursor(record) -> str:
+    return f"{record.time_defined.isoformat()},{record.uuid}"
+
+
+def parse_records_filters(request: web.Request) -> Dict:
+    query = request.query
+    since, until, cursor = query.get("since"), query.get("until"), query.get("cursor")
+    try:
+        return {
+            "vm_hash": query.get("vm_hash"),
+            "since": datetime.fromisoformat(since) if since else None,
+            "until": datetime.fromisoformat(until) if until else None,
+            "after": parse_cursor(cursor) if cursor else None,
+        }
+    except ValueError as error:
+        raise web.HTTPBadRequest(reason=f"Invalid filter: {error}")
+
+
 async def about_execution_records(request: web.Request):
-    records = await get_execution_records()
+    """Execution records ordered by time, filtered by `vm_hash` and `since`/`until`.
+
+    Records are returned by pages of `limit`, with the link to the next page in the
+    `Link` header. With `format=ndjson`, all the records are streamed instead, one
+    per line.
+    """
+    filters = parse_records_filters(request)
+    try:
+        limit = int(request.query.get("limit", settings.RECORDS_PAGE_SIZE))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Invalid limit")
+    if not 0 < limit <= settings.RECORDS_PAGE_SIZE:
+        limit = settings.RECORDS_PAGE_SIZE
+
+    if request.query.get("format") == "ndjson":
+        response = web.StreamResponse(
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        await response.prepare(request)
+        while True:
+            records = await get_execution_records(**filters, limit=limit)
+            if not records:
+                break
+            await response.write(
+                b"".join(
+                    dumps_for_json(record).encode() + b"\n" for record in records
+                )
+            )
+            filters["after"] = (records[-1].time_defined, records[-1].uuid)
+        await response.write_eof()
+        return response
+
+    records = await get_execution_records(**filters, limit=limit)
+    headers = {}
+    if len(records) == limit:
+        # Relative, the scheme and host seen here may not be the public ones
+        next_url = request.rel_url.update_query(cursor=format_cursor(records[-1]))
+        headers["Link"] = f'<{next_url}>; rel="next"'
     return web.json_response(
         records,
         dumps=dumps_for_json,
+        headers=headers,
+    )
+
+
+async def about_program_usage(request: web.Request):
+    """Usage of each program from `since` to `until`, the last day by default.
+
+    The bounds are rounded to the `period` of the rollups used, by day when both are
+    at midnight and by hour otherwise: `since` down and `until` up, so that the
+    periods that contain them are included.
+    """
+    query = request.query
+    try:
+        until = datetime.fromisoformat(query["until"]) if "until" in query else None
+        since = datetime.fromisoformat(query["since"]) if "since" in query else None
+    except ValueError as error:
+        raise web.HTTPBadRequest(reason=f"Invalid filter: {error}")
+    until = until or period_start(datetime.now(), "hour") + timedelta(hours=1)
+    since = since or until - timedelta(days=1)
+    if since >= until:
+        raise web.HTTPBadRequest(reason="Invalid filter: since must be before until")
+
+    period = query.get("period")
+    if not period:
+        at_midnight = since == period_start(since, "day") and until == period_start(
+            until, "day"
+        )
+        period = "day" if at_midnight else "hour"
+    elif period not in ROLLUP_PERIODS:
+        raise web.HTTPBadRequest(reason=f"Invalid period: {period}")
+    since, end = period_start(since, period), period_start(until, period)
+    until = end if end == until else end + ROLLUP_PERIODS[period]
+
+    programs = await get_program_usage(
+        period=period, since=since, until=until, vm_hash=query.get("vm_hash")
+    )
+    return web.json_response(
+        {"since": since, "until": until, "period": period, "programs": programs},
+        dumps=dumps_for_json,
     )
 
 
@@ -137,17 +260,17 @@ async def index(request: web.Request):
 
 
 async def status_check_fastapi(request: web.Request):
-    async with aiohttp.ClientSession() as session:
-        result = {
-            "index": await status.check_index(session),
-            "environ": await status.check_environ(session),
-            "messages": await status.check_messages(session),
-            "internet": await status.check_internet(session),
-            "cache": await status.check_cache(session),
-            "persistent_storage": await status.check_persistent_storage(session),
-            "error_handling": await status.check_error_raised(session),
-        }
-        return web.json_response(result, status=200 if all(result.values()) else 503)
+    session = get_session()
+    result = {
+        "index": await status.check_index(session),
+        "environ": await status.check_environ(session),
+        "messages": await status.check_messages(session),
+        "internet": await status.check_internet(session),
+        "cache": await status.check_cache(session),
+        "persistent_storage": await status.check_persistent_storage(session),
+        "error_handling": await status.check_error_raised(session),
+    }
+    return web.json_response(result, status=200 if all(result.values()) else 503)
 
 
 async def status_check_version(request: web.Request):
@@ -202,7 +325,10 @@ async def update_allocations(request: web.Request):
     for vm_hash in allocation.persistent_vms:
         vm_hash = VmHash(vm_hash)
         logger.info(f"Starting long running VM {vm_hash}")
-        await start_persistent_vm(vm_hash, pubsub)
+        try:
+            await start_persistent_vm(vm_hash, pubsub)
+        except VM_CREATION_ERRORS as error:
+            raise creation_error_response(error)
 
     # Stop VMs
     for execution in pool.get_persistent_executions():
@@ -0,0 +1,260 @@
+"""
+Multiplexed connection between the supervisor and the init of a VM.
+
+A single connection over the Firecracker vsock is kept open per VM and shared by
+concurrent requests, avoiding the `CONNECT` handshake on every request. Requests and
+responses are framed with a header containing a request id and the payload length.
+
+Responses to HTTP requests can be streamed: the init then sends each ASGI event as a
+frame as soon as it is produced, followed by a final response frame. The body of these
+requests is streamed to the VM as well, as ASGI receive messages.
+
+The frames of a stream are flow controlled with credits in both directions, so that
+frames are always dispatched without waiting: each side sends at most `STREAM_WINDOW`
+frames that the other has not consumed yet, and the receiver grants credit back as it
+consumes them. A slow client only pauses the program producing its response, and a
+program reading its request body slowly only pauses the upload. A stream is only aborted, with a
+cancel frame, when its request fails or when the client goes away.
+
+Runtimes with an init that does not support the multiplexed channel close the
+connection after the handshake, in which case the supervisor falls back to one
+connection per request.
+"""
+import asyncio
+import logging
+import struct
+from enum import IntEnum
+from typing import Dict, Optional, AsyncIterator, Tuple, AsyncIterable
+
+from ..utils import create_task_log_exceptions
+
+logger = logging.getLogger(__name__)
+
+MUX_HANDSHAKE = b"MUX\n"
+MUX_ACK = b"MUX OK\n"
+FRAME_HEADER = struct.Struct("!IBI")  # Request id, frame type, payload length
+CREDIT = struct.Struct("!I")  # Number of frames consumed by the receiver
+
+# Frames of a stream sent and not consumed yet, at most. Must match the init.
+STREAM_WINDOW = 64
+
+
+class FrameType(IntEnum):
+    request = 1
+    response = 2
+    stream_request = 3
+    event = 4
+    receive = 5
+    cancel = 6  # The request is aborted by the side sending this frame
+    credit = 7  # The receiver of a stream consumed frames, more can be sent
+
+
+class ChannelNotSupported(Exception):
+    pass
+
+
+class StreamCancelled(Exception):
+    """The stream was aborted by the VM, or did not respect the flow control."""
+
+
+class VmChannel:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    pending: Dict[int, asyncio.Future]
+    streams: Dict[int, asyncio.Queue]
+    send_windows: Dict[int, asyncio.Semaphore]  # Receive frames the VM accepts
+    last_request_id: int
+    closed: bool
+    read_task: Optional[asyncio.Task] = None
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.streams = {}
+        self.send_windows = {}
+        self.last_request_id = 0
+        self.closed = False
+        self.write_lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, vsock_path: str) -> "VmChannel":
+        """Connect to the init of the VM and switch the connection to multiplexing."""
+        reader, writer = await asyncio.open_unix_connection(path=vsock_path)
+        writer.write(b"CONNECT 52\n" + MUX_HANDSHAKE)
+        await writer.drain()
+
+        ack: bytes = await reader.readline()
+        logger.debug(f"ack={ack.decode()}")
+        response: bytes = await reader.readline()
+        if response != MUX_ACK:
+            writer.close()
+            await writer.wait_closed()
+            raise ChannelNotSupported(response[:20])
+
+        channel = cls(reader, writer)
+        channel.read_task = asyncio.create_task(channel.read_frames())
+        return channel
+
+    def new_request_id(self) -> int:
+        self.last_request_id = (self.last_request_id + 1) % 2**32
+        return self.last_request_id
+
+    async def write_frame(self, request_id: int, frame_type: FrameType, payload: bytes):
+        async with self.write_lock:
+            self.writer.write(FRAME_HEADER.pack(request_id, frame_type, len(payload)))
+            self.writer.write(payload)
+            await self.writer.drain()
+
+    async def request(self, payload: bytes) -> bytes:
+        """Send a request to the VM and wait for its response.
+
+        Returns an empty response if the connection is closed before, as when the
+        VM does not respond on a dedicated connection.
+        """
+        if self.closed:
+            return b""
+        request_id = self.new_request_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.write_frame(request_id, FrameType.request, payload)
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def send_messages(self, request_id: int, messages: AsyncIterable[bytes]):
+        window = self.send_windows[request_id]
+        async for message in messages:
+            # Paused, without reading further, while the program is not consuming
+            await window.acquire()
+            if self.closed:
+                return
+            await self.write_frame(request_id, FrameType.receive, message)
+
+    async def stream(
+        self,
+        payload: bytes,
+        timeout: float,
+        receive_messages: Optional[AsyncIterable[bytes]] = None,
+    ) -> AsyncIterator[Tuple[FrameType, bytes]]:
+        """Send a request to the VM and yield the frames of its response as they arrive.
+
+        `receive_messages` are sent to the VM concurrently, while the response is
+        being produced.
+
+        The last frame yielded is always a response frame, empty if the connection
+        was closed. Raises `asyncio.TimeoutError` if the VM does not send any frame
+        within `timeout` seconds and `StreamCancelled` if the stream is aborted.
+
+        Credit is granted to the VM as the frames are consumed. The request is
+        cancelled in the VM if the stream is closed before its response frame.
+        """
+        if self.closed:
+            yield FrameType.response, b""
+            return
+        request_id = self.new_request_id()
+        # Bounded by the flow control, checked by `read_frames`
+        queue: asyncio.Queue = asyncio.Queue()
+        self.streams[request_id] = queue
+        self.send_windows[request_id] = asyncio.Semaphore(STREAM_WINDOW)
+        send_task: Optional[asyncio.Task] = None
+        finished = False
+        consumed = 0
+        try:
+            await self.write_frame(request_id, FrameType.stream_request, payload)
+            if receive_messages:
+                send_task = asyncio.create_task(
+                    self.send_messages(request_id, receive_messages)
+                )
+            while True:
+                if self.closed and queue.empty():
+                    finished = True
+                    yield FrameType.response, b""
+                    return
+                frame_type, frame = await asyncio.wait_for(queue.get(), timeout)
+                if frame_type == FrameType.cancel:
+                    finished = True
+                    raise StreamCancelled(f"Request {request_id} aborted")
+                finished = frame_type == FrameType.response
+                yield frame_type, frame
+                if finished:
+                    return
+                consumed += 1
+                if consumed >= STREAM_WINDOW // 2:
+                    await self.write_frame(
+                        request_id, FrameType.credit, CREDIT.pack(consumed)
+                    )
+                    consumed = 0
+        finally:
+            if send_task:
+                send_task.cancel()
+            self.streams.pop(request_id, None)
+            self.send_windows.pop(request_id, None)
+            if not finished and not self.closed:
+                # The VM would otherwise keep waiting for credit
+                create_task_log_exceptions(
+                    self.write_frame(request_id, FrameType.cancel, b""),
+                    name=f"cancel request {request_id}",
+                )
+
+    async def read_frames(self):
+        """Dispatch the responses from the VM to the pending requests."""
+        try:
+            while True:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                request_id, frame_type, length = FRAME_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length)
+
+                if frame_type == FrameType.credit:
+                    window = self.send_windows.get(request_id)
+                    if window:
+                        for _ in range(CREDIT.unpack(payload)[0]):
+                            window.release()
+                    continue
+
+                queue = self.streams.get(request_id)
+                if queue:
+                    if frame_type == FrameType.event and queue.qsize() >= STREAM_WINDOW:
+                        logger.error(f"Request {request_id} exceeded its window")
+                        self.cancel_stream(request_id, queue)
+                    else:
+                        queue.put_nowait((frame_type, payload))
+                    continue
+
+                future = self.pending.get(request_id)
+                if not future or future.done():
+                    # The request may have timed out in the meantime
+                    logger.debug(f"Dropping frame of request {request_id}")
+                elif frame_type != FrameType.response:
+                    logger.warning(f"Unexpected frame type {frame_type}")
+                else:
+                    future.set_result(payload)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            logger.debug("Multiplexed channel closed by the VM")
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(b"")
+            for queue in self.streams.values():
+                queue.put_nowait((FrameType.response, b""))
+
+    def cancel_stream(self, request_id: int, queue: asyncio.Queue):
+        """Abort a stream, in the VM as well. Further frames for it are dropped."""
+        del self.streams[request_id]
+        queue.put_nowait((FrameType.cancel, b""))
+        create_task_log_exceptions(
+            self.write_frame(request_id, FrameType.cancel, b""),
+            name=f"cancel stream {request_id}",
+        )
+
+    async def close(self):
+        self.closed = True
+        if self.read_task:
+            self.read_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionResetError:
+            pass
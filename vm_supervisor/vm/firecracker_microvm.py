@@ -7,7 +7,7 @@ from dataclasses import dataclass, field
 from enum import Enum
 from multiprocessing import Process, set_start_method
 from os.path import isfile, exists
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, AsyncIterator, Tuple, AsyncIterable
 from pathlib import Path
 
 import msgpack
@@ -16,11 +16,12 @@ try:
     import psutil as psutil
 except ImportError:
     psutil = None
-from aiohttp import ClientResponseError
+from aiohttp import ClientResponseError, ClientError
 
 from aleph_message.models import ProgramContent
 from aleph_message.models.program import MachineResources, Encoding
 from firecracker.config import (
+    Balloon,
     BootSource,
     Drive,
     MachineConfig,
@@ -28,12 +29,16 @@ from firecracker.config import (
     Vsock,
     NetworkInterface,
 )
-from firecracker.microvm import MicroVM, setfacl
+from firecracker.microvm import MicroVM, setfacl, FirecrackerApiError
 from guest_api.__main__ import run_guest_api
 from ..conf import settings
 from ..storage import get_code_path, get_runtime_path, get_data_path, get_volume_path
 from ..network.interfaces import TapInterface
-from ..network.firewall import teardown_nftables_for_vm
+from ..network.hostnetwork import delete_tap, release_tap
+from ..cgroups import ResourceUsage, VmCgroup, get_cgroup_sampler
+from ..placement import Placement, apply_placement, get_cpu_placer
+from ..snapshots import get_snapshot_key, get_snapshot_store
+from .channel import VmChannel, ChannelNotSupported, FrameType
 
 logger = logging.getLogger(__name__)
 set_start_method("spawn")
@@ -206,7 +211,7 @@ class VmInitNotConnected(Exception):
 
 class AlephFirecrackerVM:
     vm_id: int
-    vm_hash: str
+    vm_hash: Optional[str]
     resources: AlephFirecrackerResources
     enable_console: bool
     enable_networking: bool
@@ -214,11 +219,20 @@ class AlephFirecrackerVM:
     fvm: Optional[MicroVM] = None
     guest_api_process: Optional[Process] = None
     tap_interface: Optional[TapInterface] = None
+    channel: Optional[VmChannel] = None
+    channel_supported: bool = True
+    balloon_lock: asyncio.Lock
+    balloon_size: int = 0  # MiB requested from the guest
+    balloon_inflations: int = 0
+    balloon_stats: Optional[Dict] = None  # When the balloon was last inflated
+    placement: Optional[Placement] = None  # CPUs the VM is pinned to
+    cgroup: Optional[VmCgroup] = None
+    usage: Optional[ResourceUsage] = None  # Final usage, once torn down
 
     def __init__(
         self,
         vm_id: int,
-        vm_hash: str,
+        vm_hash: Optional[str],
         resources: AlephFirecrackerResources,
         enable_networking: bool = False,
         enable_console: Optional[bool] = None,
@@ -234,6 +248,13 @@ class AlephFirecrackerVM:
         self.enable_console = enable_console
         self.hardware_resources = hardware_resources
         self.tap_interface = tap_interface
+        self.channel_lock = asyncio.Lock()
+        self.balloon_lock = asyncio.Lock()
+        # Exposed with the executions
+        self.balloon_size = 0
+        self.balloon_inflations = 0
+        self.balloon_stats = None
+        self.placement = None
 
     def to_dict(self):
         if self.fvm.proc and psutil:
@@ -311,18 +332,40 @@ class AlephFirecrackerVM:
             ]
             if self.enable_networking
             else [],
+            balloon=Balloon(
+                amount_mib=0,
+                deflate_on_oom=True,
+                stats_polling_interval_s=settings.BALLOON_STATS_INTERVAL,
+            )
+            if settings.BALLOON_IDLE_DELAY is not None
+            else None,
         )
 
         logger.debug(config.json(by_alias=True, exclude_none=True, indent=4))
 
+        snapshot_key = self.get_snapshot_key()
+        snapshot = get_snapshot_store().get(snapshot_key) if snapshot_key else None
+
         try:
-            await fvm.start(config)
+            if snapshot:
+                logger.debug(f"Restoring vm {self.vm_id} from snapshot {snapshot_key}")
+                await fvm.start_from_snapshot(
+                    snapshot.snapshot_path, snapshot.mem_file_path
+                )
+            else:
+                await fvm.start(config)
+            if settings.CPU_PINNING:
+                self.placement = get_cpu_placer().place(self.hardware_resources.vcpus)
+                apply_placement(fvm.proc.pid, self.placement)
+            cgroup_sampler = get_cgroup_sampler()
+            if cgroup_sampler:
+                self.cgroup = cgroup_sampler.add(self.vm_id, fvm.proc.pid)
             logger.debug("setup done")
             self.fvm = fvm
         except Exception:
+            self.release_placement()
             await fvm.teardown()
-            teardown_nftables_for_vm(self.vm_id)
-            await self.tap_interface.delete()
+            await delete_tap(self.vm_id, self.tap_interface)
             raise
 
     async def start(self):
@@ -335,9 +378,80 @@ class AlephFirecrackerVM:
         if self.enable_console:
             fvm.start_printing_logs()
 
-        await fvm.wait_for_init()
+        if fvm.restored_from_snapshot:
+            logger.debug("Restored from snapshot, init is already waiting")
+        else:
+            await fvm.wait_for_init()
+            if self.placement:
+                # The vcpu threads have been created in the meantime
+                apply_placement(fvm.proc.pid, self.placement)
         logger.debug(f"started fvm {self.vm_id}")
 
+    def get_snapshot_key(self) -> Optional[str]:
+        """Key of the snapshots this VM can be restored from, if snapshots apply.
+
+        The devices of a VM are part of its snapshot, so VMs with a network interface
+        or program specific drives are always booted, see `vm_supervisor.snapshots`.
+        """
+        if (
+            not settings.USE_SNAPSHOTS
+            or self.enable_networking
+            or self.resources.code_encoding == Encoding.squashfs
+            or self.resources.volumes
+        ):
+            return None
+        return get_snapshot_key(
+            runtime_ref=self.resources.message_content.runtime.ref,
+            kernel_path=self.resources.kernel_image_path,
+            vcpus=self.hardware_resources.vcpus,
+            memory=self.hardware_resources.memory,
+        )
+
+    async def snapshot(self):
+        """Snapshot the VM, if snapshots apply and none is available for it yet.
+
+        The VM is paused meanwhile, so this is only used on VMs booted in advance and
+        not yet configured, never while a request waits for the VM.
+        """
+        snapshot_key = self.get_snapshot_key()
+        if snapshot_key and not get_snapshot_store().get(snapshot_key):
+            await self.create_snapshot(snapshot_key)
+
+    async def create_snapshot(self, snapshot_key: str):
+        """Snapshot the VM while its init waits for a configuration."""
+        loop = asyncio.get_event_loop()
+        store = get_snapshot_store()
+        snapshot = await loop.run_in_executor(None, store.new_snapshot)
+        try:
+            await self.fvm.create_snapshot(
+                snapshot.snapshot_path, snapshot.mem_file_path
+            )
+        except Exception as error:
+            logger.warning(f"Could not snapshot vm {self.vm_id}: {error}")
+            await loop.run_in_executor(None, store.discard, snapshot)
+            return
+        await loop.run_in_executor(None, store.add, snapshot_key, snapshot)
+        logger.debug(f"Created snapshot {snapshot_key} from vm {self.vm_id}")
+
+    def assign(
+        self,
+        vm_hash: str,
+        resources: AlephFirecrackerResources,
+        enable_networking: bool,
+        hardware_resources: MachineResources,
+    ):
+        """Assign a program to a VM that was booted in advance, before it is configured.
+
+        The VM must have been started without program specific drives, since these
+        cannot be attached after boot.
+        """
+        if not self.fvm:
+            raise ValueError("No VM found. Call setup() before assign()")
+        self.vm_hash = vm_hash
+        self.resources = resources
+        self.enable_networking = enable_networking and settings.ALLOW_VM_NETWORKING
+        self.hardware_resources = hardware_resources
+
     async def configure(self):
         """Configure the VM by sending configuration info to it's init"""
 
@@ -432,11 +546,134 @@ class AlephFirecrackerVM:
         if self.guest_api_process and self.guest_api_process._popen:
             self.guest_api_process.terminate()
 
+    async def get_channel(self) -> Optional[VmChannel]:
+        """Return the multiplexed channel to the init of the VM, if supported."""
+        async with self.channel_lock:
+            if self.channel and not self.channel.closed:
+                return self.channel
+            if not self.channel_supported:
+                return None
+            try:
+                self.channel = await VmChannel.open(self.fvm.vsock_path)
+            except ChannelNotSupported:
+                logger.info(
+                    f"Init of vm {self.vm_id} does not support multiplexing, "
+                    "using one connection per request"
+                )
+                self.channel_supported = False
+                return None
+            except ConnectionRefusedError:
+                raise VmInitNotConnected("MicroVM may have crashed")
+            return self.channel
+
+    async def can_stream(self) -> bool:
+        """Whether responses can be streamed from the VM, see `run_code_streaming`."""
+        return await self.get_channel() is not None
+
+    async def run_code_streaming(
+        self, scope: dict, receive: AsyncIterable[Dict]
+    ) -> AsyncIterator[Tuple[FrameType, bytes]]:
+        """Run an HTTP request and yield the frames of the response as they arrive.
+
+        The body of the request is not part of the scope, it is sent to the VM as
+        the ASGI `receive` messages.
+
+        Each event frame contains an ASGI send event, the last frame is a response
+        frame with the output of the program or its error.
+        """
+        if not self.fvm:
+            raise ValueError("MicroVM must be created first")
+        await self.deflate_balloon()
+        channel = await self.get_channel()
+        if not channel:
+            raise ChannelNotSupported("Streaming requires a multiplexed channel")
+
+        async def receive_messages() -> AsyncIterator[bytes]:
+            async for message in receive:
+                yield msgpack.dumps(message, use_bin_type=True)
+
+        async for frame in channel.stream(
+            RunCodePayload(scope=scope).as_msgpack(),
+            timeout=self.hardware_resources.seconds,
+            receive_messages=receive_messages(),
+        ):
+            yield frame
+
+    async def inflate_balloon(self) -> None:
+        """Reclaim the memory of the VM not needed while it is idle."""
+        amount = self.hardware_resources.memory - settings.BALLOON_RESERVED_MEMORY
+        if not self.fvm or self.balloon_size or amount <= 0:
+            return
+        async with self.balloon_lock:
+            if self.balloon_size:
+                return
+            # Set before the call so that a request arriving meanwhile deflates it
+            self.balloon_size = amount
+            try:
+                await self.fvm.update_balloon(amount)
+            except (FirecrackerApiError, ClientError) as error:
+                logger.warning(f"Balloon of vm {self.vm_id} not inflated: {error}")
+                self.balloon_size = 0
+                return
+            self.balloon_inflations += 1
+        if settings.BALLOON_STATS_INTERVAL:
+            try:
+                self.balloon_stats = await self.fvm.get_balloon_statistics()
+            except (FirecrackerApiError, ClientError) as error:
+                logger.warning(f"Balloon statistics of vm {self.vm_id}: {error}")
+
+    async def deflate_balloon(self) -> None:
+        """Give its memory back to the VM before it is used."""
+        if not self.fvm or not self.balloon_size:
+            return
+        # Waits for an inflation in progress, that would otherwise land after this
+        async with self.balloon_lock:
+            if not self.balloon_size:
+                return
+            try:
+                await self.fvm.update_balloon(0)
+            except (FirecrackerApiError, ClientError) as error:
+                logger.warning(f"Balloon of vm {self.vm_id} not deflated: {error}")
+            self.balloon_size = 0
+
+    def release_placement(self) -> None:
+        if self.placement:
+            get_cpu_placer().release(self.placement)
+            self.placement = None
+
+    def read_process_usage(self) -> Optional[ResourceUsage]:
+        """Usage of the Firecracker process, when it is not in a cgroup."""
+        if not (self.fvm and self.fvm.proc and psutil):
+            return None
+        try:
+            process = psutil.Process(self.fvm.proc.pid)
+            cpu_times = process.cpu_times()
+            io_counters = process.io_counters()
+        except psutil.NoSuchProcess:
+            logger.warning("Cannot read process metrics (process not found)")
+            return None
+        return ResourceUsage(
+            cpu_time_user=cpu_times.user,
+            cpu_time_system=cpu_times.system,
+            io_read_count=io_counters.read_count,
+            io_write_count=io_counters.write_count,
+            io_read_bytes=io_counters.read_bytes,
+            io_write_bytes=io_counters.write_bytes,
+        )
+
     async def teardown(self):
+        self.release_placement()
+        if self.channel:
+            await self.channel.close()
         if self.fvm:
+            if not self.cgroup:
+                self.usage = self.read_process_usage()
             await self.fvm.teardown()
-            teardown_nftables_for_vm(self.vm_id)
-            await self.tap_interface.delete()
+            if self.cgroup:
+                # The counters of the cgroup remain once the process has exited
+                self.usage = get_cgroup_sampler().close(self.vm_id)
+                self.cgroup = None
+            await release_tap(self.vm_id, self.tap_interface)
         await self.stop_guest_api()
 
     async def run_code(
@@ -447,6 +684,14 @@ class AlephFirecrackerVM:
             raise ValueError("MicroVM must be created first")
         logger.debug("running code")
         scope = scope or {}
+        await self.deflate_balloon()
+
+        channel = await self.get_channel()
+        if channel:
+            return await asyncio.wait_for(
+                channel.request(RunCodePayload(scope=scope).as_msgpack()),
+                timeout=self.hardware_resources.seconds,
+            )
 
         async def communicate(reader, writer, scope):
             payload = RunCodePayload(scope=scope)